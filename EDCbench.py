@@ -0,0 +1,486 @@
+"""
+   Python Module: 'EDCbench' (ECHO Data Client benchmarks)
+   Atmospheric Sciences Research Center
+   Python Env   : Anaconda Python (2.7.10)
+
+   Reproducible end-to-end benchmarks for EDClient.  A local stand-in for
+   the ECHO REST API (tokens, datasets and granule queries returning
+   synthetic ECHO10 XML with 'echo-hits' headers) and a local file server
+   with configurable latency and bandwidth are started in a child process.
+   EDClient then queries the fake ECHO service and downloads the granules
+   with each of the requested download engines.  The query and download
+   timings and throughput are saved as JSON, for comparing runs.
+
+   Example:
+
+        python EDCbench.py --datasets 2 --granules 30 --file-size-mb 4 \\
+                           --latency-ms 50 --bandwidth-kb 2048 --engines multi,socket
+
+   Any arguments EDCbench doesn't know are passed on to EDClient, e.g.
+   '--max-conns 8' or '--stream-granules'.
+"""
+import os
+import sys
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import platform
+import shutil
+import tempfile
+import threading
+import time
+import datetime as dt
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+import EDClient
+
+
+class benchServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def makeFileBlock():
+    """
+    :return: 64KB of deterministic, incompressible file content
+    """
+    block = b''
+    seed = b'EDCbench'
+    while len(block) < 65536:
+        seed = hashlib.sha256(seed).digest()
+        block += seed
+    return block
+
+
+class fakeFileHandler(BaseHTTPRequestHandler):
+    """
+    Serves '/files/<size in bytes>/<name>' as 'size' bytes of synthetic
+    content, after 'latency' seconds, at no more than 'bandwidth' bytes/s
+    per connection (0 for no limit).  A single 'bytes=' Range is answered
+    with a 206 (416 if it can't be satisfied), unless 'ranges' is off, when
+    Range headers are ignored like some file servers do.
+    """
+
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    bandwidth = 0.0
+    ranges = True
+    block = makeFileBlock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def parseRange(self, size):
+        """
+        :return: (first, last) byte of the requested range, None for the
+                 whole file (no Range header, ranges off, or a header this
+                 server doesn't handle), or () if it can't be satisfied
+        """
+        header = self.headers.get('Range')
+        if not self.ranges or header is None or not header.startswith('bytes=') or ',' in header:
+            return None
+        first, sep, last = header[len('bytes='):].strip().partition('-')
+        try:
+            if first:
+                first = int(first)
+                last = min(int(last), size - 1) if last else size - 1
+            else:
+                # The last 'last' bytes
+                first = max(size - int(last), 0)
+                last = size - 1
+        except ValueError:
+            return None
+        if first > last:
+            return ()
+        return (first, last)
+
+    def do_HEAD(self):
+        self.sendFile(False)
+
+    def do_GET(self):
+        self.sendFile(True)
+
+    def sendFile(self, withBody):
+        parts = urlparse(self.path).path.split('/')
+        try:
+            size = int(parts[2])
+        except (IndexError, ValueError):
+            self.send_error(404)
+            return
+
+        time.sleep(self.latency)
+        byteRange = self.parseRange(size)
+        if byteRange == ():
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{}".format(size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if byteRange is None:
+            first, last = 0, size - 1
+            self.send_response(200)
+        else:
+            first, last = byteRange
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(first, last, size))
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(last - first + 1))
+        if self.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if not withBody:
+            return
+
+        pos = first
+        start = time.time()
+        while pos <= last:
+            offset = pos % len(self.block)
+            chunk = self.block[offset:offset + min(len(self.block) - offset, last + 1 - pos)]
+            try:
+                self.wfile.write(chunk)
+            except (IOError, OSError):
+                return
+            pos += len(chunk)
+            if self.bandwidth > 0:
+                ahead = (pos - first) / self.bandwidth - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+def fileDigest(size):
+    """
+    :return: MD5 hex digest of the 'size' bytes fakeFileHandler serves
+    """
+    block = fakeFileHandler.block
+    hasher = hashlib.md5()
+    for i in range(size // len(block)):
+        hasher.update(block)
+    hasher.update(block[:size % len(block)])
+    return hasher.hexdigest()
+
+
+def makeGranuleXML(collID, index, fileURL, sizeBytes, digest=None, numPoints=0):
+    """
+    :param collID: ECHO dataset id of the granule's collection
+    :param index: Granule number within the collection
+    :param fileURL: Online access URL of the granule file
+    :param sizeBytes: Granule file size in bytes
+    :param digest: MD5 hex digest of the file, None for no checksum
+    :param numPoints: Number of GPolygon boundary points, 0 for a bounding rectangle
+    :return: The granule query 'result' element, as ECHO10 XML text
+    """
+    begin = dt.datetime(2007, 4, 7) + dt.timedelta(minutes=5 * index)
+    end = begin + dt.timedelta(minutes=5)
+
+    if numPoints > 0:
+        points = []
+        for i in range(numPoints):
+            angle = 2.0 * math.pi * i / numPoints
+            points.append("<Point><PointLongitude>{:.4f}</PointLongitude>"
+                          "<PointLatitude>{:.4f}</PointLatitude></Point>".format(
+                              10.0 * math.cos(angle), 10.0 * math.sin(angle)))
+        geometry = "<GPolygon><Boundary>" + "".join(points) + "</Boundary></GPolygon>"
+    else:
+        geometry = ("<BoundingRectangle><WestBoundingCoordinate>-180.0</WestBoundingCoordinate>"
+                    "<NorthBoundingCoordinate>90.0</NorthBoundingCoordinate>"
+                    "<EastBoundingCoordinate>180.0</EastBoundingCoordinate>"
+                    "<SouthBoundingCoordinate>-90.0</SouthBoundingCoordinate></BoundingRectangle>")
+
+    checksum = ""
+    if digest is not None:
+        checksum = "<Checksum><Value>{}</Value><Algorithm>MD5</Algorithm></Checksum>".format(digest)
+
+    return ('<result echo_granule_id="G{index}-{coll}">'
+            '<Granule><GranuleUR>{coll}.{index:06d}</GranuleUR>'
+            '<DataGranule><SizeMBDataGranule>{sizeMB!r}</SizeMBDataGranule>{checksum}</DataGranule>'
+            '<Temporal><RangeDateTime><BeginningDateTime>{begin}Z</BeginningDateTime>'
+            '<EndingDateTime>{end}Z</EndingDateTime></RangeDateTime></Temporal>'
+            '<Spatial><HorizontalSpatialDomain><Geometry>{geometry}</Geometry></HorizontalSpatialDomain></Spatial>'
+            '<OnlineAccessURLs><OnlineAccessURL><URL>{url}</URL><MimeType>application/x-hdf</MimeType>'
+            '</OnlineAccessURL></OnlineAccessURLs></Granule></result>').format(
+        index=index, coll=collID, sizeMB=sizeBytes / math.pow(1024, 2), checksum=checksum,
+        begin=begin.isoformat(), end=end.isoformat(), geometry=geometry, url=fileURL)
+
+
+class fakeECHOHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the ECHO REST API calls EDClient makes.  Every dataset
+    query finds one collection, with 'numGranules' granules of 'fileSize'
+    bytes served by the fake file server at 'fileURL'.
+    """
+
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    numGranules = 30
+    fileSize = 1048576
+    numPoints = 0
+    fileURL = ""
+    digests = {}  # file size: MD5 digest
+
+    def log_message(self, format, *args):
+        pass
+
+    def sendXML(self, body, headers=()):
+        body = body.encode('utf-8')
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if urlparse(self.path).path.endswith('/tokens'):
+            self.sendXML("<token><id>EDCBENCH-TOKEN</id></token>")
+        else:
+            self.send_error(404)
+
+    def do_DELETE(self):
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path.startswith('/catalog-rest/echo_catalog/datasets'):
+            self.datasetQuery(query)
+        elif url.path.startswith('/catalog-rest/echo_catalog/granules'):
+            self.granuleQuery(query)
+        else:
+            self.send_error(404)
+
+    def datasetQuery(self, query):
+        shortName = query.get('shortName', ['BENCH'])[0]
+        self.sendXML('<results><result echo_dataset_id="C-{sn}"><Collection>'
+                     '<ShortName>{sn}</ShortName><ArchiveCenter>EDCBENCH</ArchiveCenter>'
+                     '<Description>EDCbench synthetic collection</Description>'
+                     '<Temporal><RangeDateTime><BeginningDateTime>2007-01-01T00:00:00Z</BeginningDateTime>'
+                     '<EndingDateTime>2007-12-31T23:59:59Z</EndingDateTime></RangeDateTime></Temporal>'
+                     '</Collection></result></results>'.format(sn=shortName))
+
+    def granuleQuery(self, query):
+        collID = query.get('echo_collection_id[]', ['C-BENCH'])[0]
+        pageSize = int(query.get('page_size', ['10'])[0])
+        pageNum = int(query.get('page_num', ['1'])[0])
+
+        if self.fileSize not in self.digests:
+            self.digests[self.fileSize] = fileDigest(self.fileSize)
+        results = []
+        for index in range((pageNum - 1) * pageSize, min(pageNum * pageSize, self.numGranules)):
+            fileURL = "{}/files/{}/{}_{:06d}.hdf".format(self.fileURL, self.fileSize, collID, index)
+            results.append(makeGranuleXML(collID, index, fileURL, self.fileSize, self.digests[self.fileSize],
+                                          self.numPoints))
+        self.sendXML("<results>" + "".join(results) + "</results>", [("echo-hits", str(self.numGranules))])
+
+
+def serveForever(servers):
+    for server in servers[1:]:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    servers[0].serve_forever()
+
+
+def startServers(args):
+    """
+    Start the fake ECHO and file servers in a child process
+    :return: (child process, ECHO base URL)
+    """
+    fileServer = benchServer(('127.0.0.1', 0), fakeFileHandler)
+    echoServer = benchServer(('127.0.0.1', 0), fakeECHOHandler)
+
+    fakeFileHandler.latency = args.latency_ms / 1000.0
+    fakeFileHandler.bandwidth = args.bandwidth_kb * 1024.0
+    fakeFileHandler.ranges = args.ranges
+    fakeECHOHandler.latency = args.echo_latency_ms / 1000.0
+    fakeECHOHandler.numGranules = args.granules
+    fakeECHOHandler.fileSize = int(args.file_size_mb * math.pow(1024, 2))
+    fakeECHOHandler.numPoints = args.polygon_points
+    fakeECHOHandler.fileURL = "http://127.0.0.1:{}".format(fileServer.server_address[1])
+
+    # The servers (with their bound sockets) are inherited by a forked child
+    context = multiprocessing
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('fork')
+    child = context.Process(target=serveForever, args=([echoServer, fileServer],))
+    child.daemon = True
+    child.start()
+    echoURL = "http://127.0.0.1:{}".format(echoServer.server_address[1])
+    echoServer.server_close()
+    fileServer.server_close()
+    return child, echoURL
+
+
+def writeRequestFile(workDir, numDatasets):
+    """
+    :return: Name of an EDClient download request file for 'numDatasets' datasets
+    """
+    dataRoot = os.path.join(workDir, "DATA")
+    dbRoot = os.path.join(workDir, "DB")
+    for path in (dataRoot, dbRoot):
+        if not os.access(path, os.F_OK):
+            os.makedirs(path)
+
+    datasets = []
+    for i in range(numDatasets):
+        datasets.append('<dataset shortname="BENCH{}"><version v="1" />'
+                        '<boundingbox w="-180.0" s="-90.0" e="180.0" n="90.0" />'
+                        '<temporal type="static"><startdatetime dtstr="2007-04-07T00:00:00Z" />'
+                        '<enddatetime dtstr="2007-04-08T23:59:59Z" /></temporal></dataset>'.format(i))
+    reqFile = os.path.join(workDir, "EDCbench_request.xml")
+    with open(reqFile, 'w') as fh:
+        fh.write('<echoDownload useDB="False" dbRoot="{}" dataRoot="{}">{}</echoDownload>\n'.format(
+            dbRoot, dataRoot, "".join(datasets)))
+    with open(os.path.join(workDir, "ECHOlogin.xml"), 'w') as fh:
+        fh.write("<token><username>edcbench</username><password>edcbench</password>"
+                 "<client_id>EDCbench</client_id><user_ip_address>127.0.0.1</user_ip_address></token>\n")
+    return reqFile
+
+
+def runOnce(reqFile, echoURL, engine, clientArgs):
+    """
+    Query the fake ECHO service and download all granules with 'engine'
+    :return: Dictionary of timings and counts for the run
+    """
+    dataRoot = os.path.join(os.path.dirname(reqFile), "DATA")
+    shutil.rmtree(dataRoot)
+    os.makedirs(dataRoot)
+
+    argv = [reqFile, "-o", "D", "--no-cache", "--transfer-report", "none", "--echo-url", echoURL,
+            "--download-engine", engine] + clientArgs
+    runMgr = EDClient.runManager(argv)
+    EDClient.EDClog = runMgr.getLogFH()
+
+    ero = EDClient.ECHOrequest(runMgr)
+    queryStart = time.time()
+    client = EDClient.ECHOclient(runMgr.getMaxFiles(), runMgr.getPoolSize(),
+                                 runMgr.getTimeouts(), runMgr.getNumRetries(),
+                                 runMgr.getQueryWorkers(), runMgr.getResponseCache(),
+                                 *runMgr.getTokenCache(), serviceurl=runMgr.getEchoURL())
+    ero.getReqData(client)
+    client.logout()
+    queryTime = time.time() - queryStart
+
+    granules = [g for c in ero.collContainer for g in c.granContainer]
+    loader = EDClient.ECHOdownloader(ero, None, runMgr)
+    downloadStart = time.time()
+    loader.downloadGranules(ero)
+    downloadTime = time.time() - downloadStart
+
+    done = [g for g in granules if g.getDownloadStatus() == 1]
+    numBytes = sum(os.path.getsize(g.getLocalFileName()) for g in done)
+    runMgr.getLogFH().close()
+
+    return {'engine': engine,
+            'query_seconds': queryTime,
+            'granules': len(granules),
+            'query_granules_per_second': len(granules) / max(queryTime, 1e-6),
+            'download_seconds': downloadTime,
+            'downloaded': len(done),
+            'failed': len(granules) - len(done),
+            'bytes': numBytes,
+            'download_MB_per_second': numBytes / math.pow(1024, 2) / max(downloadTime, 1e-6)}
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EDClient query and download benchmarks")
+    parser.add_argument("--datasets", help="Number of datasets in the request (Default=2)", type=int, default=2)
+    parser.add_argument("--granules", help="Granules per dataset (Default=30)", type=int, default=30)
+    parser.add_argument("--file-size-mb", help="Granule file size in MegaBytes (Default=1)", type=float,
+                        default=1.0)
+    parser.add_argument("--polygon-points", help="GPolygon points per granule, 0 for a bounding rectangle "
+                        "(Default=0)", type=int, default=0)
+    parser.add_argument("--latency-ms", help="File server time to first byte in ms (Default=20)", type=float,
+                        default=20.0)
+    parser.add_argument("--bandwidth-kb", help="File server KB/s per connection, 0 for no limit (Default=0)",
+                        type=float, default=0.0)
+    parser.add_argument("--no-ranges", help="File server ignores Range requests, so downloads can't be "
+                        "resumed or segmented", action="store_false", dest="ranges")
+    parser.add_argument("--echo-latency-ms", help="Fake ECHO API response latency in ms (Default=50)",
+                        type=float, default=50.0)
+    parser.add_argument("--engines", help="Comma separated download engines to run (Default=multi,single,socket)",
+                        type=str, default="multi,single,socket")
+    parser.add_argument("--repeat", help="Runs per engine (Default=1)", type=int, default=1)
+    parser.add_argument("--output", help="JSON results file (Default=EDCbench_<timestamp>.json)", type=str,
+                        default=None)
+    parser.add_argument("--keep", help="Keep the benchmark working directory", action="store_true")
+    args, clientArgs = parser.parse_known_args()
+
+    engines = [e for e in args.engines.split(',') if e]
+    for engine in engines:
+        if engine not in EDClient.ECHOdownloader.engines:
+            parser.error("unknown download engine '{}' (known: {})".format(
+                engine, ", ".join(EDClient.ECHOdownloader.engines)))
+
+    stamp = dt.datetime.now().replace(microsecond=0).isoformat('T').replace('-', '_').replace(':', '_')
+    output = os.path.abspath(args.output or "EDCbench_" + stamp + ".json")
+
+    child, echoURL = startServers(args)
+    workDir = tempfile.mkdtemp(prefix="edcbench")
+    startDir = os.getcwd()
+    runs = []
+    try:
+        os.chdir(workDir)
+        reqFile = writeRequestFile(workDir, args.datasets)
+        for engine in engines:
+            for i in range(args.repeat):
+                run = runOnce(reqFile, echoURL, engine, clientArgs)
+                run['repeat'] = i + 1
+                runs.append(run)
+                print("{engine:>8s} #{repeat}: query {query_seconds:.2f}s ({query_granules_per_second:.0f} "
+                      "granules/s), download {download_seconds:.2f}s ({download_MB_per_second:.2f} MB/s, "
+                      "{downloaded}/{granules} granules)".format(**run))
+    finally:
+        os.chdir(startDir)
+        child.terminate()
+        if args.keep:
+            print("Working directory kept: {}".format(workDir))
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    summary = {}
+    for engine in engines:
+        engineRuns = [run for run in runs if run['engine'] == engine]
+        summary[engine] = {'median_query_seconds': median([run['query_seconds'] for run in engineRuns]),
+                           'median_download_seconds': median([run['download_seconds'] for run in engineRuns]),
+                           'median_download_MB_per_second': median([run['download_MB_per_second']
+                                                                    for run in engineRuns])}
+
+    results = {'timestamp': stamp,
+               'edclient_version': EDClient.__version__,
+               'python': platform.python_version(),
+               'config': dict(vars(args), client_args=clientArgs),
+               'runs': runs,
+               'summary': summary}
+    with open(output, 'w') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+    print("Results written to {}".format(output))
+
+
+if __name__ == '__main__':
+    main()
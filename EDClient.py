@@ -15,15 +15,41 @@
 
 """
 import os
+import sys
 import argparse
+import threading
+import time
+import json
+import heapq
+import select
+import csv
+import hashlib
+import tempfile
 import datetime as dt
 import requests
 import math
+import random
 import lxml.etree as ET
 import pycurl
 import MySQLdb
 from lxml.etree import XMLSyntaxError
 from re import sub as resub
+from errno import EBADF, EINTR, ENOENT
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.exceptions import HTTPError as urllib3HTTPError
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+from collections import deque
 
 __version__ = "1.2.0"
 
@@ -39,8 +65,52 @@ except ImportError:
     raise SystemExit
 
 
+def threadMap(func, items, numWorkers):
+    """
+    Apply 'func' to every item in 'items' using a bounded pool of worker
+    threads and return the results in the same order as 'items'.  If any
+    call raises (including SystemExit), the first such exception is
+    re-raised in the calling thread once all workers have finished.
+    """
+    results = [None] * len(items)
+    errors = []
+    workQueue = Queue.Queue()
+    for index, item in enumerate(items):
+        workQueue.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = workQueue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except BaseException:
+                errors.append((index, sys.exc_info()[1]))
+
+    numWorkers = max(1, min(numWorkers, len(items)))
+    if numWorkers == 1:
+        worker()
+    else:
+        workers = [threading.Thread(target=worker) for i in range(numWorkers)]
+        for t in workers:
+            t.daemon = True
+            t.start()
+        for t in workers:
+            t.join()
+
+    if errors:
+        errors.sort(key=lambda e: e[0])
+        raise errors[0][1]
+    return results
+
+
 class runManager(object):
-    def __init__(self):
+    def __init__(self, argv=None):
+        """
+        :param argv: Command line arguments, None to use sys.argv
+        """
 
         self.dtStamp = dt.datetime.now()
         self.dtStamp = self.dtStamp.replace(microsecond=0)
@@ -52,7 +122,7 @@ class runManager(object):
         self.logfilename = "./EDClient_" + self.dtString + ".log"
 
         self.setLogFH(self.logfilename)
-        self.setCmdLineArgs()
+        self.setCmdLineArgs(argv)
 
     def setLogFH(self, fname):
         try:
@@ -65,22 +135,124 @@ class runManager(object):
     def getLogFH(self):
         return (self.logfh)
 
-    def setCmdLineArgs(self):
+    def setCmdLineArgs(self, argv=None):
 
         parser = argparse.ArgumentParser()
         parser.add_argument("xmlfile", help="Your ECHO Download Request File (XML format)", type=str)
         parser.add_argument("-o", "--opmode", help="Operation mode ('Q' for query only (default), 'D' for download)",
                             type=str, default='Q')
-        parser.add_argument("-r", "--resultsize", help="Allowable # of data files to download (Max=2000,Default=1000)",
-                            type=int, default=1000)
+        parser.add_argument("-r", "--resultsize", help="Granule query page size, all pages are retrieved "
+                            "(Max=2000,Default=1000)", type=int, default=1000)
         parser.add_argument("-s", "--downloadlimit", help="Maximum download size in MegaBytes (Max=5120,Default=3072)",
                             type=int, default=3072)
-        args = parser.parse_args()
+        parser.add_argument("--pool-size", help="Max. pooled (keep-alive) connections to the ECHO service (Default=10)",
+                            type=int, default=10, dest="poolsize")
+        parser.add_argument("--connect-timeout", help="ECHO service connect timeout in seconds (Default=30)",
+                            type=float, default=30.0, dest="conntimeout")
+        parser.add_argument("--read-timeout", help="ECHO service read timeout in seconds (Default=120)",
+                            type=float, default=120.0, dest="readtimeout")
+        parser.add_argument("--retries", help="Retries for failed idempotent ECHO requests (Default=3)",
+                            type=int, default=3)
+        parser.add_argument("--stream-granules", help="Parse granule query responses as they stream in",
+                            action="store_true", dest="streamgranules")
+        parser.add_argument("--no-cache", help="Don't use the on-disk ECHO query response cache",
+                            action="store_false", dest="usecache")
+        parser.add_argument("--cache-dir", help="ECHO query response cache directory (Default=./.echocache)",
+                            type=str, default="./.echocache", dest="cachedir")
+        parser.add_argument("--dataset-ttl", help="Dataset query cache time to live in hours (Default=24)",
+                            type=float, default=24.0, dest="datasetttl")
+        parser.add_argument("--granule-ttl", help="Granule query cache time to live in hours (Default=1)",
+                            type=float, default=1.0, dest="granulettl")
+        parser.add_argument("--cache-size", help="Maximum response cache size in MegaBytes (Default=512)",
+                            type=int, default=512, dest="cachesize")
+        parser.add_argument("--token-cache", help="Reuse ECHO tokens across runs through this file (Default=off)",
+                            type=str, default=None, dest="tokencache")
+        parser.add_argument("--token-lifetime", help="Minutes a new ECHO token is reused for (Default=60)",
+                            type=float, default=60.0, dest="tokenlifetime")
+        parser.add_argument("--min-conns", help="Min. number of concurrent downloads (Default=2)",
+                            type=int, default=2, dest="minconns")
+        parser.add_argument("--max-conns", help="Max. number of concurrent downloads (Default=20)",
+                            type=int, default=20, dest="maxconns")
+        parser.add_argument("--host-conns", help="Max. number of concurrent downloads per host (Default=10)",
+                            type=int, default=10, dest="hostconns")
+        parser.add_argument("--day-rate", help="Day time download rate limit in KB/s (Default=0, no limit)",
+                            type=float, default=0.0, dest="dayrate")
+        parser.add_argument("--night-rate", help="Night time download rate limit in KB/s (Default=0, no limit)",
+                            type=float, default=0.0, dest="nightrate")
+        parser.add_argument("--night-hours", help="Night time start-end hours for --night-rate (Default=20-6)",
+                            type=str, default="20-6", dest="nighthours")
+        parser.add_argument("--transfer-report", help="Per-transfer timing report format, csv, jsonl or none "
+                            "(Default=jsonl)", type=str, default="jsonl", choices=("csv", "jsonl", "none"),
+                            dest="transferreport")
+        parser.add_argument("--profile", help="Profile this run phase, may be repeated (Default=none)",
+                            type=str, action="append", default=[], choices=ECHOphaseTimer.phases,
+                            dest="profilephases")
+        parser.add_argument("--profiler", help="Profiler for --profile phases, cprofile or tracemalloc "
+                            "(Default=cprofile)", type=str, default="cprofile", choices=ECHOphaseTimer.profilers)
+        parser.add_argument("--metrics-file", help="Write Prometheus metrics to this .prom file (Default=off)",
+                            type=str, default=None, dest="metricsfile")
+        parser.add_argument("--metrics-interval", help="Seconds between metrics updates while downloading "
+                            "(Default=60)", type=float, default=60.0, dest="metricsinterval")
+        parser.add_argument("--echo-url", help="ECHO service base URL (Default=" + ECHOclient.echoURL + ")",
+                            type=str, default=ECHOclient.echoURL, dest="echourl")
+        parser.add_argument("--download-engine", help="Granule download engine, multi, single or socket "
+                            "(Default=multi)", type=str, default="multi", choices=ECHOdownloader.engines,
+                            dest="downloadengine")
+        parser.add_argument("--no-http2", help="Don't negotiate HTTP/2 for granule downloads",
+                            action="store_false", dest="http2")
+        parser.add_argument("--max-attempts", help="Download attempts per granule in one run (Default=3)",
+                            type=int, default=3, dest="maxattempts")
+        parser.add_argument("--retry-delay", help="Seconds before the first in-run retry, doubled for each "
+                            "further retry (Default=5)", type=float, default=5.0, dest="retrydelay")
+        parser.add_argument("--max-tries", help="Runs a granule may fail in before it is quarantined, 0 for "
+                            "no limit (Default=10)", type=int, default=10, dest="maxtries")
+        parser.add_argument("--race-mirrors", help="Race the two best mirrors of granules up to this size in "
+                            "MB, first to send data wins (Default=0, off)", type=float, default=0.0,
+                            dest="racemirrors")
+        parser.add_argument("--segment-threshold", help="Download granules larger than this size in MB as "
+                            "concurrent byte range segments (Default=1024, 0=off)", type=float, default=1024.0,
+                            dest="segmentthreshold")
+        parser.add_argument("--segment-conns", help="Max. concurrent segments per granule (Default=4)", type=int,
+                            default=4, dest="segmentconns")
+        parser.add_argument("--query-workers", help="Concurrent dataset/granule queries (Max=32,Default=4)",
+                            type=int, default=4, dest="queryworkers")
+        args = parser.parse_args(argv)
 
         self.XMLcfgFile = args.xmlfile
         self.opMode = args.opmode
         self.MAXdataFiles = args.resultsize
         self.dwnloadSize = args.downloadlimit
+        self.poolSize = args.poolsize
+        self.connTimeout = args.conntimeout
+        self.readTimeout = args.readtimeout
+        self.numRetries = args.retries
+        self.queryWorkers = args.queryworkers
+        self.streamGranules = args.streamgranules
+        self.useCache = args.usecache
+        self.cacheDir = args.cachedir
+        self.cacheTTLs = {'dataset': args.datasetttl * 3600.0, 'granule': args.granulettl * 3600.0}
+        self.cacheSizeMB = args.cachesize
+        self.tokenCacheFile = args.tokencache
+        self.tokenLifetime = args.tokenlifetime * 60.0
+        self.minConns = args.minconns
+        self.maxConns = args.maxconns
+        self.hostConns = args.hostconns
+        self.dayRate = args.dayrate
+        self.nightRate = args.nightrate
+        self.nightHours = args.nighthours
+        self.transferReport = args.transferreport
+        self.profilePhases = args.profilephases
+        self.profiler = args.profiler
+        self.metrics = ECHOmetrics(args.metricsfile, args.metricsinterval)
+        self.echoURL = args.echourl
+        self.downloadEngine = args.downloadengine
+        self.http2 = args.http2
+        self.maxAttempts = args.maxattempts
+        self.retryDelay = args.retrydelay
+        self.maxTries = args.maxtries
+        self.raceMirrorsMB = args.racemirrors
+        self.segmentThresholdMB = args.segmentthreshold
+        self.segmentConns = args.segmentconns
 
     def getopMode(self):
         return self.opMode
@@ -94,6 +266,252 @@ class runManager(object):
     def getDwnLoadLimit(self):
         return self.dwnloadSize
 
+    def getPoolSize(self):
+        return self.poolSize
+
+    def getTimeouts(self):
+        return (self.connTimeout, self.readTimeout)
+
+    def getNumRetries(self):
+        return self.numRetries
+
+    def getQueryWorkers(self):
+        return self.queryWorkers
+
+    def getStreamGranules(self):
+        return self.streamGranules
+
+    def getConnLimits(self):
+        return (self.minConns, self.maxConns)
+
+    def getHostConns(self):
+        return self.hostConns
+
+    def getRateLimits(self):
+        return (self.dayRate, self.nightRate, self.nightHours)
+
+    def getTokenCache(self):
+        return (self.tokenCacheFile, self.tokenLifetime)
+
+    def getEchoURL(self):
+        return self.echoURL
+
+    def getDownloadEngine(self):
+        return self.downloadEngine
+
+    def getHTTP2(self):
+        return self.http2
+
+    def getRetryPolicy(self):
+        return (self.maxAttempts, self.retryDelay)
+
+    def getMaxTries(self):
+        return self.maxTries
+
+    def getRaceMirrors(self):
+        return self.raceMirrorsMB
+
+    def getSegmentation(self):
+        return (self.segmentThresholdMB, self.segmentConns)
+
+    def getMetrics(self):
+        return self.metrics
+
+    def getPhaseTimer(self):
+        return ECHOphaseTimer("./EDClient_" + self.dtString + "_phases", self.profilePhases, self.profiler)
+
+    def getTransferReport(self):
+        """
+        :return: ECHOtransferReport object, None if the report is disabled
+        """
+        if self.transferReport == "none":
+            return None
+        return ECHOtransferReport("./EDClient_" + self.dtString + "_transfers", self.transferReport)
+
+    def getResponseCache(self):
+        """
+        :return: ECHOcache object, None if response caching is disabled
+        """
+        if not self.useCache:
+            return None
+        return ECHOcache(self.cacheDir, self.cacheTTLs, self.cacheSizeMB)
+
+
+class ECHOphaseTimer(object):
+    """
+    Wall clock and CPU timers around each phase of a run.  The times are
+    written to the log and to a JSON summary file when the run finishes.
+    Phases named with --profile are run under cProfile (or tracemalloc,
+    where available) and their stats are dumped next to the log file.
+    """
+
+    phases = ("pendingTx", "login", "query", "logout", "pendingDownloads", "download", "cleanup",
+              "savePending", "dbUpdate", "savePendTx")
+    profilers = ("cprofile", "tracemalloc")
+
+    def __init__(self, basename, profilePhases, profiler):
+        """
+        :param basename: Summary and profile stats filename prefix
+        :param profilePhases: Names of the phases to profile
+        :param profiler: 'cprofile' or 'tracemalloc'
+        """
+        self.basename = basename
+        self.profilePhases = set(profilePhases)
+        self.profiler = profiler
+        self.timings = []  # list of (phase, wall seconds, CPU seconds) tuples
+        if self.profiler == "tracemalloc":
+            try:
+                import tracemalloc
+            except ImportError:
+                EDClog.write("ECHOphaseTimer::__init__\n")
+                EDClog.write("\t***WARNING: tracemalloc not available, profiling with cProfile\n")
+                self.profiler = "cprofile"
+
+    def cpuTime(self):
+        t = os.times()
+        return t[0] + t[1]
+
+    def run(self, phase, func, *args, **kwargs):
+        """
+        Call 'func' with the given arguments as the run phase 'phase'
+        :return: The return value of 'func'
+        """
+        wallStart = time.time()
+        cpuStart = self.cpuTime()
+        try:
+            if phase in self.profilePhases:
+                return self.runProfiled(phase, func, *args, **kwargs)
+            return func(*args, **kwargs)
+        finally:
+            wall = time.time() - wallStart
+            cpu = self.cpuTime() - cpuStart
+            self.timings.append((phase, wall, cpu))
+            EDClog.write("ECHOphaseTimer::run\n")
+            EDClog.write("\tPhase {}: {:.3f}s wall, {:.3f}s CPU\n".format(phase, wall, cpu))
+
+    def runProfiled(self, phase, func, *args, **kwargs):
+        statsFile = "{}_{}".format(self.basename, phase)
+        if self.profiler == "tracemalloc":
+            import tracemalloc
+            tracemalloc.start(25)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                snapshot.dump(statsFile + ".tracemalloc")
+                EDClog.write("ECHOphaseTimer::runProfiled\n")
+                EDClog.write("\tPhase {} memory: {:.1f} MB current, {:.1f} MB peak, top allocations:\n".format(
+                    phase, current / math.pow(1024, 2), peak / math.pow(1024, 2)))
+                for stat in snapshot.statistics('lineno')[:25]:
+                    EDClog.write("\t\t{}\n".format(stat))
+
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            profile.dump_stats(statsFile + ".prof")
+            EDClog.write("ECHOphaseTimer::runProfiled\n")
+            EDClog.write("\tPhase {} profile stats written to {}.prof\n".format(phase, statsFile))
+            stats = pstats.Stats(profile, stream=EDClog)
+            stats.sort_stats('cumulative').print_stats(25)
+
+    def getDurations(self):
+        """
+        :return: Dictionary of phase: wall clock seconds (summed if run more than once)
+        """
+        durations = {}
+        for phase, wall, cpu in self.timings:
+            durations[phase] = durations.get(phase, 0.0) + wall
+        return durations
+
+    def close(self):
+        """
+        Write the phase timings to the log and the JSON summary file
+        """
+        EDClog.write("ECHOphaseTimer::close\n")
+        totalWall = sum(wall for phase, wall, cpu in self.timings)
+        totalCPU = sum(cpu for phase, wall, cpu in self.timings)
+        for phase, wall, cpu in self.timings:
+            EDClog.write("\t{:<18s}{:10.3f}s wall{:10.3f}s CPU\n".format(phase, wall, cpu))
+        EDClog.write("\t{:<18s}{:10.3f}s wall{:10.3f}s CPU\n".format("total", totalWall, totalCPU))
+
+        summary = {'phases': [{'phase': phase, 'wall': wall, 'cpu': cpu} for phase, wall, cpu in self.timings],
+                   'wall': totalWall,
+                   'cpu': totalCPU}
+        try:
+            with open(self.basename + ".json", 'w') as fh:
+                json.dump(summary, fh, indent=2)
+        except IOError:
+            EDClog.write("\t***WARNING: Could not write phase summary file ({}.json)\n".format(self.basename))
+
+
+class ECHOmetrics(object):
+    """
+    Run metrics in the Prometheus text exposition format, for the
+    node_exporter textfile collector.  The file is rewritten atomically (a
+    temporary file renamed over it) at the end of the run and, while
+    downloading, at most every 'interval' seconds.  Without a metrics file
+    name the metrics are only kept in memory.
+    """
+
+    def __init__(self, filename, interval):
+        """
+        :param filename: The .prom file to write, None to disable writing
+        :param interval: Minimum seconds between writes during a download
+        """
+        self.filename = filename
+        self.interval = interval
+        self.metrics = {}  # name: [type, help, {labels: value}]
+        self.order = []  # metric names, in the order they were first set
+        self.lastWrite = 0.0
+
+    def set(self, name, mtype, helpStr, value, labels=()):
+        """
+        :param mtype: Prometheus metric type, 'counter' or 'gauge'
+        :param labels: Sequence of (label name, label value) tuples
+        """
+        if name not in self.metrics:
+            self.metrics[name] = [mtype, helpStr, {}]
+            self.order.append(name)
+        self.metrics[name][2][tuple(labels)] = value
+
+    def due(self):
+        return self.filename is not None and time.time() - self.lastWrite >= self.interval
+
+    def format(self):
+        lines = []
+        for name in self.order:
+            mtype, helpStr, samples = self.metrics[name]
+            lines.append("# HELP {} {}".format(name, helpStr))
+            lines.append("# TYPE {} {}".format(name, mtype))
+            for labels in sorted(samples):
+                labelStr = ""
+                if labels:
+                    labelStr = "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}"
+                lines.append("{}{} {}".format(name, labelStr, repr(float(samples[labels]))))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        if self.filename is None:
+            return
+        self.lastWrite = time.time()
+        self.set("edclient_metrics_timestamp_seconds", "gauge", "Time the metrics were last written",
+                 self.lastWrite)
+        metricsDir = os.path.dirname(os.path.abspath(self.filename))
+        try:
+            fd, tmpPath = tempfile.mkstemp(dir=metricsDir, prefix=".edclient", suffix=".prom.tmp")
+            with os.fdopen(fd, 'w') as fh:
+                fh.write(self.format())
+            os.chmod(tmpPath, 0o644)
+            os.rename(tmpPath, self.filename)
+        except (IOError, OSError) as error:
+            EDClog.write("ECHOmetrics::write\n")
+            EDClog.write("\t***WARNING: Could not write metrics file {} ({})\n".format(self.filename, error))
+
 
 class ECHOrequest(object):
     """
@@ -106,6 +524,9 @@ class ECHOrequest(object):
     # to remove comments from XML data
     parser = ET.XMLParser(remove_comments=True)
 
+    # Valid values of the optional 'downloadOrder' attribute of 'echoDownload'
+    downloadOrders = ("discovery", "largest", "newest", "collection")
+
     def __init__(self, runMgr):
         """EDClient_2015_11_24T08_47_12.log
         :param cla: Command line arguments
@@ -113,13 +534,18 @@ class ECHOrequest(object):
         self.xmlConfigFile = runMgr.getXMLfile()
         self.maxDataFiles = runMgr.getMaxFiles()
         self.dwnloadLimit = runMgr.getDwnLoadLimit()
+        self.queryWorkers = runMgr.getQueryWorkers()
+        self.streamGranules = runMgr.getStreamGranules()
         self.directoryRoot = ""
+        self.downloadOrder = "discovery"
         self.availDiskSpaceMB = 0.0
         self.dataSetQueries = []
         self.numDatasetQueries = 0
         self.numCollections = 0
         self.havePendDwnld = False  # assume no pending downloads
         self.pdlfile = "pendingDwnld.xml"
+        self.qdlfile = "quarantineDwnld.xml"  # granules that failed in 'maxTries' runs
+        self.maxTries = runMgr.getMaxTries()
 
         # Check to see if there are any pending downloads that
         # will need to be processed
@@ -133,6 +559,9 @@ class ECHOrequest(object):
             else:
                 self.havePendDwnld = True
 
+        # Granules that failed in 'maxTries' runs are not downloaded again
+        self.quarantined = self.loadQuarantine()
+
         # Container to hold dataset (collection) objects
         self.collContainer = []
 
@@ -190,6 +619,13 @@ class ECHOrequest(object):
             EDClog.write("\tDB root and DATA root cannot be same path, fix XML request file\n")
             return False
 
+        # Get the (optional) granule download order policy
+        self.downloadOrder = self.edrRoot.get('downloadOrder', default="discovery")
+        if self.downloadOrder not in self.downloadOrders:
+            EDClog.write("\tInvalid downloadOrder (" + self.downloadOrder + "), should be one of " +
+                         ", ".join(self.downloadOrders) + "\n")
+            return False
+
         if self.dbFlag == 'True':
             self.directoryRoot = dbroot
         else:
@@ -209,6 +645,12 @@ class ECHOrequest(object):
             EDClog.write("\tInvalid result set size (" + str(self.maxDataFiles) + "), should be >= 1 and <= 2000\n")
             return False
 
+        # Check number of concurrent query workers
+        if (self.queryWorkers < 1 or self.queryWorkers > 32):
+            EDClog.write("\tInvalid number of query workers (" + str(self.queryWorkers) +
+                         "), should be >= 1 and <= 32\n")
+            return False
+
         # Check download size (MegaBytes).  Current maximum is 5GB (5120MB)
         if (self.dwnloadLimit <= 0 or self.dwnloadLimit > 5120):
             EDClog.write("\tInvalid download size (" + str(self.dwnloadLimit) + "), should be > 0 and <= 5120\n")
@@ -421,110 +863,170 @@ class ECHOrequest(object):
     def getDirRoot(self):
         return self.directoryRoot
 
+    def getDownloadOrder(self):
+        return self.downloadOrder
+
     def getReqData(self, eClient):
         """
         Retrieve all requested collection and granule information from the ECHO
-        web service using the 'eClient' object interface
+        web service using the 'eClient' object interface.  Each dataset query,
+        and its dependent granule query, is run as one unit of work on a
+        bounded pool of 'queryWorkers' threads.  Results are added to the
+        collection container in request file order.
         """
         # Keep track of a 'collection counter' (numCollections) since we can't
         # rely on every collection/dataset request to be successful (return
         # 1, and only 1, collection)
         # self.numCollections set to 0 (zero) in __init__
 
-        for i in range(self.numDatasetQueries):
-            queryStr = self.dataSetQueries[i].getDSqueryStr()
-            collElemRoot = eClient.makeDatasetQuery(queryStr, "echo10")
-            if ((len(collElemRoot) == 0) or (len(collElemRoot) > 1)):
+        EDClog.write("ECHOrequest::getReqData\n")
+        EDClog.write("\tRunning {} dataset queries with {} query workers\n".format(
+            self.numDatasetQueries, self.queryWorkers))
+
+        queryResults = threadMap(lambda dsQuery: self.runDatasetQuery(eClient, dsQuery),
+                                 self.dataSetQueries[:self.numDatasetQueries], self.queryWorkers)
+
+        for queryStr, collElemRoot, collection in queryResults:
+            if collection is None:
                 EDClog.write("ECHOrequest::getReqData\n\t***IGNORING REQUEST\n")
                 EDClog.write("\tYour dataset query: " + queryStr +
                              " returned " + str(len(collElemRoot)) +
                              " results, should be 1, check your query criteria\n")
                 EDClog.write(ET.tostring(collElemRoot, pretty_print=True))
             else:
-                # If we reach this block we are confident there is 1, and only 1 result
-                # from the collection query.  Create a new collection object with a
-                # collection element root reference.
+                self.collContainer.append(collection)
+                self.numCollections += 1
 
-                result = collElemRoot.find('result')
-                collID = result.get("echo_dataset_id")
-                try:
-                    shortName = result.find('Collection').find('ShortName').text
-                except AttributeError:
-                    shortName = "NoShortName"
+    def runDatasetQuery(self, eClient, dsQuery):
+        """
+        Run a single dataset query and, if it returns exactly 1 collection, the
+        granule query for that collection.  Called from the 'getReqData' worker
+        threads, so it only builds and returns objects, it never touches the
+        collection container.
+        :return: (query string, collection element root, collection object or
+                 None if the dataset query didn't return 1, and only 1, result)
+        """
+        queryStr = dsQuery.getDSqueryStr()
+        collElemRoot = eClient.makeDatasetQuery(queryStr, "echo10")
+        if ((len(collElemRoot) == 0) or (len(collElemRoot) > 1)):
+            return (queryStr, collElemRoot, None)
+
+        # If we reach this point we are confident there is 1, and only 1 result
+        # from the collection query.  Create a new collection object with a
+        # collection element root reference.
+        collection = self.makeCollection(collElemRoot)
+
+        if self.streamGranules:
+            # Granule objects are built as the query response streams in
+            granules = eClient.streamGranuleQuery(
+                collection.collID,
+                dsQuery.getSpatialstr(),
+                dsQuery.getTemporalStr(),
+                self.maxDataFiles, "echo10", collection.makeGranule)
+            collection.addGranules(granules)
+        else:
+            granElemRoot = eClient.makeGranuleQuery(
+                collection.collID,
+                dsQuery.getSpatialstr(),
+                dsQuery.getTemporalStr(),
+                self.maxDataFiles, "echo10")
+            # EDClog.write(ET.tostring(granElemRoot, pretty_print=True))
 
-                try:
-                    archCenter = result.find('Collection').find('ArchiveCenter').text
-                except AttributeError:
-                    archCenter = "NoArchiveCenter"
+            # 'collection' is an ECHOcollection object, which has a method 'getGranules'
+            collection.getGranules(granElemRoot)
 
-                try:
-                    collDesc = result.find('Collection').find('Description').text
-                except AttributeError:
-                    collDesc = "NoDescription"
-                else:
-                    # v1.2.0 Bug fix.  The MODIS data description has embedded unicode
-                    # characters that cause trouble when trying to print the collection
-                    # description as an ASCII string.
-                    collDesc = collDesc.encode('utf-8')
+        return (queryStr, collElemRoot, collection)
 
-                try:
-                    begDateTime = result.find('Collection').find('Temporal').find('RangeDateTime').find(
-                        'BeginningDateTime').text
-                except AttributeError:
-                    begDateTime = "null"
-                else:
-                    # Remove trailing 'Z' from datetime value (for DB insert)
-                    begDateTime = resub('[Z]', '', begDateTime)
+    def makeCollection(self, collElemRoot):
+        """
+        :param collElemRoot: Dataset query response root holding a single result
+        :return: A new collection object built from the dataset query result
+        """
+        result = collElemRoot.find('result')
+        collID = result.get("echo_dataset_id")
+        try:
+            shortName = result.find('Collection').find('ShortName').text
+        except AttributeError:
+            shortName = "NoShortName"
+
+        try:
+            archCenter = result.find('Collection').find('ArchiveCenter').text
+        except AttributeError:
+            archCenter = "NoArchiveCenter"
+
+        try:
+            collDesc = result.find('Collection').find('Description').text
+        except AttributeError:
+            collDesc = "NoDescription"
+        else:
+            # v1.2.0 Bug fix.  The MODIS data description has embedded unicode
+            # characters that cause trouble when trying to print the collection
+            # description as an ASCII string.
+            collDesc = collDesc.encode('utf-8')
+
+        try:
+            begDateTime = result.find('Collection').find('Temporal').find('RangeDateTime').find(
+                'BeginningDateTime').text
+        except AttributeError:
+            begDateTime = "null"
+        else:
+            # Remove trailing 'Z' from datetime value (for DB insert)
+            begDateTime = resub('[Z]', '', begDateTime)
 
+        try:
+            endDateTime = result.find('Collection').find('Temporal').find('RangeDateTime').find(
+                'EndingDateTime').text
+        except AttributeError:
+            endDateTime = "null"
+        else:
+            # Remove trailing 'Z' from datetime value
+            endDateTime = resub('[Z]', '', endDateTime)
+
+        # Locate the additional attributes and extract Digital Object Identifier,
+        # if one exists.
+        doiname = "NoDOI"
+        doiauth = "NoDOIauth"
+        for attr in collElemRoot.iter('AdditionalAttribute'):
+            attrname = attr.find('Name').text
+            if (attrname == 'identifier_product_doi'):
                 try:
-                    endDateTime = result.find('Collection').find('Temporal').find('RangeDateTime').find(
-                        'EndingDateTime').text
-                except AttributeError:
-                    endDateTime = "null"
-                else:
-                    # Remove trailing 'Z' from datetime value
-                    endDateTime = resub('[Z]', '', endDateTime)
-
-                # Locate the additional attributes and extract Digital Object Identifier,
-                # if one exists.
-                doiname = "NoDOI"
-                doiauth = "NoDOIauth"
-                for attr in collElemRoot.iter('AdditionalAttribute'):
-                    attrname = attr.find('Name').text
-                    if (attrname == 'identifier_product_doi'):
-                        try:
-                            doiname = attr.find('Value').text
-                        except:
-                            doiname = "NoDOI"
-                    if (attrname == 'identifier_product_doi_authority'):
-                        try:
-                            doiauth = attr.find('Value').text
-                        except:
-                            doiauth = "NoDOIauth"
-
-                doi = doiauth + '/' + doiname
-
-                self.collContainer.append(ECHOcollection(collID, shortName, archCenter,
-                                                         collDesc, begDateTime, endDateTime,
-                                                         doi))
-                # EDClog.write(ET.tostring(collElemRoot, pretty_print=True))
-
-                granElemRoot = eClient.makeGranuleQuery(
-                    self.collContainer[self.numCollections].collID,
-                    self.dataSetQueries[i].getSpatialstr(),
-                    self.dataSetQueries[i].getTemporalStr(),
-                    self.maxDataFiles, "echo10")
-                # EDClog.write(ET.tostring(granElemRoot, pretty_print=True))
-
-                # remember, 'self' is the ECHOrequest object, 'collContainer' stores
-                # the collections objects, which have a method 'getGranules'
-                self.collContainer[self.numCollections].getGranules(granElemRoot)
+                    doiname = attr.find('Value').text
+                except:
+                    doiname = "NoDOI"
+            if (attrname == 'identifier_product_doi_authority'):
+                try:
+                    doiauth = attr.find('Value').text
+                except:
+                    doiauth = "NoDOIauth"
 
-                self.numCollections += 1
+        doi = doiauth + '/' + doiname
+
+        return ECHOcollection(collID, shortName, archCenter, collDesc, begDateTime, endDateTime, doi)
 
     def getHavePendDwnld(self):
         return self.havePendDwnld
 
+    def getQuarantined(self):
+        return self.quarantined
+
+    def loadQuarantine(self):
+        """
+        :return: Set of the ECHO granule ids in the quarantine file
+        """
+        if not os.access(self.qdlfile, os.F_OK):
+            return set()
+        try:
+            quarRoot = ET.parse(self.qdlfile, self.parser).getroot()
+        except (IOError, XMLSyntaxError):
+            EDClog.write("ECHOrequest::loadQuarantine\n")
+            EDClog.write("\t****WARNING: Couldn't parse quarantine file {}, no granules skipped\n".format(
+                self.qdlfile))
+            return set()
+        quarantined = set(granID.text for granID in quarRoot.iter('granID'))
+        EDClog.write("ECHOrequest::loadQuarantine\n")
+        EDClog.write("\t{} quarantined granules will be skipped ({})\n".format(len(quarantined), self.qdlfile))
+        return quarantined
+
     def getDBflag(self):
         return self.dbFlag
 
@@ -593,8 +1095,12 @@ class ECHOrequest(object):
                         lon = float(pp.find('longitude').text)
                         polyPoints.append((lat, lon))
 
-                accessURLs.append((g.find('accessURL').text, "NoMimeType"))
+                for accurl in g.findall('accessURL'):
+                    accessURLs.append((accurl.text, "NoMimeType"))
                 localFileName = g.find('localFileName').text
+                checksum = None
+                if g.find('checksum') is not None:
+                    checksum = (g.find('checksum').get('algorithm'), g.find('checksum').text)
 
                 granIndex = self.inGranules(collID, granID)
                 if granIndex == -1:
@@ -603,12 +1109,12 @@ class ECHOrequest(object):
                         ECHOgranule(granID, granuleUR, sizeMB,
                                     GbegDateTime, GendDateTime, hasPolyPoints, polyPoints,
                                     w_bound, s_bound, e_bound, n_bound,
-                                    accessURLs, localFileName, numDwnldTrys + 1))
+                                    accessURLs, localFileName, numDwnldTrys, checksum))
                 else:
                     EDClog.write("ECHOrequest::loadPendDwnld\n")
                     EDClog.write("\tPending granule {} already in granule container\n".format(granID))
                     EDClog.write("\tIncrementing # of download trys\n")
-                    self.collContainer[collIndex].granContainer[granIndex].setnumtrys(numDwnldTrys + 1)
+                    self.collContainer[collIndex].granContainer[granIndex].setnumtrys(numDwnldTrys)
 
     def inCollections(self, cid):
         """
@@ -647,82 +1153,149 @@ class ECHOrequest(object):
             EDClog.write("\t****SEVERE: Couldn't remove old pending download file\n".format(self.pdlfile))
             raise SystemExit
 
+    def makePendingCollection(self, xmlroot, c, granules):
+        """
+        Add a pending download 'collection' element, holding 'granules', to 'xmlroot'
+        """
+        coll = ET.SubElement(xmlroot, "collection")
+        coll_id = ET.SubElement(coll, 'collID')
+        coll_id.text = c.getid()
+        coll_sn = ET.SubElement(coll, "shortName")
+        coll_sn.text = c.getshortname()
+        coll_ac = ET.SubElement(coll, "archCenter")
+        coll_ac.text = c.getarchcenter()
+        coll_desc = ET.SubElement(coll, "collDesc")
+        coll_desc.text = c.getdesc()
+        coll_bdt = ET.SubElement(coll, 'begDateTime')
+        coll_bdt.text = c.getbegdate()
+        coll_edt = ET.SubElement(coll, 'endDateTime')
+        coll_edt.text = c.getenddate()
+        coll_doi = ET.SubElement(coll, 'doi')
+        coll_doi.text = c.getdoi()
+
+        grans = ET.SubElement(coll, "granules")
+        for g in granules:
+            gran = ET.SubElement(grans, "granule")
+            gran_id = ET.SubElement(gran, "granID")
+            gran_id.text = g.getgranuleid()
+            gran_trys = ET.SubElement(gran, "dwnldtrys")
+            gran_trys.text = str(g.getnumtrys())
+            gran_stat = ET.SubElement(gran, "dwnldstat")
+            gran_stat.text = str(g.getDownloadStatus())
+            gran_ur = ET.SubElement(gran, "granuleUR")
+            gran_ur.text = g.getgranuleur()
+            gran_size = ET.SubElement(gran, "sizeMB")
+            gran_size.text = str(g.getGranuleSizeMB())
+            gran_bdt = ET.SubElement(gran, 'begDateTime')
+            gran_bdt.text = g.getgranulebd()
+            gran_edt = ET.SubElement(gran, 'endDateTime')
+            gran_edt.text = g.getgranuleed()
+            gran_spatial = ET.SubElement(gran, 'spatial')
+            if g.getPolyPointStatus():
+                gran_ppts = ET.SubElement(gran_spatial, 'polyPoints')
+                ppts = g.getPolyPoints()
+                for lat, lon in ppts:
+                    pp = ET.SubElement(gran_ppts, 'polyPoint')
+                    pp_lat = ET.SubElement(pp, 'latitude')
+                    pp_lat.text = str(lat)
+                    pp_lon = ET.SubElement(pp, 'longitude')
+                    pp_lon.text = str(lon)
+            else:
+                wb = ET.SubElement(gran_spatial, 'w_bound')
+                wb.text = str(g.getgranulewb())
+                sb = ET.SubElement(gran_spatial, 's_bound')
+                sb.text = str(g.getgranulesb())
+                eb = ET.SubElement(gran_spatial, 'e_bound')
+                eb.text = str(g.getgranuleeb())
+                nb = ET.SubElement(gran_spatial, 'n_bound')
+                nb.text = str(g.getgranulenb())
+            # Every access URL is kept, the others are mirrors of the first
+            for granuleURL, mimeType in g.accessURLs:
+                gran_accurl = ET.SubElement(gran, 'accessURL')
+                gran_accurl.text = granuleURL
+            gran_lf = ET.SubElement(gran, 'localFileName')
+            gran_lf.text = g.getLocalFileName()
+            if g.getChecksum() is not None:
+                gran_ck = ET.SubElement(gran, 'checksum')
+                gran_ck.set('algorithm', g.getChecksum()[0])
+                gran_ck.text = g.getChecksum()[1]
+
+    def saveQuarantine(self, quarroot):
+        """
+        Add the quarantined granules in 'quarroot' to the quarantine file.  The
+        file has the pending download file format, so granules can be moved
+        back to 'pendingDwnld.xml' by hand once the problem is fixed.
+        """
+        EDClog.write("ECHOrequest::saveQuarantine\n")
+        for coll in quarroot:
+            for gran in coll.find('granules'):
+                EDClog.write("\tQuarantined granule {} after {} failed runs\n".format(
+                    gran.find('granID').text, gran.find('dwnldtrys').text))
+
+        if os.access(self.qdlfile, os.F_OK):
+            try:
+                oldRoot = ET.parse(self.qdlfile, self.parser).getroot()
+            except (IOError, XMLSyntaxError):
+                EDClog.write("\t****SEVERE: Couldn't parse quarantine file {}, starting a new one\n".format(
+                    self.qdlfile))
+            else:
+                # Add the new granules, each granule only once, under the
+                # collection's existing entry if it has one
+                known = set(granID.text for granID in oldRoot.iter('granID'))
+                oldColls = dict((coll.find('collID').text, coll) for coll in oldRoot.findall('collection'))
+                for coll in list(quarroot):
+                    grans = coll.find('granules')
+                    for gran in list(grans):
+                        if gran.find('granID').text in known:
+                            grans.remove(gran)
+                    if len(grans) == 0:
+                        continue
+                    collID = coll.find('collID').text
+                    if collID in oldColls:
+                        for gran in list(grans):
+                            oldColls[collID].find('granules').append(gran)
+                    else:
+                        oldRoot.append(coll)
+                quarroot = oldRoot
+
+        try:
+            with open(self.qdlfile, 'w') as fh:
+                fh.write(ET.tostring(quarroot, pretty_print=True))
+        except IOError:
+            EDClog.write("\t****SEVERE: Couldn't write quarantine file {}, quarantined granules follow\n".format(
+                self.qdlfile))
+            EDClog.write(ET.tostring(quarroot, pretty_print=True))
+
     def savePending(self):
         """
         If any downloads failed (status codes -1 (file transfer failed) or -2
-        (directory make fail), save them as "pending" downloads
+        (directory make fail), save them as "pending" downloads.  Granules that
+        have now failed in 'maxTries' runs are quarantined instead.
         """
-        haveNewPending = False
+        xmlroot = ET.Element("data")
+        quarroot = ET.Element("data")
         for c in self.collContainer:
             if c.getFailedStatus():
-                haveNewPending = True
-
-        if haveNewPending:
-            xmlroot = ET.Element("data")
-            for c in self.collContainer:
-                if c.getFailedStatus():
-                    # At least one granule in this collection encountered a download
-                    # failure (-1) or granule directory make failure (-2), or the
-                    # whole collection failed (-2) if the collection directory make failed
-                    coll = ET.SubElement(xmlroot, "collection")
-                    coll_id = ET.SubElement(coll, 'collID')
-                    coll_id.text = c.getid()
-                    coll_sn = ET.SubElement(coll, "shortName")
-                    coll_sn.text = c.getshortname()
-                    coll_ac = ET.SubElement(coll, "archCenter")
-                    coll_ac.text = c.getarchcenter()
-                    coll_desc = ET.SubElement(coll, "collDesc")
-                    coll_desc.text = c.getdesc()
-                    coll_bdt = ET.SubElement(coll, 'begDateTime')
-                    coll_bdt.text = c.getbegdate()
-                    coll_edt = ET.SubElement(coll, 'endDateTime')
-                    coll_edt.text = c.getenddate()
-                    coll_doi = ET.SubElement(coll, 'doi')
-                    coll_doi.text = c.getdoi()
-
-                    grans = ET.SubElement(coll, "granules")
-                    for g in c.granContainer:
-                        if g.getDownloadStatus() < 0:
-                            gran = ET.SubElement(grans, "granule")
-                            gran_id = ET.SubElement(gran, "granID")
-                            gran_id.text = g.getgranuleid()
-                            gran_trys = ET.SubElement(gran, "dwnldtrys")
-                            gran_trys.text = str(g.getnumtrys())
-                            gran_stat = ET.SubElement(gran, "dwnldstat")
-                            gran_stat.text = str(g.getDownloadStatus())
-                            gran_ur = ET.SubElement(gran, "granuleUR")
-                            gran_ur.text = g.getgranuleur()
-                            gran_size = ET.SubElement(gran, "sizeMB")
-                            gran_size.text = str(g.getGranuleSizeMB())
-                            gran_bdt = ET.SubElement(gran, 'begDateTime')
-                            gran_bdt.text = g.getgranulebd()
-                            gran_edt = ET.SubElement(gran, 'endDateTime')
-                            gran_edt.text = g.getgranuleed()
-                            gran_spatial = ET.SubElement(gran, 'spatial')
-                            if g.getPolyPointStatus():
-                                gran_ppts = ET.SubElement(gran_spatial, 'polyPoints')
-                                ppts = g.getPolyPoints()
-                                for lat, lon in ppts:
-                                    pp = ET.SubElement(gran_ppts, 'polyPoint')
-                                    pp_lat = ET.SubElement(pp, 'latitude')
-                                    pp_lat.text = str(lat)
-                                    pp_lon = ET.SubElement(pp, 'longitude')
-                                    pp_lon.text = str(lon)
-                            else:
-                                wb = ET.SubElement(gran_spatial, 'w_bound')
-                                wb.text = str(g.getgranulewb())
-                                sb = ET.SubElement(gran_spatial, 's_bound')
-                                sb.text = str(g.getgranulesb())
-                                eb = ET.SubElement(gran_spatial, 'e_bound')
-                                eb.text = str(g.getgranuleeb())
-                                nb = ET.SubElement(gran_spatial, 'n_bound')
-                                nb.text = str(g.getgranulenb())
-                            gran_accurl = ET.SubElement(gran, 'accessURL')
-                            granuleURL, mimeType = g.accessURLs[0]
-                            gran_accurl.text = granuleURL
-                            gran_lf = ET.SubElement(gran, 'localFileName')
-                            gran_lf.text = g.getLocalFileName()
+                # At least one granule in this collection encountered a download
+                # failure (-1) or granule directory make failure (-2), or the
+                # whole collection failed (-2) if the collection directory make failed
+                pending = []
+                quarantined = []
+                for g in c.granContainer:
+                    if g.getDownloadStatus() in (-1, -2):
+                        if self.maxTries > 0 and g.getnumtrys() >= self.maxTries:
+                            quarantined.append(g)
+                        else:
+                            pending.append(g)
+                if pending:
+                    self.makePendingCollection(xmlroot, c, pending)
+                if quarantined:
+                    self.makePendingCollection(quarroot, c, quarantined)
 
+        if len(quarroot) > 0:
+            self.saveQuarantine(quarroot)
+
+        if len(xmlroot) > 0:
             # Things get a little weird here.  If there was a pending download
             # file, it was read, and processed.  Now we have "new" pending
             # downloads and must save them, in XML format.  We must first try
@@ -791,6 +1364,275 @@ class ECHOdsQuery(object):
         return self.tStr
 
 
+class ECHOcache(object):
+    """
+    On-disk cache of ECHO web service query responses.  Entries are keyed on
+    the normalized query URL and the response format, and consist of a body
+    file (the raw response) and a small JSON metadata file (stored time, kind,
+    and the response headers needed to use or revalidate the body).  Entries
+    older than the TTL for their kind ('dataset' or 'granule') are stale, and
+    are revalidated with a conditional GET when the server gave us an ETag or
+    Last-Modified header.  The cache is kept under 'maxSizeMB' by evicting the
+    least recently used entries.
+    """
+
+    keptHeaders = ['echo-hits', 'etag', 'last-modified', 'content-type']
+
+    def __init__(self, cacheDir, ttls, maxSizeMB):
+        """
+        :param cacheDir: Cache directory, created if it doesn't exist
+        :param ttls: Dictionary of {kind: time to live in seconds}
+        :param maxSizeMB: Maximum total size of the cache in MegaBytes
+        """
+        self.cacheDir = cacheDir
+        self.ttls = ttls
+        self.maxSizeMB = maxSizeMB
+        self.statLock = threading.Lock()
+        self.numHits = 0
+        self.numMisses = 0
+        self.numRevalidated = 0
+
+        if not os.access(self.cacheDir, os.F_OK):
+            try:
+                os.makedirs(self.cacheDir, 0o700)
+            except OSError:
+                EDClog.write("ECHOcache::__init__\n")
+                EDClog.write("\t***ERROR: Couldn't create response cache directory {}\n".format(self.cacheDir))
+                raise SystemExit
+
+    def makeKey(self, url, responseFormat):
+        """
+        Normalize the query URL (lower case scheme/host, sorted query
+        parameters) and hash it together with the response format
+        """
+        base, sep, query = url.partition('?')
+        scheme, sep2, rest = base.partition('://')
+        host, sep3, path = rest.partition('/')
+        normURL = scheme.lower() + sep2 + host.lower() + sep3 + path
+        if query:
+            normURL += '?' + '&'.join(sorted(p for p in query.split('&') if p))
+        return hashlib.sha1((responseFormat + '|' + normURL).encode('utf-8')).hexdigest()
+
+    def entryPaths(self, key):
+        return (os.path.join(self.cacheDir, key + '.body'), os.path.join(self.cacheDir, key + '.meta'))
+
+    def lookup(self, kind, url, responseFormat):
+        """
+        :return: Cache entry dictionary, with a 'fresh' flag, or None on a miss
+        """
+        key = self.makeKey(url, responseFormat)
+        bodyFile, metaFile = self.entryPaths(key)
+        try:
+            with open(metaFile, 'r') as fh:
+                entry = json.load(fh)
+        except (IOError, OSError, ValueError):
+            self.countStat('numMisses')
+            return None
+
+        if not os.access(bodyFile, os.R_OK):
+            self.countStat('numMisses')
+            return None
+
+        entry['key'] = key
+        entry['bodyFile'] = bodyFile
+        entry['metaFile'] = metaFile
+        entry['fresh'] = (time.time() - entry['stored']) < self.ttls.get(kind, 0)
+        if entry['fresh']:
+            self.useEntry(entry)
+        return entry
+
+    def useEntry(self, entry):
+        """
+        Count a cache hit on 'entry' and mark it as recently used (LRU order
+        is kept through the body file modification time)
+        """
+        self.countStat('numHits')
+        try:
+            os.utime(entry['bodyFile'], None)
+        except OSError:
+            pass
+
+    def conditionalHeaders(self, entry):
+        """
+        :return: Request headers to revalidate a stale cache entry
+        """
+        headers = {}
+        if entry is not None:
+            if entry['headers'].get('etag'):
+                headers['If-None-Match'] = entry['headers']['etag']
+            if entry['headers'].get('last-modified'):
+                headers['If-Modified-Since'] = entry['headers']['last-modified']
+        return headers
+
+    def refresh(self, entry):
+        """
+        The server confirmed (304 Not Modified) that a stale entry is still
+        current, restart its TTL
+        """
+        self.countStat('numRevalidated')
+        self.useEntry(entry)
+        self.writeMeta(entry['metaFile'], entry['kind'], entry['url'], entry['headers'])
+
+    def openBody(self, entry, refresh=False):
+        """
+        :param refresh: Restart the TTL of the entry first (see 'refresh')
+        :return: The body file of 'entry' opened for reading, None if the
+                 entry can't be used (it is dropped, the query then goes to
+                 ECHO as on a cache miss)
+        """
+        try:
+            if refresh:
+                self.refresh(entry)
+            return open(entry['bodyFile'], 'rb')
+        except (IOError, OSError) as error:
+            self.dropEntry(entry, error)
+            return None
+
+    def readBody(self, entry, refresh=False):
+        """
+        :return: The body of 'entry', None if the entry can't be used (see 'openBody')
+        """
+        fh = self.openBody(entry, refresh)
+        if fh is None:
+            return None
+        try:
+            with fh:
+                return fh.read()
+        except (IOError, OSError) as error:
+            self.dropEntry(entry, error)
+            return None
+
+    def dropEntry(self, entry, error):
+        EDClog.write("ECHOcache::dropEntry\n")
+        EDClog.write("\t***WARNING: Dropping unusable cache entry for {} ({})\n".format(entry['url'], error))
+        self.discardFile(entry['bodyFile'])
+        self.discardFile(entry['metaFile'])
+
+    def newTempFile(self):
+        """
+        :return: (file object, path) of a new temporary file in the cache
+                 directory, to be passed to 'storeFile' or 'discardFile'
+        """
+        fd, tmpPath = tempfile.mkstemp(dir=self.cacheDir, suffix='.tmp')
+        return (os.fdopen(fd, 'wb'), tmpPath)
+
+    def store(self, kind, url, responseFormat, body, headers):
+        try:
+            fh, tmpPath = self.newTempFile()
+        except (IOError, OSError) as error:
+            EDClog.write("ECHOcache::store\n")
+            EDClog.write("\t***WARNING: Couldn't store cache entry for {} ({})\n".format(url, error))
+            return
+        try:
+            try:
+                fh.write(body)
+            finally:
+                fh.close()
+        except (IOError, OSError) as error:
+            EDClog.write("ECHOcache::store\n")
+            EDClog.write("\t***WARNING: Couldn't store cache entry for {} ({})\n".format(url, error))
+            self.discardFile(tmpPath)
+            return
+        self.storeFile(kind, url, responseFormat, tmpPath, headers)
+
+    def storeFile(self, kind, url, responseFormat, tmpPath, headers):
+        """
+        Move a completely written temporary body file into the cache
+        """
+        bodyFile, metaFile = self.entryPaths(self.makeKey(url, responseFormat))
+        keep = {}
+        for h in self.keptHeaders:
+            if h in headers:
+                keep[h] = headers[h]
+        try:
+            os.rename(tmpPath, bodyFile)
+            self.writeMeta(metaFile, kind, url, keep)
+        except (IOError, OSError) as error:
+            EDClog.write("ECHOcache::storeFile\n")
+            EDClog.write("\t***WARNING: Couldn't store cache entry for {} ({})\n".format(url, error))
+            self.discardFile(tmpPath)
+
+    def discardFile(self, tmpPath):
+        try:
+            os.remove(tmpPath)
+        except OSError:
+            pass
+
+    def writeMeta(self, metaFile, kind, url, headers):
+        fd, tmpPath = tempfile.mkstemp(dir=self.cacheDir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump({'kind': kind, 'url': url, 'stored': time.time(), 'headers': headers}, fh)
+        os.rename(tmpPath, metaFile)
+
+    def countStat(self, name):
+        with self.statLock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def prune(self):
+        """
+        Evict least recently used entries until the cache fits in 'maxSizeMB'
+        """
+        entries = []
+        totalBytes = 0
+        for fname in os.listdir(self.cacheDir):
+            if not fname.endswith('.body'):
+                continue
+            bodyFile = os.path.join(self.cacheDir, fname)
+            try:
+                st = os.stat(bodyFile)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname[:-len('.body')]))
+            totalBytes += st.st_size
+
+        maxBytes = self.maxSizeMB * math.pow(1024, 2)
+        numEvicted = 0
+        entries.sort()
+        for mtime, size, key in entries:
+            if totalBytes <= maxBytes:
+                break
+            for path in self.entryPaths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            totalBytes -= size
+            numEvicted += 1
+
+        EDClog.write("ECHOcache::prune\n")
+        EDClog.write("\t{} hits, {} misses, {} revalidated, {} evicted, {:.1f}MB in use\n".format(
+            self.numHits, self.numMisses, self.numRevalidated, numEvicted, totalBytes / math.pow(1024, 2)))
+
+
+class ECHOcachedResponse(object):
+    """
+    Stand-in for a 'requests' response when the body comes from the cache
+    """
+
+    status_code = 200
+
+    def __init__(self, content, headers):
+        self.content = content
+        self.headers = headers
+
+
+class ECHOteeReader(object):
+    """
+    File-like wrapper that copies everything read from 'src' to 'dst', used
+    to fill the cache while a response is being parsed as it streams in
+    """
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        if data:
+            self.dst.write(data)
+        return data
+
+
 class ECHOclient(object):
     """
     Create an ECHO web service client class.  When the client
@@ -808,9 +1650,74 @@ class ECHOclient(object):
     echoCollectionURL = echoCatalogURL + "/datasets"
     echoGranuleURL = echoCatalogURL + "/granules"
 
-    def __init__(self, maxfiles):
+    def __init__(self, maxfiles, poolsize=10, timeouts=(30.0, 120.0), retries=3, pageworkers=4, cache=None,
+                 tokencache=None, tokenlifetime=3600.0, serviceurl=None):
+        """
+        :param maxfiles: Granule query page size
+        :param poolsize: Max. number of pooled keep-alive connections
+        :param timeouts: (connect, read) timeout tuple in seconds
+        :param retries: Number of retries for failed idempotent requests
+        :param pageworkers: Max. number of granule result pages retrieved concurrently
+        :param cache: ECHOcache object for query responses, None to disable caching
+        :param tokencache: Token cache file name, None to disable token reuse
+        :param tokenlifetime: Seconds a new ECHO token is assumed to stay valid
+        :param serviceurl: ECHO service base URL, None for the default 'echoURL'
+        """
+        if serviceurl is not None:
+            self.setServiceURL(serviceurl)
         self.maxFiles = maxfiles
-        self.login()
+        self.timeouts = timeouts
+        self.pageWorkers = pageworkers
+        self.cache = cache
+        self.tokenCacheFile = tokencache
+        self.tokenLifetime = tokenlifetime
+        self.tokenLock = threading.Lock()
+        self.makeSession(poolsize, retries)
+        if not self.loadCachedToken():
+            self.login()
+
+    def setServiceURL(self, serviceurl):
+        """
+        Point this client at another ECHO service (e.g. a test instance)
+        """
+        self.echoURL = serviceurl.rstrip('/')
+        self.echoRestURL = self.echoURL + "/echo-rest"
+        self.echoLoginURL = self.echoRestURL + "/tokens"
+        self.echoProvURL = self.echoRestURL + "/providers"
+
+        self.echoCatalogURL = self.echoURL + "/catalog-rest/echo_catalog"
+        self.echoCollectionURL = self.echoCatalogURL + "/datasets"
+        self.echoGranuleURL = self.echoCatalogURL + "/granules"
+
+    def makeSession(self, poolsize, retries):
+        """
+        Create the persistent HTTP session used for all communication with
+        the ECHO web service.  The session keeps its connections alive in a
+        pool so each query doesn't pay for a new TCP/TLS handshake.  Only
+        idempotent requests (GET, DELETE) are retried, the login POST is not.
+        """
+        retryPolicy = Retry(total=retries, backoff_factor=0.5,
+                            status_forcelist=[500, 502, 503, 504])
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolsize,
+                                   max_retries=retryPolicy)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def getConnStats(self):
+        """
+        Return a (requests made, connections opened, connections reused)
+        tuple summed over all of the session's connection pools
+        """
+        numRequests = 0
+        numConnections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                numRequests += pool.num_requests
+                numConnections += pool.num_connections
+        return (numRequests, numConnections, max(numRequests - numConnections, 0))
 
     def login(self):
         reqHeaders = {'Content-type': 'application/xml'}
@@ -819,8 +1726,9 @@ class ECHOclient(object):
 
         EDClog.write("ECHOclient::login\n")
         try:
-            wsResponse = requests.post(self.echoLoginURL, data=reqDataXml, headers=reqHeaders)
-        except requests.exceptions.ConnectionError:
+            wsResponse = self.session.post(self.echoLoginURL, data=reqDataXml, headers=reqHeaders,
+                                           timeout=self.timeouts)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             EDClog.write("\t***FATAL ERROR: Couldn't make connection to ECHO web service\n")
             self.ECHO_TOKEN = "Failed"
         else:
@@ -844,15 +1752,109 @@ class ECHOclient(object):
         else:
             EDClog.write("\tSuccessful.\n")
 
+        if self.tokenCacheFile is not None:
+            self.saveCachedToken()
+
+    def getLoginUser(self):
+        try:
+            return ET.parse('ECHOlogin.xml').findtext('username')
+        except (IOError, XMLSyntaxError):
+            return None
+
+    def loadCachedToken(self):
+        """
+        Reuse the ECHO token saved by a previous run, if token caching is
+        enabled and the saved token belongs to the same user and hasn't expired.
+        The token cache file must not be readable by group or others.
+        :return: True if a cached token is being used, False otherwise
+        """
+        if self.tokenCacheFile is None or not os.access(self.tokenCacheFile, os.F_OK):
+            return False
+
+        EDClog.write("ECHOclient::loadCachedToken\n")
+        try:
+            if os.stat(self.tokenCacheFile).st_mode & 0o077:
+                EDClog.write("\t***WARNING: Ignoring token cache file {}, it is readable by others\n".format(
+                    self.tokenCacheFile))
+                return False
+            with open(self.tokenCacheFile, 'r') as fh:
+                cached = json.load(fh)
+        except (IOError, OSError, ValueError):
+            EDClog.write("\t***WARNING: Couldn't read token cache file {}\n".format(self.tokenCacheFile))
+            return False
+
+        # Leave a minute of slack so the token doesn't expire mid-run
+        if (cached.get('loginURL') != self.echoLoginURL or cached.get('user') != self.getLoginUser() or
+                cached.get('expires', 0) < time.time() + 60):
+            EDClog.write("\tCached token expired or not for this login, logging in\n")
+            return False
+
+        self.ECHO_TOKEN = cached['token']
+        EDClog.write("\tReusing cached ECHO token.\n")
+        return True
+
+    def saveCachedToken(self):
+        """
+        Save the current ECHO token, with its expiry time, to the token cache
+        file (owner read/write only)
+        """
+        cached = {'token': self.ECHO_TOKEN,
+                  'loginURL': self.echoLoginURL,
+                  'user': self.getLoginUser(),
+                  'expires': time.time() + self.tokenLifetime}
+        tmpName = "{}.{}.tmp".format(self.tokenCacheFile, os.getpid())
+        try:
+            fd = os.open(tmpName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(cached, fh)
+            os.rename(tmpName, self.tokenCacheFile)
+        except (IOError, OSError) as error:
+            EDClog.write("ECHOclient::saveCachedToken\n")
+            EDClog.write("\t***WARNING: Couldn't write token cache file {} ({})\n".format(self.tokenCacheFile, error))
+
+    def renewToken(self, staleToken):
+        """
+        Log in again after ECHO rejected 'staleToken'.  Several query threads
+        may see the same rejection, only the first one logs in.
+        """
+        with self.tokenLock:
+            if self.ECHO_TOKEN == staleToken:
+                EDClog.write("ECHOclient::renewToken\n")
+                EDClog.write("\tECHO token rejected, logging in again\n")
+                self.login()
+
+    def sendGet(self, queryURL, extraHeaders=None, stream=False):
+        """
+        GET 'queryURL' with the current ECHO token.  If ECHO rejects the token
+        (401) it is renewed and the request is made once more.  Request
+        exceptions are left to the caller.
+        """
+        token = self.ECHO_TOKEN
+        reqHeaders = {'Content-type': 'application/xml',
+                      'Echo-Token': token}
+        if extraHeaders:
+            reqHeaders.update(extraHeaders)
+
+        queryResponse = self.session.get(queryURL, headers=reqHeaders, timeout=self.timeouts, stream=stream)
+        if queryResponse.status_code == 401:
+            queryResponse.close()
+            self.renewToken(token)
+            reqHeaders['Echo-Token'] = self.ECHO_TOKEN
+            queryResponse = self.session.get(queryURL, headers=reqHeaders, timeout=self.timeouts, stream=stream)
+        return queryResponse
+
     def getProviders(self):
         """
         Get a list of data providers from ECHO and store provider ID (key)
         and organization name (value) in a dictionary
         """
         self.echoProviders = {}
-        reqHeaders = {'Content-type': 'application/xml',
-                      'Echo-Token': self.ECHO_TOKEN}
-        provRes = requests.get(self.echoProvURL, headers=reqHeaders)
+        try:
+            provRes = self.sendGet(self.echoProvURL)
+        except requests.exceptions.RequestException as error:
+            EDClog.write(">>>>Error: ECHOclient.getProviders : Request failed ({})".format(error))
+            return
+
         try:
             provRoot = ET.fromstring(provRes.content)
         except XMLSyntaxError:
@@ -872,12 +1874,46 @@ class ECHOclient(object):
             EDClog.write("{} : {} : {}".format(n, kw, self.echoProviders[kw]))
             n += 1
 
+    def cachedGet(self, kind, queryURL, responseFormat):
+        """
+        GET a query URL through the response cache (if enabled).  Fresh cache
+        entries are returned without contacting ECHO, stale entries are
+        revalidated with a conditional GET, and successful responses are
+        stored.  Request exceptions are left to the caller.
+        :param kind: Query kind, 'dataset' or 'granule' (selects the cache TTL)
+        :return: A 'requests' response, or an ECHOcachedResponse
+        """
+        if self.cache is None:
+            return self.sendGet(queryURL)
+
+        cacheEntry = self.cache.lookup(kind, queryURL, responseFormat)
+        if cacheEntry is not None and cacheEntry['fresh']:
+            body = self.cache.readBody(cacheEntry)
+            if body is not None:
+                return ECHOcachedResponse(body, cacheEntry['headers'])
+            cacheEntry = None
+
+        queryResponse = self.sendGet(queryURL, self.cache.conditionalHeaders(cacheEntry))
+        if queryResponse.status_code == 304 and cacheEntry is not None:
+            body = self.cache.readBody(cacheEntry, refresh=True)
+            if body is not None:
+                return ECHOcachedResponse(body, cacheEntry['headers'])
+            # The cached copy is gone, get the whole response after all
+            queryResponse = self.sendGet(queryURL)
+
+        if queryResponse.status_code == 200:
+            self.cache.store(kind, queryURL, responseFormat, queryResponse.content, queryResponse.headers)
+        return queryResponse
+
     def makeDatasetQuery(self, dsQueryStr, responseFormat):
         queryURL = self.echoCollectionURL + '.' + responseFormat + dsQueryStr
-        reqHeaders = {'Content-type': 'application/xml',
-                      'Echo-Token': self.ECHO_TOKEN}
 
-        queryResponse = requests.get(queryURL, headers=reqHeaders)
+        try:
+            queryResponse = self.cachedGet('dataset', queryURL, responseFormat)
+        except requests.exceptions.RequestException as error:
+            EDClog.write(">>>>Error: ECHOclient.makeDatasetQuery : Request failed ({})".format(error))
+            return ET.Element("results")
+
         try:
             respRoot = ET.fromstring(queryResponse.content)
         except XMLSyntaxError:
@@ -889,43 +1925,243 @@ class ECHOclient(object):
         return respRoot
 
     def makeGranuleQuery(self, echoDSid, boundingBoxStr, temporalStr, maxFiles, responseFormat):
+        """
+        Query all granules of a collection.  The first page of 'maxFiles'
+        results is requested, the 'echo-hits' header tells us how many pages
+        there are in total, and any remaining pages are then requested
+        concurrently (using up to 'pageWorkers' threads) and merged, in page
+        order, under the first page's results element.
+        """
         queryURL = self.echoGranuleURL + '.' + responseFormat
         queryURL += "?echo_collection_id[]=" + echoDSid + boundingBoxStr + temporalStr
-        queryURL += "&page_size=" + str(self.maxFiles)
-        reqHeaders = {'Content-type': 'application/xml',
-                      'Echo-Token': self.ECHO_TOKEN}
+        queryURL += "&page_size=" + str(maxFiles)
 
         # GET request.  Note the values stored in the 'headers' dictionary
         # are stored as strings!  This got me the first time when trying to
         # use 'hitsReceived'
-        queryResponse = requests.get(queryURL, headers=reqHeaders)
-        hitsReceived = int(queryResponse.headers['echo-hits'])
+        queryResponse = self.getGranulePage(queryURL, 1, responseFormat)
+        if queryResponse is None:
+            return ET.Element("results")
 
-        if (hitsReceived > maxFiles):
+        try:
+            hitsReceived = int(queryResponse.headers['echo-hits'])
+        except (KeyError, ValueError):
             EDClog.write("ECHOclient::makeGranuleQuery\n")
-            EDClog.write("\tYour query (" + queryURL + ")")
-            EDClog.write("\tgot " + str(
-                hitsReceived) + " hits, increase 'resultsize' via command line, or refine download request\n")
-            EDClog.write("\t<Note: forcing 0 collection results because of the volume of hits>\n")
+            EDClog.write("\t****Error: Missing or invalid 'echo-hits' header in granule query response\n")
+            return ET.Element("results")
+
+        respRoot = self.parseGranulePage(queryResponse)
+        numPages = int(math.ceil(hitsReceived / float(maxFiles)))
+        if numPages > 1:
+            EDClog.write("ECHOclient::makeGranuleQuery\n")
+            EDClog.write("\tQuery for collection {} got {} hits, retrieving {} pages of {}\n".format(
+                echoDSid, hitsReceived, numPages, maxFiles))
+
+            pageRoots = threadMap(lambda pageNum: self.parseGranulePage(
+                self.getGranulePage(queryURL, pageNum, responseFormat)),
+                                  range(2, numPages + 1), self.pageWorkers)
+            for pageRoot in pageRoots:
+                for result in pageRoot.findall('result'):
+                    respRoot.append(result)
+
+            if len(respRoot) < hitsReceived:
+                EDClog.write("ECHOclient::makeGranuleQuery\n")
+                EDClog.write("\t****WARNING: Only {} of {} granules retrieved for collection {}\n".format(
+                    len(respRoot), hitsReceived, echoDSid))
+
+        return respRoot
+
+    def getGranulePage(self, queryURL, pageNum, responseFormat):
+        """
+        :param queryURL: Granule query URL (including the page size)
+        :param pageNum: Page number to request (1 based)
+        :param responseFormat: Response format (for the cache key)
+        :return: The query response, None if the request failed
+        """
+        try:
+            queryResponse = self.cachedGet('granule', queryURL + "&page_num=" + str(pageNum), responseFormat)
+        except requests.exceptions.RequestException as error:
+            EDClog.write("ECHOclient::getGranulePage\n")
+            EDClog.write("\t****Error: Request for page {} failed ({})\n".format(pageNum, error))
+            return None
+
+        return queryResponse
+
+    def parseGranulePage(self, queryResponse):
+        """
+        :param queryResponse: A granule query response (or None)
+        :return: The results element root of the response.  In the event of a
+                 failure getting the full XML response, an empty response
+                 element root is returned
+        """
+        if queryResponse is None:
+            return ET.Element("results")
+
+        try:
+            respRoot = ET.fromstring(queryResponse.content)
+        except XMLSyntaxError:
+            EDClog.write("ECHOclient::parseGranulePage\n")
+            EDClog.write("\t****Error: XML Syntax Error on granule query response\n")
             respRoot = ET.Element("results")
+
+        return respRoot
+
+    def streamGranuleQuery(self, echoDSid, boundingBoxStr, temporalStr, maxFiles, responseFormat, makeGranule):
+        """
+        Streaming version of 'makeGranuleQuery'.  Rather than building a tree
+        for each page of results, every granule 'result' element is parsed
+        straight off the socket, handed to 'makeGranule' and then discarded,
+        so memory use doesn't grow with the size of the response and parsing
+        overlaps the network transfer.
+        :param makeGranule: Callable turning a 'result' element into a granule object
+        :return: List of granule objects, in page order
+        """
+        queryURL = self.echoGranuleURL + '.' + responseFormat
+        queryURL += "?echo_collection_id[]=" + echoDSid + boundingBoxStr + temporalStr
+        queryURL += "&page_size=" + str(maxFiles)
+
+        hitsReceived, granules = self.streamGranulePage(queryURL, 1, responseFormat, makeGranule)
+        if hitsReceived is None:
+            return granules
+
+        numPages = int(math.ceil(hitsReceived / float(maxFiles)))
+        if numPages > 1:
+            EDClog.write("ECHOclient::streamGranuleQuery\n")
+            EDClog.write("\tQuery for collection {} got {} hits, streaming {} pages of {}\n".format(
+                echoDSid, hitsReceived, numPages, maxFiles))
+
+            pages = threadMap(lambda pageNum: self.streamGranulePage(
+                queryURL, pageNum, responseFormat, makeGranule)[1], range(2, numPages + 1), self.pageWorkers)
+            for pageGranules in pages:
+                granules.extend(pageGranules)
+
+            if len(granules) < hitsReceived:
+                EDClog.write("ECHOclient::streamGranuleQuery\n")
+                EDClog.write("\t****WARNING: Only {} of {} granules retrieved for collection {}\n".format(
+                    len(granules), hitsReceived, echoDSid))
+
+        return granules
+
+    def streamGranulePage(self, queryURL, pageNum, responseFormat, makeGranule):
+        """
+        :param queryURL: Granule query URL (including the page size)
+        :param pageNum: Page number to request (1 based)
+        :param responseFormat: Response format (for the cache key)
+        :param makeGranule: Callable turning a 'result' element into a granule object
+        :return: ('echo-hits' value or None on failure, list of granule objects)
+        """
+        granules = []
+        pageURL = queryURL + "&page_num=" + str(pageNum)
+        queryResponse = None
+        cacheEntry = None
+        cacheFH = None
+        source = None
+        if self.cache is not None:
+            cacheEntry = self.cache.lookup('granule', pageURL, responseFormat)
+            if cacheEntry is not None and cacheEntry['fresh']:
+                source = self.cache.openBody(cacheEntry)
+                if source is None:
+                    cacheEntry = None
+
+        if source is None:
+            condHeaders = None
+            if self.cache is not None:
+                condHeaders = self.cache.conditionalHeaders(cacheEntry)
+            try:
+                queryResponse = self.sendGet(pageURL, condHeaders, stream=True)
+                if queryResponse.status_code == 304 and cacheEntry is not None:
+                    queryResponse.close()
+                    queryResponse = None
+                    source = self.cache.openBody(cacheEntry, refresh=True)
+                    if source is None:
+                        # The cached copy is gone, get the whole page after all
+                        queryResponse = self.sendGet(pageURL, stream=True)
+            except requests.exceptions.RequestException as error:
+                EDClog.write("ECHOclient::streamGranulePage\n")
+                EDClog.write("\t****Error: Request for page {} failed ({})\n".format(pageNum, error))
+                return (None, granules)
+
+        if queryResponse is None:
+            # Parse the cached copy of the page
+            respHeaders = cacheEntry['headers']
         else:
+            respHeaders = queryResponse.headers
+            # Let urllib3 undo any gzip/deflate content encoding as lxml reads
+            queryResponse.raw.decode_content = True
+            source = queryResponse.raw
+            if self.cache is not None and queryResponse.status_code == 200:
+                # Copy the page into the cache while it is being parsed
+                try:
+                    cacheFH, cacheTmp = self.cache.newTempFile()
+                except (IOError, OSError) as error:
+                    EDClog.write("ECHOclient::streamGranulePage\n")
+                    EDClog.write("\t***WARNING: Not caching page {} ({})\n".format(pageNum, error))
+                else:
+                    source = ECHOteeReader(source, cacheFH)
+
+        complete = False
+        try:
             try:
-                respRoot = ET.fromstring(queryResponse.content)
-            except XMLSyntaxError:
-                EDClog.write("ECHOclient::makeGranuleQuery\n")
-                EDClog.write("\t****Error: XML Syntax Error on granule query response")
-                # In the event of a failure getting the full XML response, create an empty response element root
-                # to pass back to the caller
-                respRoot = ET.Element("results")
+                hitsReceived = int(respHeaders['echo-hits'])
+            except (KeyError, ValueError):
+                EDClog.write("ECHOclient::streamGranulePage\n")
+                EDClog.write("\t****Error: Missing or invalid 'echo-hits' header in granule query response\n")
+                return (None, granules)
 
-        return respRoot
+            try:
+                for event, result in ET.iterparse(source, events=('end',), tag='result'):
+                    granules.append(makeGranule(result))
+                    # Release the consumed element, and any already consumed
+                    # siblings still hanging off the results root
+                    result.clear()
+                    while result.getprevious() is not None:
+                        del result.getparent()[0]
+            except (XMLSyntaxError, requests.exceptions.RequestException, urllib3HTTPError, IOError,
+                    OSError) as error:
+                # A dropped connection surfaces from the raw stream as a urllib3
+                # error (ReadTimeoutError, ProtocolError), a full disk while
+                # copying to the cache as an IOError.  Either way the page is incomplete.
+                EDClog.write("ECHOclient::streamGranulePage\n")
+                EDClog.write("\t****Error: Streaming page {} failed after {} granules ({})\n".format(
+                    pageNum, len(granules), error))
+            else:
+                complete = True
+        finally:
+            if queryResponse is None:
+                source.close()
+            else:
+                queryResponse.close()
+            if cacheFH is not None:
+                cacheFH.close()
+                if complete:
+                    self.cache.storeFile('granule', pageURL, responseFormat, cacheTmp, respHeaders)
+                else:
+                    self.cache.discardFile(cacheTmp)
+
+        return (hitsReceived, granules)
 
     def logout(self):
 
         tokenURL = self.echoLoginURL + '/' + self.ECHO_TOKEN
-        logoutResp = requests.delete(tokenURL)
         EDClog.write("ECHOclient::logout\n")
-        EDClog.write("\t***ECHO logout (status: " + str(logoutResp.status_code) + ")\n")
+        if self.tokenCacheFile is not None:
+            # The token is kept for reuse by the next run
+            EDClog.write("\t***ECHO token cached in {}, skipping logout\n".format(self.tokenCacheFile))
+        else:
+            try:
+                logoutResp = self.session.delete(tokenURL, timeout=self.timeouts)
+            except requests.exceptions.RequestException as error:
+                EDClog.write("\t***WARNING: ECHO logout failed ({})\n".format(error))
+            else:
+                EDClog.write("\t***ECHO logout (status: " + str(logoutResp.status_code) + ")\n")
+
+        numRequests, numConnections, numReused = self.getConnStats()
+        EDClog.write("\t{} ECHO requests over {} connections ({} connection reuses)\n".format(
+            numRequests, numConnections, numReused))
+        self.session.close()
+
+        if self.cache is not None:
+            self.cache.prune()
 
 
 class ECHOcollection(object):
@@ -960,105 +2196,128 @@ class ECHOcollection(object):
 
     def getGranules(self,
                     geRoot):
-        self.granRoot = geRoot
-        self.numGranules = len(self.granRoot)
-        if (self.numGranules > 0):
-            for granule in self.granRoot.findall('result'):
-                polyPoints = []  # list of polypoint tuples
-                accessURLs = []
-                w_bound = -180.0
-                e_bound = 180.0
-                s_bound = -90.0
-                n_bound = 90.0
-
-                egid = granule.get("echo_granule_id")
+        """
+        :param geRoot: Granule query response root
+        Create a granule object for each granule query result and store it in
+        'granContainer'.  The response tree is not kept.
+        """
+        for granule in geRoot.findall('result'):
+            # Create a new granule object and store in 'granContainer'
+            self.granContainer.append(self.makeGranule(granule))
+        self.numGranules = len(self.granContainer)
 
-                spatialGeometry = granule.find('Granule').find('Spatial').find(
-                    'HorizontalSpatialDomain').find('Geometry')
+    def addGranules(self, granules):
+        """
+        :param granules: List of granule objects (built with 'makeGranule')
+        """
+        self.granContainer.extend(granules)
+        self.numGranules = len(self.granContainer)
 
-                if spatialGeometry is None:
-                    # No spatial geometry information, which means it's orbit
-                    # information.  For now, just store global extent in the
-                    # boundary fields (default initialization above)
-                    HasPolyPoints = 0
+    def makeGranule(self, granule):
+        """
+        :param granule: A granule query 'result' element (ECHO10 format)
+        :return: A new granule object
+        """
+        polyPoints = []  # list of polypoint tuples
+        accessURLs = []
+        w_bound = -180.0
+        e_bound = 180.0
+        s_bound = -90.0
+        n_bound = 90.0
+
+        egid = granule.get("echo_granule_id")
+
+        spatialGeometry = granule.find('Granule').find('Spatial').find(
+            'HorizontalSpatialDomain').find('Geometry')
+
+        if spatialGeometry is None:
+            # No spatial geometry information, which means it's orbit
+            # information.  For now, just store global extent in the
+            # boundary fields (default initialization above)
+            HasPolyPoints = 0
+        else:
+            boundingRect = spatialGeometry.find('BoundingRectangle')
+            if boundingRect is None:
+                boundaryPoints = spatialGeometry.find('GPolygon').find('Boundary')
+                if boundaryPoints is None:
+                    EDClog.write("ECHOcollection::getGranules\n")
+                    EDClog.write(
+                        "\t***FATAL ERROR: Missing bounding rectangle or Polygon points for granule {}\n".format(
+                            egid))
+                    raise SystemExit
                 else:
-                    boundingRect = spatialGeometry.find('BoundingRectangle')
-                    if boundingRect is None:
-                        boundaryPoints = spatialGeometry.find('GPolygon').find('Boundary')
-                        if boundaryPoints is None:
-                            EDClog.write("ECHOcollection::getGranules\n")
-                            EDClog.write(
-                                "\t***FATAL ERROR: Missing bounding rectangle or Polygon points for granule {}\n".format(
-                                    egid))
-                            raise SystemExit
-                        else:
-                            HasPolyPoints = 1
-                            for point in boundaryPoints.findall('Point'):
-                                pt_longitude = float(point.find('PointLongitude').text)
-                                pt_latitude = float(point.find('PointLatitude').text)
-                                polyPoints.append((pt_latitude, pt_longitude))
-                    else:
-                        HasPolyPoints = 0
-                        w_bound = float(boundingRect.find('WestBoundingCoordinate').text)
-                        s_bound = float(boundingRect.find('SouthBoundingCoordinate').text)
-                        e_bound = float(boundingRect.find('EastBoundingCoordinate').text)
-                        n_bound = float(boundingRect.find('NorthBoundingCoordinate').text)
+                    HasPolyPoints = 1
+                    for point in boundaryPoints.findall('Point'):
+                        pt_longitude = float(point.find('PointLongitude').text)
+                        pt_latitude = float(point.find('PointLatitude').text)
+                        polyPoints.append((pt_latitude, pt_longitude))
+            else:
+                HasPolyPoints = 0
+                w_bound = float(boundingRect.find('WestBoundingCoordinate').text)
+                s_bound = float(boundingRect.find('SouthBoundingCoordinate').text)
+                e_bound = float(boundingRect.find('EastBoundingCoordinate').text)
+                n_bound = float(boundingRect.find('NorthBoundingCoordinate').text)
 
-                try:
-                    granuleUR = granule.find('Granule').find('GranuleUR').text
-                except AttributeError:
-                    granuleUR = "NoGranuleUR"
+        try:
+            granuleUR = granule.find('Granule').find('GranuleUR').text
+        except AttributeError:
+            granuleUR = "NoGranuleUR"
 
-                try:
-                    granuleSizeMB = float(granule.find('Granule').find('DataGranule').find('SizeMBDataGranule').text)
-                except AttributeError:
-                    granuleSizeMB = -0.0
+        try:
+            granuleSizeMB = float(granule.find('Granule').find('DataGranule').find('SizeMBDataGranule').text)
+        except AttributeError:
+            granuleSizeMB = -0.0
 
-                try:
-                    begDateTime = granule.find('Granule').find('Temporal').find('RangeDateTime').find(
-                        'BeginningDateTime').text
-                except AttributeError:
-                    begDateTime = "null"
-                    EDClog.write("ECHOcollection:getGranules\n")
-                    EDClog.write("\tWARNING: No Beginning DateTime for Granule {}".format(egid))
-                else:
-                    # Remove trailing 'Z' from datetime object
-                    begDateTime = resub('[Z]', '', begDateTime)
+        try:
+            checksumElem = granule.find('Granule').find('DataGranule').find('Checksum')
+            checksum = (checksumElem.find('Algorithm').text, checksumElem.find('Value').text)
+        except AttributeError:
+            checksum = None
 
-                try:
-                    endDateTime = granule.find('Granule').find('Temporal').find('RangeDateTime').find(
-                        'EndingDateTime').text
-                except AttributeError:
-                    endDateTime = "null"
-                    EDClog.write("ECHOcollection:getGranules\n")
-                    EDClog.write("\tWARNING: No Ending DateTime for Granule {}".format(egid))
-                else:
-                    # Remove trailing 'Z' from datetime object
-                    endDateTime = resub('[Z]', '', endDateTime)
+        try:
+            begDateTime = granule.find('Granule').find('Temporal').find('RangeDateTime').find(
+                'BeginningDateTime').text
+        except AttributeError:
+            begDateTime = "null"
+            EDClog.write("ECHOcollection:getGranules\n")
+            EDClog.write("\tWARNING: No Beginning DateTime for Granule {}".format(egid))
+        else:
+            # Remove trailing 'Z' from datetime object
+            begDateTime = resub('[Z]', '', begDateTime)
 
-                for child in granule.find('Granule').find('OnlineAccessURLs').iterchildren():
-                    try:
-                        # Find the URL part of the child, if it exists
-                        thisurl = child.find('URL').text
-                    except AttributeError:
-                        thisurl = "Unknown URL"
+        try:
+            endDateTime = granule.find('Granule').find('Temporal').find('RangeDateTime').find(
+                'EndingDateTime').text
+        except AttributeError:
+            endDateTime = "null"
+            EDClog.write("ECHOcollection:getGranules\n")
+            EDClog.write("\tWARNING: No Ending DateTime for Granule {}".format(egid))
+        else:
+            # Remove trailing 'Z' from datetime object
+            endDateTime = resub('[Z]', '', endDateTime)
 
-                    try:
-                        # Find the Mimetype part of the child, if it exists
-                        thismt = child.find('MimeType').text
-                    except:
-                        thismt = "Unknown MimeType"
-
-                    t = (thisurl, thismt)
-                    accessURLs.append(t)
-
-                # Create a new granule object and store in 'granContainer'.  The
-                # last parameter is the number of download trys.  This was added
-                # to keep track of pending downloads that keep failing
-                self.granContainer.append(
-                    ECHOgranule(egid, granuleUR, granuleSizeMB,
-                                begDateTime, endDateTime, HasPolyPoints, polyPoints,
-                                w_bound, s_bound, e_bound, n_bound, accessURLs, "", 1))
+        for child in granule.find('Granule').find('OnlineAccessURLs').iterchildren():
+            try:
+                # Find the URL part of the child, if it exists
+                thisurl = child.find('URL').text
+            except AttributeError:
+                thisurl = "Unknown URL"
+
+            try:
+                # Find the Mimetype part of the child, if it exists
+                thismt = child.find('MimeType').text
+            except:
+                thismt = "Unknown MimeType"
+
+            t = (thisurl, thismt)
+            accessURLs.append(t)
+
+        # Create a new granule object.  The last parameter is the number of
+        # download trys.  This was added to keep track of pending downloads
+        # that keep failing
+        return ECHOgranule(egid, granuleUR, granuleSizeMB,
+                           begDateTime, endDateTime, HasPolyPoints, polyPoints,
+                           w_bound, s_bound, e_bound, n_bound, accessURLs, "", 1, checksum)
 
     def getNumGranules(self):
         return len(self.granContainer)
@@ -1110,10 +2369,12 @@ class ECHOcollection(object):
 class ECHOgranule(object):
     def __init__(self,
                  gid, ur, sizeMB, bdt, edt, ppflag, ppts,
-                 wbnd, sbnd, ebnd, nbnd, aurls, lfn, dltrys):
+                 wbnd, sbnd, ebnd, nbnd, aurls, lfn, dltrys, cksum=None):
 
         # 'accessURLs' is a  list of tuples of the form:
         # (URL, MimeType)
+        # 'checksum' is the granule metadata checksum, if any, as an
+        # (Algorithm, Value) tuple
 
         self.egid = gid
         self.granuleUR = ur
@@ -1129,6 +2390,8 @@ class ECHOgranule(object):
         self.localFileName = lfn
         self.accessURLs = aurls
         self.numDloadTrys = dltrys
+        self.checksum = cksum
+        self.digest = None  # "<algorithm>:<hex digest>" of the downloaded file
         self.dbInsertFailed = False
 
         for lat, lon in ppts:
@@ -1150,6 +2413,7 @@ class ECHOgranule(object):
         #  1==downloaded ok (a download was successful)
         # -1==download failed (a download for this granule failed)
         # -2==collection or granule directory make failed
+        # -3==not downloaded (the granule is quarantined, see 'quarantineDwnld.xml')
 
         self.downloadStatus = 0
 
@@ -1227,6 +2491,15 @@ class ECHOgranule(object):
     def setnumtrys(self, nt):
         self.numDloadTrys = nt
 
+    def getChecksum(self):
+        return self.checksum
+
+    def setDigest(self, digest):
+        self.digest = digest
+
+    def getDigest(self):
+        return self.digest
+
     def getnumtrys(self):
         return self.numDloadTrys
 
@@ -1246,32 +2519,992 @@ class ECHOpolypoint(object):
         self.longitude = lon
         self.dbInsertFailed = False
 
-    def getLatitude(self):
-        return self.latitude
+    def getLatitude(self):
+        return self.latitude
+
+    def getLongitude(self):
+        return self.longitude
+
+    def setInsertFailed(self, statFlag):
+        self.dbInsertFailed = statFlag
+
+    def getInsertFailed(self):
+        return self.dbInsertFailed
+
+
+class ECHOdownloadQueue(object):
+    """
+    Download queue of (egid, url, filename) tuples, or (egid, url, filename,
+    segment index) for the segments of a large granule, grouped by the host of
+    the URL.  'get' hands out queued granules round-robin across hosts, and
+    never lets a host have more than 'hostCap' transfers in flight, so one
+    slow archive server can't tie up all of the download connections.
+    Granules from the same host are handed out in the order they were put.
+    Granules put back with 'retry' are held until their retry time.
+    """
+
+    def __init__(self, items, hostCap):
+        self.hostCap = hostCap
+        self.hostQueues = {}  # host: deque of (egid, url, filename) tuples
+        self.hosts = deque()  # hosts with queued granules, in round-robin order
+        self.inFlight = {}  # host: number of transfers in progress
+        self.numQueued = 0
+        self.delayed = []  # heap of (retry time, sequence number, item) tuples
+        self.delaySeq = 0
+        for item in items:
+            self.put(item)
+
+    def __len__(self):
+        return self.numQueued + len(self.delayed)
+
+    def hostOf(self, url):
+        return urlparse(url).netloc.lower()
+
+    def put(self, item):
+        host = self.hostOf(item[1])
+        if host not in self.hostQueues:
+            self.hostQueues[host] = deque()
+            self.inFlight.setdefault(host, 0)
+        if not self.hostQueues[host]:
+            self.hosts.append(host)
+        self.hostQueues[host].append(item)
+        self.numQueued += 1
+
+    def get(self):
+        """
+        :return: The next (egid, url, filename) tuple from the next host (in
+                 round-robin order) that is below its in-flight cap, None if
+                 every host with queued granules is at its cap
+        """
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            self.put(heapq.heappop(self.delayed)[2])
+
+        for i in range(len(self.hosts)):
+            host = self.hosts[0]
+            self.hosts.rotate(-1)
+            if self.inFlight[host] < self.hostCap:
+                item = self.hostQueues[host].popleft()
+                if not self.hostQueues[host]:
+                    # rotate(-1) moved this host to the end of the rotation
+                    self.hosts.pop()
+                self.inFlight[host] += 1
+                self.numQueued -= 1
+                return item
+        return None
+
+    def done(self, url):
+        """
+        A transfer handed out by 'get' (or announced with 'started') for 'url' has finished
+        """
+        self.inFlight[self.hostOf(url)] -= 1
+
+    def hasRoom(self, url):
+        """
+        :return: True if the host of 'url' is below its in-flight cap
+        """
+        return self.inFlight.get(self.hostOf(url), 0) < self.hostCap
+
+    def started(self, url):
+        """
+        A transfer for 'url' that did not come from 'get' (a mirror race) has started
+        """
+        host = self.hostOf(url)
+        self.inFlight[host] = self.inFlight.get(host, 0) + 1
+
+    def retry(self, item, delay):
+        """
+        Queue 'item' again, to be handed out no sooner than 'delay' seconds from now
+        """
+        self.delaySeq += 1
+        heapq.heappush(self.delayed, (time.time() + delay, self.delaySeq, item))
+
+    def waitTime(self):
+        """
+        :return: Seconds until the next retry is due, None if there are no retries
+        """
+        if not self.delayed:
+            return None
+        return max(0.0, self.delayed[0][0] - time.time())
+
+
+class ECHOconcurrency(object):
+    """
+    Adaptive controller for the number of concurrent downloads.  Every
+    'interval' seconds the aggregate download throughput and the transfer
+    error rate of the last interval are measured and the target number of
+    concurrent transfers is adjusted (hill climbing):
+
+      - error rate above 'maxErrorRate': back off by a quarter
+      - throughput up by more than 'tolerance': keep moving in the same direction
+      - throughput down by more than 'tolerance': reverse direction
+      - otherwise: hold
+
+    The target always stays within [minConns, maxConns].
+    """
+
+    interval = 10.0  # seconds between decisions
+    tolerance = 0.05  # relative throughput change that counts as a change
+    maxErrorRate = 0.2  # fraction of failed transfers that forces a back off
+
+    def __init__(self, minConns, maxConns, startConns=10):
+        self.minConns = minConns
+        self.maxConns = maxConns
+        self.target = max(minConns, min(startConns, maxConns))
+        self.direction = 1
+        self.lastTime = time.time()
+        self.lastBytes = 0
+        self.lastDone = 0
+        self.lastFailed = 0
+        self.lastThroughput = None
+
+    def getTarget(self):
+        return self.target
+
+    def update(self, totalBytes, numDone, numFailed, backlog):
+        """
+        :param totalBytes: Total bytes downloaded so far (all transfers)
+        :param numDone: Number of finished transfers so far
+        :param numFailed: Number of failed transfers so far
+        :param backlog: True if transfers are still waiting to be started
+        """
+        now = time.time()
+        elapsed = now - self.lastTime
+        if elapsed < self.interval:
+            return
+
+        throughput = (totalBytes - self.lastBytes) / elapsed
+        numFinished = numDone - self.lastDone
+        errorRate = 0.0
+        if numFinished > 0:
+            errorRate = (numFailed - self.lastFailed) / float(numFinished)
+
+        previous = self.target
+        if not backlog:
+            # Nothing waiting, more connections wouldn't be used anyway
+            reason = "no queued transfers, holding"
+        elif errorRate > self.maxErrorRate:
+            self.direction = -1
+            self.target -= max(1, self.target // 4)
+            reason = "error rate {:.0%}, backing off".format(errorRate)
+        elif self.lastThroughput is None:
+            self.target += self.direction
+            reason = "first measurement, probing"
+        elif throughput > self.lastThroughput * (1.0 + self.tolerance):
+            self.target += self.direction
+            reason = "throughput up, continuing"
+        elif throughput < self.lastThroughput * (1.0 - self.tolerance):
+            self.direction = -self.direction
+            self.target += self.direction
+            reason = "throughput down, reversing"
+        else:
+            reason = "throughput flat, holding"
+
+        # Stay within bounds, and turn around at them
+        if self.target >= self.maxConns:
+            self.target = self.maxConns
+            self.direction = -1
+        elif self.target <= self.minConns:
+            self.target = self.minConns
+            self.direction = 1
+
+        EDClog.write("ECHOconcurrency::update\n")
+        EDClog.write("\t{:.1f} KB/s, error rate {:.0%}, connections {} -> {} ({})\n".format(
+            throughput / 1024.0, errorRate, previous, self.target, reason))
+
+        self.lastTime = now
+        self.lastBytes = totalBytes
+        self.lastDone = numDone
+        self.lastFailed = numFailed
+        if backlog:
+            self.lastThroughput = throughput
+
+
+class ECHObandwidth(object):
+    """
+    Aggregate download rate limit of all transfers, with separate day and
+    night values (0 means unlimited).  The current limit is shared evenly
+    between the running transfers (see ECHOdownloader.limitRate), and
+    libcurl paces each transfer to its share (MAX_RECV_SPEED_LARGE).
+    """
+
+    def __init__(self, dayRateKB, nightRateKB, nightHours):
+        """
+        :param dayRateKB: Day time rate limit in KB/s, 0 for no limit
+        :param nightRateKB: Night time rate limit in KB/s, 0 for no limit
+        :param nightHours: Night time as a "start-end" hour string, e.g. "20-6"
+        """
+        self.dayRate = dayRateKB * 1024.0
+        self.nightRate = nightRateKB * 1024.0
+        try:
+            self.nightStart, self.nightEnd = [int(h) for h in nightHours.split('-')]
+            if not (0 <= self.nightStart <= 23 and 0 <= self.nightEnd <= 23):
+                raise ValueError
+        except ValueError:
+            EDClog.write("ECHObandwidth::__init__\n")
+            EDClog.write("\t****ERROR: Invalid night hours '{}', use 'start-end' (e.g. 20-6)\n".format(nightHours))
+            raise SystemExit
+        if self.dayRate < 0 or self.nightRate < 0:
+            EDClog.write("ECHObandwidth::__init__\n")
+            EDClog.write("\t****ERROR: Rate limits can't be negative\n")
+            raise SystemExit
+
+    def isNight(self, hour):
+        if self.nightStart <= self.nightEnd:
+            return self.nightStart <= hour < self.nightEnd
+        return hour >= self.nightStart or hour < self.nightEnd
+
+    def currentRate(self):
+        """
+        :return: The rate limit in bytes/s for the current local time, 0 if unlimited
+        """
+        if self.isNight(time.localtime().tm_hour):
+            return self.nightRate
+        return self.dayRate
+
+    def perTransfer(self, numTransfers):
+        """
+        :return: The rate limit in bytes/s of each of 'numTransfers' concurrent
+                 transfers, 0 if unlimited
+        """
+        rate = self.currentRate()
+        if rate <= 0 or numTransfers < 1:
+            return 0
+        return max(1, int(rate / numTransfers))
+
+
+class ECHOhostStats(object):
+    """
+    Recent download throughput of each archive host: an exponentially
+    weighted moving average of the throughput of its finished transfers,
+    halved by every failed one.  Kept across runs in a small JSON file,
+    and used to choose between the mirrors (access URLs) of a granule.
+    """
+
+    alpha = 0.3  # weight of the newest transfer in the moving average
+    failurePenalty = 0.5
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.hosts = {}  # host: throughput in bytes/s
+        if os.access(self.filename, os.F_OK):
+            try:
+                with open(self.filename, 'r') as fh:
+                    self.hosts = dict((host, float(bps)) for host, bps in json.load(fh).items())
+            except (IOError, ValueError, TypeError, AttributeError):
+                EDClog.write("ECHOhostStats::__init__\n")
+                EDClog.write("\t***WARNING: Ignoring unreadable host statistics file ({})\n".format(
+                    self.filename))
+                self.hosts = {}
+
+    def hostOf(self, url):
+        return urlparse(url).netloc.lower()
+
+    def record(self, url, numBytes, seconds, ok):
+        """
+        :param ok: True if the transfer succeeded
+        """
+        host = self.hostOf(url)
+        if not ok:
+            self.hosts[host] = self.hosts.get(host, 0.0) * self.failurePenalty
+        elif seconds > 0:
+            bps = numBytes / seconds
+            if host in self.hosts:
+                bps = self.alpha * bps + (1.0 - self.alpha) * self.hosts[host]
+            self.hosts[host] = bps
+
+    def rank(self, urls):
+        """
+        :return: 'urls' ordered from the host with the best recent throughput
+                 down.  Hosts without history rank with the best known host,
+                 so they get tried, and ties keep the given order.
+        """
+        best = max(self.hosts.values()) if self.hosts else 0.0
+        return sorted(urls, key=lambda url: -self.hosts.get(self.hostOf(url), best))
+
+    def save(self):
+        try:
+            with open(self.filename, 'w') as fh:
+                json.dump(self.hosts, fh, indent=1, sort_keys=True)
+        except IOError:
+            EDClog.write("ECHOhostStats::save\n")
+            EDClog.write("\t***WARNING: Could not write host statistics file ({})\n".format(self.filename))
+
+
+class ECHOrace(object):
+    """
+    Two transfers of the same granule from different mirrors.  The first
+    one to receive data wins, the other one is aborted.
+    """
+
+    def __init__(self):
+        self.winner = None  # the winning ECHOtransfer
+        self.running = 2
+
+    def lost(self, t):
+        return self.winner is not None and self.winner is not t
+
+
+class ECHOgranuleFile(object):
+    """
+    Size and checksum verification of a downloaded granule file.  The size
+    ('size', in bytes) is checked against the granule metadata size
+    (SizeMBDataGranule) and the digest of 'hasher' against the metadata
+    checksum, if the granule has one.
+    """
+
+    # Relative size difference still accepted, SizeMBDataGranule is rounded
+    # and providers differ on whether a MB is 10^6 or 2^20 bytes
+    sizeTolerance = 0.01
+
+    def __init__(self, egid, filename, sizeMB=-0.0, checksum=None):
+        """
+        :param sizeMB: Expected size in MegaBytes (<= 0 if unknown)
+        :param checksum: Expected (Algorithm, Value) checksum, None if unknown
+        """
+        self.egid = egid
+        self.filename = filename
+        self.size = 0
+        self.expectedSizeMB = sizeMB
+        self.expectedDigest = None
+        self.digest = None
+        self.hashName = 'md5'
+        if checksum is not None and checksum[0] and checksum[1]:
+            hashName = checksum[0].lower().replace('-', '')
+            try:
+                hashlib.new(hashName)
+            except ValueError:
+                EDClog.write("ECHOgranuleFile::__init__\n")
+                EDClog.write("\t***WARNING: Unsupported checksum algorithm {} for granule {}\n".format(
+                    checksum[0], egid))
+            else:
+                self.hashName = hashName
+                self.expectedDigest = checksum[1].strip().lower()
+        self.hasher = hashlib.new(self.hashName)
+
+    def verify(self):
+        """
+        Check the downloaded size and digest against the granule metadata
+        :return: True if the file matches (or there is nothing to check against)
+        """
+        self.digest = self.hashName + ':' + self.hasher.hexdigest()
+
+        if self.expectedSizeMB > 0.0:
+            tolerance = max(self.expectedSizeMB * self.sizeTolerance, 0.01)
+            if (abs(self.size / math.pow(1024, 2) - self.expectedSizeMB) > tolerance and
+                    abs(self.size / 1.0e6 - self.expectedSizeMB) > tolerance):
+                EDClog.write("ECHOgranuleFile::verify\n")
+                EDClog.write("\t****ERROR: Granule {} size mismatch, got {} bytes, expected {} MB\n".format(
+                    self.egid, self.size, self.expectedSizeMB))
+                return False
+
+        if self.expectedDigest is not None and self.hasher.hexdigest() != self.expectedDigest:
+            EDClog.write("ECHOgranuleFile::verify\n")
+            EDClog.write("\t****ERROR: Granule {} {} checksum mismatch, got {}, expected {}\n".format(
+                self.egid, self.hashName, self.hasher.hexdigest(), self.expectedDigest))
+            return False
+
+        return True
+
+
+class ECHOtransfer(ECHOgranuleFile):
+    """
+    Download of one granule file on a curl object.  Data is written to
+    '<filename>.part', resuming (with an HTTP Range request) from the end of
+    any partial file left by an earlier failed attempt.  If the server won't
+    resume it, the partial file is discarded and the download starts over
+    (see ECHOdownloader.resumeRejected).  The partial file is renamed to
+    'filename' only once the transfer has completed.
+
+    A transfer racing another mirror (see ECHOrace) aborts itself as soon
+    as the other one has received data.
+
+    The data is hashed as it is written, so the file never has to be read
+    back before it is verified.
+    """
+
+    def __init__(self, c, egid, url, filename, sizeMB=-0.0, checksum=None, race=None, partname=None):
+        """
+        :param race: ECHOrace this transfer is part of, None if it isn't racing
+        :param partname: Partial file name, '<filename>.part' if None
+        """
+        ECHOgranuleFile.__init__(self, egid, filename, sizeMB, checksum)
+        self.curl = c
+        self.race = race
+        self.url = url
+        self.partname = partname or filename + '.part'
+
+        self.offset = 0
+        if os.access(self.partname, os.F_OK):
+            self.offset = os.path.getsize(self.partname)
+            # Bytes from the earlier attempt have to go into the digest too
+            with open(self.partname, 'rb') as fh:
+                for block in iter(lambda: fh.read(1048576), b''):
+                    self.hasher.update(block)
+        self.size = self.offset
+        self.writeTime = 0.0  # seconds spent writing the data to disk
+        self.fp = open(self.partname, 'ab')
+
+        c.setopt(pycurl.URL, url)
+        c.setopt(pycurl.WRITEFUNCTION, self.write)
+        # Always set, curl objects are reused for several transfers
+        c.setopt(pycurl.RESUME_FROM_LARGE, self.offset)
+        c.unsetopt(pycurl.RANGE)
+        # The progress callback (called at least once a second) stops a racing
+        # transfer that hasn't received any data when the other one wins
+        c.setopt(pycurl.NOPROGRESS, 0 if race is not None else 1)
+        if race is not None:
+            c.setopt(getattr(pycurl, 'XFERINFOFUNCTION', pycurl.PROGRESSFUNCTION), self.progress)
+        if self.offset > 0:
+            EDClog.write("\tResuming {} at byte {}\n".format(egid, self.offset))
+
+    def progress(self, *args):
+        # Non-zero aborts the transfer
+        return 1 if self.race.lost(self) else 0
+
+    def write(self, data):
+        if self.race is not None:
+            if self.race.winner is None:
+                self.race.winner = self
+                EDClog.write("\t{} won the mirror race for {}\n".format(urlparse(self.url).netloc, self.egid))
+            elif self.race.winner is not self:
+                # The other mirror won, a short write aborts this transfer
+                return 0
+        writeStart = time.time()
+        self.fp.write(data)
+        self.writeTime += time.time() - writeStart
+        self.hasher.update(data)
+        self.size += len(data)
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.close()
+
+    def complete(self):
+        """
+        Verify the completed download and move it into place.  A download
+        that fails verification is discarded, resuming it would be pointless.
+        :return: True on success, False if verification or the rename failed
+        """
+        self.close()
+        if not self.verify():
+            self.discard()
+            return False
+
+        try:
+            os.rename(self.partname, self.filename)
+        except OSError:
+            EDClog.write("ECHOtransfer::complete\n")
+            EDClog.write("\t****ERROR: Couldn't rename {} to {}\n".format(self.partname, self.filename))
+            return False
+        return True
+
+    def discard(self):
+        """
+        Remove the partial file, the next attempt starts from byte zero
+        """
+        self.close()
+        try:
+            os.remove(self.partname)
+        except OSError:
+            pass
+
+
+class ECHOsegmentedFile(ECHOgranuleFile):
+    """
+    A large granule downloaded as byte range segments (see
+    ECHOsegmentTransfer), concurrently, into the preallocated partial file
+    '<filename>.seg.part'.  The segments done are kept in '<filename>.seg.json'
+    so a later run only fetches the missing ones.  Segments arrive out of
+    order, so the file is hashed once all of them are in.
+    """
+
+    def __init__(self, egid, url, filename, size, segmentSize, sizeMB=-0.0, checksum=None):
+        """
+        :param url: URL the size (and range support) was probed on, all
+                    segments are downloaded from it
+        :param size: Exact file size in bytes
+        :param segmentSize: Segment size in bytes
+        :raises: IOError/OSError if the partial file can't be preallocated
+        """
+        ECHOgranuleFile.__init__(self, egid, filename, sizeMB, checksum)
+        self.url = url
+        self.partname = filename + '.seg.part'
+        self.statename = filename + '.seg.json'
+        self.fileSize = size
+        self.segmentSize = segmentSize
+        self.segments = [(start, min(start + segmentSize, size) - 1) for start in range(0, size, segmentSize)]
+        self.done = self.loadState()
+        if not self.done:
+            self.preallocate()
+        self.pending = deque(i for i in range(len(self.segments)) if i not in self.done)
+        self.outstanding = 0  # segments queued or being downloaded
+        self.failed = False
+
+    def loadState(self):
+        """
+        :return: Set of the segments already downloaded by an earlier run
+        """
+        if not (os.access(self.partname, os.F_OK) and os.access(self.statename, os.F_OK)):
+            return set()
+        try:
+            with open(self.statename, 'r') as fh:
+                state = json.load(fh)
+            if (state['size'] == self.fileSize and state['segmentSize'] == self.segmentSize and
+                    os.path.getsize(self.partname) == self.fileSize):
+                EDClog.write("\tResuming {} with {} of {} segments done\n".format(
+                    self.egid, len(state['done']), len(self.segments)))
+                return set(state['done'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+        return set()
+
+    def saveState(self):
+        try:
+            with open(self.statename, 'w') as fh:
+                json.dump({'size': self.fileSize, 'segmentSize': self.segmentSize, 'done': sorted(self.done)}, fh)
+        except IOError:
+            EDClog.write("ECHOsegmentedFile::saveState\n")
+            EDClog.write("\t***WARNING: Could not write segment state file ({})\n".format(self.statename))
+
+    def preallocate(self):
+        """
+        Create the partial file at its full size, so segments can be written
+        in place, and running out of disk space shows up before the download
+        """
+        if os.access(self.statename, os.F_OK):
+            os.remove(self.statename)
+        with open(self.partname, 'wb') as fh:
+            fallocate = getattr(os, 'posix_fallocate', None)
+            try:
+                if fallocate is None:
+                    raise OSError
+                fallocate(fh.fileno(), 0, self.fileSize)
+            except OSError:
+                # Not supported here (or by the file system), a sparse file will do
+                fh.truncate(self.fileSize)
+
+    def nextSegment(self):
+        """
+        :return: Index of the next segment to download, None if there is none
+        """
+        if not self.pending:
+            return None
+        return self.pending.popleft()
+
+    def segmentDone(self, index):
+        self.done.add(index)
+        self.saveState()
+
+    def complete(self):
+        """
+        Verify the file once all segments are in and move it into place.  A
+        file that fails verification is discarded.
+        :return: True on success, False if verification or the rename failed
+        """
+        with open(self.partname, 'rb') as fh:
+            for block in iter(lambda: fh.read(1048576), b''):
+                self.hasher.update(block)
+                self.size += len(block)
+        if not self.verify():
+            self.discard()
+            return False
+
+        try:
+            os.rename(self.partname, self.filename)
+        except OSError:
+            EDClog.write("ECHOsegmentedFile::complete\n")
+            EDClog.write("\t****ERROR: Couldn't rename {} to {}\n".format(self.partname, self.filename))
+            return False
+        self.removeState()
+        return True
+
+    def removeState(self):
+        try:
+            os.remove(self.statename)
+        except OSError:
+            pass
+
+    def discard(self):
+        """
+        Remove the partial file, the next attempt starts from scratch
+        """
+        self.removeState()
+        try:
+            os.remove(self.partname)
+        except OSError:
+            pass
+
+
+class ECHOsegmentTransfer(object):
+    """
+    Download of one byte range segment of an ECHOsegmentedFile on a curl
+    object, written in place into the preallocated partial file
+    """
+
+    def __init__(self, c, segFile, index, url):
+        """
+        :param segFile: The ECHOsegmentedFile
+        :param index: Segment index in 'segFile.segments'
+        """
+        self.curl = c
+        self.segFile = segFile
+        self.index = index
+        self.egid = segFile.egid
+        self.url = url
+        self.filename = segFile.filename
+        self.race = None
+        self.digest = None
+        self.start, self.end = segFile.segments[index]
+        self.length = self.end - self.start + 1
+        self.offset = self.start  # reported as the resume offset
+        self.size = 0
+        self.writeTime = 0.0  # seconds spent writing the data to disk
+        self.fp = open(segFile.partname, 'r+b')
+        self.fp.seek(self.start)
+        self.checkedRange = False
+
+        c.setopt(pycurl.URL, url)
+        c.setopt(pycurl.WRITEFUNCTION, self.write)
+        c.setopt(pycurl.RESUME_FROM_LARGE, 0)
+        c.setopt(pycurl.RANGE, "{}-{}".format(self.start, self.end))
+        c.setopt(pycurl.NOPROGRESS, 1)
+
+    def write(self, data):
+        if not self.checkedRange:
+            self.checkedRange = True
+            if self.curl.getinfo(pycurl.RESPONSE_CODE) != 206:
+                # The server ignored the Range request, a short write aborts the transfer
+                EDClog.write("\t{} ignored the range request for {}\n".format(urlparse(self.url).netloc,
+                                                                            self.egid))
+                return 0
+        if self.size + len(data) > self.length:
+            return 0
+        writeStart = time.time()
+        self.fp.write(data)
+        self.writeTime += time.time() - writeStart
+        self.size += len(data)
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.close()
+
+    def complete(self):
+        """
+        :return: True if the whole segment was received
+        """
+        self.close()
+        if self.size != self.length:
+            EDClog.write("\t****ERROR: Granule {} segment {} got {} of {} bytes\n".format(
+                self.egid, self.index, self.size, self.length))
+            return False
+        return True
+
+    def discard(self):
+        # The segment is downloaded again from its start
+        self.close()
+
+
+class ECHOtransferReport(object):
+    """
+    Per-run report of the curl timing information of every finished granule
+    transfer, one CSV row or JSON line per transfer.  The curl times are
+    cumulative seconds from the start of the transfer (so 'connect_time'
+    includes 'dns_time' etc.), 'write_time' is the time spent writing to
+    disk.  When the report is closed, per-host percentiles of the timings
+    are written to '<report>_hosts.<format>' and to the log.
+    """
+
+    formats = ("csv", "jsonl")
+    fields = ("egid", "host", "status", "errno", "http_code", "dns_time", "connect_time", "tls_time",
+              "first_byte_time", "total_time", "write_time", "speed_bps", "bytes", "resume_offset",
+              "redirects", "url")
+    # Timings summarized per host, and the percentiles reported for each
+    summaryTimes = ("dns_time", "connect_time", "tls_time", "first_byte_time", "total_time", "write_time",
+                    "speed_bps")
+    percentiles = (50, 90, 99)
+
+    def __init__(self, basename, fmt):
+        """
+        :param basename: Report filename without the extension
+        :param fmt: Report format, 'csv' or 'jsonl'
+        """
+        self.fmt = fmt
+        self.filename = basename + '.' + fmt
+        self.hostsFilename = basename + '_hosts.' + fmt
+        self.hostRows = {}  # host: list of report rows
+        try:
+            self.fh = open(self.filename, 'w')
+        except IOError:
+            EDClog.write("ECHOtransferReport::__init__\n")
+            EDClog.write("\t***ERROR: Could not open transfer report file ({})\n".format(self.filename))
+            raise SystemExit
+        self.writer = self.makeWriter(self.fh, self.fields)
+
+    def makeWriter(self, fh, fields):
+        if self.fmt == "csv":
+            writer = csv.DictWriter(fh, fields, lineterminator='\n')
+            writer.writeheader()
+            return writer.writerow
+        return lambda row: fh.write(json.dumps(row, sort_keys=True) + '\n')
+
+    def record(self, c, t, status, errno=0):
+        """
+        :param c: Curl object the transfer ran on
+        :param t: The finished ECHOtransfer
+        :param status: Granule download status (1 or -1)
+        :param errno: Curl error number, 0 if the transfer itself succeeded
+        """
+        appConnect = getattr(pycurl, 'APPCONNECT_TIME', None)
+        row = {'egid': t.egid,
+               'host': urlparse(t.url).netloc.lower(),
+               'status': status,
+               'errno': errno,
+               'http_code': c.getinfo(pycurl.RESPONSE_CODE),
+               'dns_time': c.getinfo(pycurl.NAMELOOKUP_TIME),
+               'connect_time': c.getinfo(pycurl.CONNECT_TIME),
+               'tls_time': c.getinfo(appConnect) if appConnect is not None else 0.0,
+               'first_byte_time': c.getinfo(pycurl.STARTTRANSFER_TIME),
+               'total_time': c.getinfo(pycurl.TOTAL_TIME),
+               'write_time': t.writeTime,
+               'speed_bps': c.getinfo(pycurl.SPEED_DOWNLOAD),
+               'bytes': c.getinfo(pycurl.SIZE_DOWNLOAD),
+               'resume_offset': t.offset,
+               'redirects': c.getinfo(pycurl.REDIRECT_COUNT),
+               'url': t.url}
+        self.writer(row)
+        self.hostRows.setdefault(row['host'], []).append(row)
+
+    def percentile(self, values, pct):
+        """
+        :return: The nearest-rank 'pct' percentile of the sorted list 'values'
+        """
+        rank = int(math.ceil(pct / 100.0 * len(values)))
+        return values[max(rank, 1) - 1]
+
+    def close(self):
+        self.fh.close()
+
+        summaryFields = ["host", "transfers", "failed", "bytes"]
+        for name in self.summaryTimes:
+            summaryFields.extend("{}_p{}".format(name, pct) for pct in self.percentiles)
+
+        try:
+            fh = open(self.hostsFilename, 'w')
+        except IOError:
+            EDClog.write("ECHOtransferReport::close\n")
+            EDClog.write("\t***WARNING: Could not open host summary file ({})\n".format(self.hostsFilename))
+            return
+        writer = self.makeWriter(fh, summaryFields)
+
+        EDClog.write("ECHOtransferReport::close\n")
+        EDClog.write("\tTransfer report: {}\n".format(self.filename))
+        for host in sorted(self.hostRows):
+            rows = self.hostRows[host]
+            summary = {'host': host,
+                       'transfers': len(rows),
+                       'failed': sum(1 for row in rows if row['status'] != 1),
+                       'bytes': sum(row['bytes'] for row in rows)}
+            for name in self.summaryTimes:
+                values = sorted(row[name] for row in rows)
+                for pct in self.percentiles:
+                    summary["{}_p{}".format(name, pct)] = self.percentile(values, pct)
+            writer(summary)
+            EDClog.write("\t{}: {} transfers ({} failed), total time p50/p90/p99 {:.2f}/{:.2f}/{:.2f}s, "
+                         "first byte p50 {:.2f}s, dns p50 {:.3f}s\n".format(
+                             host, summary['transfers'], summary['failed'], summary['total_time_p50'],
+                             summary['total_time_p90'], summary['total_time_p99'],
+                             summary['first_byte_time_p50'], summary['dns_time_p50']))
+        fh.close()
+
+
+class ECHOeventLoop(object):
+    """
+    Minimal event loop: file descriptor watches and timed callbacks.  Used
+    by the 'socket' download engine to drive a CurlMulti through its socket
+    and timer callbacks, other work (progress reporting, concurrency tuning
+    etc.) is scheduled on the same loop with 'callLater'.  Sockets are
+    polled with epoll or poll where available (no FD_SETSIZE limit), select
+    otherwise.  Nothing run on the loop may block.
+    """
+
+    def __init__(self):
+        self.watched = {}  # fd: (readable, writable, callback(fd, readable, writable, error))
+        self.timers = []  # heap of [when, sequence number, callback or None if cancelled, args]
+        self.timerSeq = 0
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.pollIn, self.pollOut = select.EPOLLIN, select.EPOLLOUT
+            self.pollErr = select.EPOLLERR | select.EPOLLHUP
+            self.pollMillis = False  # epoll timeouts are in seconds
+        elif hasattr(select, 'poll'):
+            self.poller = select.poll()
+            self.pollIn, self.pollOut = select.POLLIN, select.POLLOUT
+            self.pollErr = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            self.pollMillis = True  # poll timeouts are in (whole) milliseconds
+        else:
+            self.poller = None
+
+    def watch(self, fd, readable, writable, callback):
+        if self.poller is not None:
+            mask = (self.pollIn if readable else 0) | (self.pollOut if writable else 0)
+            if fd in self.watched:
+                try:
+                    self.poller.modify(fd, mask)
+                except (IOError, OSError) as error:
+                    # epoll forgets a socket when it is closed, and its fd may
+                    # have been reused since
+                    if error.args[0] != ENOENT:
+                        raise
+                    self.poller.register(fd, mask)
+            else:
+                self.poller.register(fd, mask)
+        self.watched[fd] = (readable, writable, callback)
+
+    def unwatch(self, fd):
+        if self.watched.pop(fd, None) is not None and self.poller is not None:
+            try:
+                self.poller.unregister(fd)
+            except (IOError, OSError, KeyError):
+                # Already closed (and dropped by epoll)
+                pass
+
+    def close(self):
+        if self.poller is not None and hasattr(self.poller, 'close'):
+            self.poller.close()
+
+    def callLater(self, delay, func, *args):
+        """
+        :return: Timer entry, can be passed to 'cancel'
+        """
+        self.timerSeq += 1
+        entry = [time.time() + delay, self.timerSeq, func, args]
+        heapq.heappush(self.timers, entry)
+        return entry
 
-    def getLongitude(self):
-        return self.longitude
+    def cancel(self, entry):
+        entry[2] = None
 
-    def setInsertFailed(self, statFlag):
-        self.dbInsertFailed = statFlag
+    def poll(self, wait):
+        """
+        :return: List of (fd, readable, writable, error) for the sockets that
+                 became ready within 'wait' seconds
+        """
+        if self.poller is not None:
+            events = self.poller.poll(int(math.ceil(wait * 1000)) if self.pollMillis else wait)
+            return [(fd, bool(ev & self.pollIn), bool(ev & self.pollOut), bool(ev & self.pollErr))
+                    for fd, ev in events]
+
+        rlist = [fd for fd, (r, w, cb) in self.watched.items() if r]
+        wlist = [fd for fd, (r, w, cb) in self.watched.items() if w]
+        readable, writable, errored = select.select(rlist, wlist, list(self.watched), wait)
+        return [(fd, fd in readable, fd in writable, fd in errored)
+                for fd in set(readable) | set(writable) | set(errored)]
+
+    def runOnce(self, maxWait):
+        """
+        Wait (at most 'maxWait' seconds, less if a timer is due sooner) for
+        socket events, then run the callbacks of ready sockets and due timers
+        """
+        while self.timers and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+        wait = maxWait
+        if self.timers:
+            wait = max(0.0, min(wait, self.timers[0][0] - time.time()))
 
-    def getInsertFailed(self):
-        return self.dbInsertFailed
+        if self.watched:
+            try:
+                ready = self.poll(wait)
+            except (select.error, IOError, OSError) as error:
+                code = error.args[0] if error.args else None
+                if code == EBADF:
+                    # select() on a socket closed under us, wait for the next
+                    # timer (libcurl's timeout clears it up) instead of spinning
+                    EDClog.write("ECHOeventLoop::runOnce\n")
+                    EDClog.write("\t***WARNING: Watching a closed socket ({})\n".format(error))
+                    time.sleep(wait)
+                elif code != EINTR:
+                    raise
+                ready = []
+            for fd, readable, writable, error in ready:
+                # An earlier callback may have stopped watching this socket
+                if fd in self.watched:
+                    self.watched[fd][2](fd, readable, writable, error)
+        else:
+            time.sleep(wait)
+
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            when, seq, func, args = heapq.heappop(self.timers)
+            if func is not None:
+                func(*args)
 
 
 class ECHOdownloader(object):
-    def __init__(self, ero, dbh):
+    # Download engines, see 'downloadGranules'
+    engines = ("multi", "single", "socket")
+
+    # Curl errors worth retrying in the same run (timeouts, resets etc.)
+    transientErrors = tuple(getattr(pycurl, name) for name in (
+        'E_COULDNT_RESOLVE_HOST', 'E_COULDNT_CONNECT', 'E_OPERATION_TIMEDOUT', 'E_PARTIAL_FILE',
+        'E_GOT_NOTHING', 'E_SEND_ERROR', 'E_RECV_ERROR', 'E_SSL_CONNECT_ERROR') if hasattr(pycurl, name))
+    maxRetryDelay = 300.0  # seconds
+    hostStatsFile = "hostStats.json"
+    segmentMB = 64  # segment size of segmented downloads
+    transferTimeout = 300  # seconds, for transfers at full speed
+    lowSpeedLimit = 1024  # bytes/s, a slower rate limited transfer ...
+    lowSpeedTime = 60  # ... for this many seconds has stalled
+    stallOnlyMB = 256  # whole granules larger than this (or of unknown size) only time out when stalled
+    probeTimeout = 15  # seconds, for the HEAD requests probing the size of segmented granules
+
+    def __init__(self, ero, dbh, runMgr):
         """
         :param ero: ECHO Request Object containing collections and granules
         :param dbh: Local 'echo' database handle object (for checking if granule
                     already exists (has been downloaded previously)
+        :param runMgr: Run manager object holding the download options
         :return: Process exists if download conditions (disk space etc) are not
                 adequate.
         """
         self.rootDir = ero.getDirRoot()
         self.granuleQueue = []  # list of (egid, url, filename) tuples
         self.granuleStatus = {}  # egid, true/false(0/1) flag dictionary
+        self.granuleDigest = {}  # egid, digest of the downloaded file dictionary
+        self.granules = {}  # egid, granule object dictionary
+        self.granuleColl = {}  # egid, collection id dictionary
+        self.dirStatus = {}  # directory path, true/false (usable) dictionary
         self.dbHandle = dbh
+        self.minConns, self.maxConns = runMgr.getConnLimits()
+        self.hostConns = runMgr.getHostConns()
+        self.limiter = ECHObandwidth(*runMgr.getRateLimits())
+        self.report = runMgr.getTransferReport()
+        self.metrics = runMgr.getMetrics()
+        self.engine = runMgr.getDownloadEngine()
+        self.http2 = runMgr.getHTTP2() and self.haveHTTP2()
+        self.maxAttempts, self.retryDelay = runMgr.getRetryPolicy()
+        self.attempts = {}  # egid, number of download attempts made this run
+        self.mirrors = {}  # egid, list of the access URLs of the granule file
+        self.tried = {}  # egid, set of mirrors tried since the last retry wait
+        self.hostStats = ECHOhostStats(self.hostStatsFile)
+        self.raceMirrorsMB = runMgr.getRaceMirrors()
+        self.segmentThresholdMB, self.segmentConns = runMgr.getSegmentation()
+        self.segFiles = {}  # egid, ECHOsegmentedFile of granules downloaded in segments
+        self.numAttempts = 0  # finished transfers, including ones that get retried
+        self.numAttemptsFailed = 0
+        self.share = self.makeShare()
+
+        if self.maxAttempts < 1 or self.retryDelay < 0:
+            EDClog.write("ECHOdownloader::__init__\n")
+            EDClog.write("\t****ERROR: Invalid retry policy (max. attempts {}, delay {})\n".format(
+                self.maxAttempts, self.retryDelay))
+            raise SystemExit
+
+        if self.minConns < 1 or self.maxConns < self.minConns or self.hostConns < 1 or self.segmentConns < 1:
+            EDClog.write("ECHOdownloader::__init__\n")
+            EDClog.write("\t****ERROR: Invalid connection limits (min {}, max {}, per host {}, "
+                         "per granule {})\n".format(self.minConns, self.maxConns, self.hostConns,
+                                                    self.segmentConns))
+            raise SystemExit
 
         if not self.downloadOk(ero):
             raise SystemExit
@@ -1312,73 +3545,67 @@ class ECHOdownloader(object):
 
         return True
 
-    def makeCollPath(self, archCtr, shortName):
-
-        self.collPath = self.rootDir + '/' + archCtr + '/' + shortName
+    def makeDir(self, path, caller):
+        """
+        :param path: Directory pathname
+        :param caller: Name of the calling method, for the log
+        :return: true if path can be created and is writeable, false otherwise
+        """
 
-        if os.access(self.collPath, os.F_OK) and os.access(self.collPath, os.W_OK):
+        if os.access(path, os.F_OK) and os.access(path, os.W_OK):
             # exists and is writeable
             return True
 
-        if not os.access(self.collPath, os.F_OK):
+        if not os.access(path, os.F_OK):
             # doesn't exist, try to create it. note that we are using the
             # recursive OS functon 'makedirs' which makes all of the requisite
             # intermediate subdirectories that contain the final leaf directory
             try:
-                os.makedirs(self.collPath, 0o755)
+                os.makedirs(path, 0o755)
             except OSError:
-                EDClog.write("ECHOdownloader::makeCollPath\n")
-                EDClog.write("\tERROR: Couldn't create directory %s\n" % self.collPath)
+                EDClog.write("ECHOdownloader::{}\n".format(caller))
+                EDClog.write("\tERROR: Couldn't create directory %s\n" % path)
                 return False
 
-        if not os.access(self.collPath, os.W_OK):
+        if not os.access(path, os.W_OK):
             # exists but is not writeable, try to change permission
             try:
-                os.chmod(self.collPath, 0o755)
+                os.chmod(path, 0o755)
             except OSError:
-                EDClog.write("ECHOdownloader::makeCollPath\n")
-                EDClog.write("\tERROR: Couldn't make directory %s writeable\n" % self.collPath)
+                EDClog.write("ECHOdownloader::{}\n".format(caller))
+                EDClog.write("\tERROR: Couldn't make directory %s writeable\n" % path)
                 return False
 
         return True
 
+    def makeCollPath(self, archCtr, shortName):
+
+        self.collPath = self.rootDir + '/' + archCtr + '/' + shortName
+
+        # Each directory is only checked (and created) once per run
+        if self.collPath not in self.dirStatus:
+            self.dirStatus[self.collPath] = self.makeDir(self.collPath, "makeCollPath")
+        return self.dirStatus[self.collPath]
+
     def makeGranPath(self, gp):
         """
         :param gp: Desired granule pathname
         :return: true if path can be created and is writeable, false otherwise
         """
 
-        if os.access(gp, os.F_OK) and os.access(gp, os.W_OK):
-            # exists and is writeable
-            return True
-
-        if not os.access(gp, os.F_OK):
-            # doesn't exist, try to create it. note that we are using the
-            # recursive OS functon 'makedirs' which makes all of the requisite
-            # intermediate subdirectories that contain the final leaf directory
-            try:
-                os.makedirs(gp, 0o755)
-            except OSError:
-                EDClog.write("ECHOdownloader::makeGranPath\n")
-                EDClog.write("\tERROR: Couldn't create directory %s\n" % gp)
-                return False
-
-        if not os.access(gp, os.W_OK):
-            # exists but is not writeable, try to change permission
-            try:
-                os.chmod(gp, 0o755)
-            except OSError:
-                EDClog.write("ECHOdownloader::makeGanPath\n")
-                EDClog.write("\tERROR: Couldn't make directory %s writeable\n" % gp)
-                return False
-
-        return True
+        # Each directory is only checked (and created) once per run
+        if gp not in self.dirStatus:
+            self.dirStatus[gp] = self.makeDir(gp, "makeGranPath")
+        return self.dirStatus[gp]
 
     def getCollPath(self):
         return (self.collPath)
 
     def downloadGranules(self, ero):
 
+        # Granules that failed in 'maxTries' earlier runs are never downloaded again
+        quarantined = ero.getQuarantined()
+
         for cc in ero.collContainer:
             # If there were no granules retrieved from ECHO, for this collection,
             # we can completely ignore it
@@ -1386,15 +3613,12 @@ class ECHOdownloader(object):
                 if self.makeCollPath(cc.archCenter, cc.shortName):
                     # Collection filesystem ready to accept granules. Create
                     # queue of (egid, url, filename) tuples for all granules in collection
+                    readyGranules = []
+                    granPaths = {}  # egid, granule directory dictionary
 
                     for g in cc.granContainer:
-
-                        if (len(g.accessURLs) > 1):
-                            EDClog.write("ECHOdownloader::downloadGranules\n")
-                            EDClog.write("\tWARNING: Using URL 1 for granule %s with > 1 access URLs\n".format(g.egid))
-
-                        granuleURL, mimeType = g.accessURLs[0]
-                        filename = os.path.basename(granuleURL)
+                        if g.egid in quarantined:
+                            continue
                         yyyy = int(g.begDateTime[0:4])
                         mm = int(g.begDateTime[5:7])
                         dd = int(g.begDateTime[8:10])
@@ -1403,56 +3627,97 @@ class ECHOdownloader(object):
                         yday = granDate.toordinal() - dt.date(yyyy, 1, 1).toordinal() + 1
                         ydayStr = '{0:03d}'.format(yday)
 
-                        granPath = self.getCollPath() + '/' + str(yyyy) + '/' + ydayStr
+                        granPaths[g.egid] = self.getCollPath() + '/' + str(yyyy) + '/' + ydayStr
+
+                    # Make all of the granule directories of the collection in
+                    # one pass, before any granule is queued.  Many granules share
+                    # a directory, and each unique directory is only made once.
+                    for granPath in sorted(set(granPaths.values())):
+                        self.makeGranPath(granPath)
+
+                    for g in cc.granContainer:
+                        self.granules[g.egid] = g
+                        self.granuleColl[g.egid] = cc.getid()
+                        if g.egid in quarantined:
+                            EDClog.write("\tSkipping quarantined granule {}\n".format(g.egid))
+                            self.granuleStatus[g.egid] = -3
+                            continue
+
+                        # Access URLs of the same file name as the first one are
+                        # mirrors of it, start with the one on the host with the
+                        # best recent throughput
+                        filename = os.path.basename(g.accessURLs[0][0])
+                        mirrors = [u for u, mt in g.accessURLs if os.path.basename(u) == filename]
+                        if len(mirrors) < len(g.accessURLs):
+                            EDClog.write("ECHOdownloader::downloadGranules\n")
+                            EDClog.write("\tWARNING: Ignoring {} access URLs of granule {} that aren't a "
+                                         "mirror of {}\n".format(len(g.accessURLs) - len(mirrors), g.egid,
+                                                                 filename))
+                        self.mirrors[g.egid] = mirrors
+                        granuleURL = self.hostStats.rank(mirrors)[0]
+                        self.tried[g.egid] = set([granuleURL])
+
+                        granPath = granPaths[g.egid]
                         if self.makeGranPath(granPath):
-                            # Filesystem ready to receive this granule, add it to
-                            # the download queue
+                            # Filesystem ready to receive this granule
                             granuleFilename = granPath + '/' + filename
                             # Save this granule's local filename in the granule
                             # object for subsequent loading of database
                             g.setLocalFileName(granuleFilename)
-
-                            # If this granule has NOT already been inserted into the
-                            # local 'echo' database, add it to the download queue
-                            # v1.2.0 Only use check the DB if this is a useDB=True request
-                            if ero.getDBflag() == "True":
-                                qStr = "select granuleUR from granules where granID = '{}'".format(g.egid)
-                                qResults = self.dbHandle.makeDBquery(qStr)
-                                if not qResults:
-                                    # This granule is NOT already in the DB, add it to the
-                                    # download queue
-                                    self.granuleQueue.append((g.egid, granuleURL, granuleFilename))
-                                else:
-                                    # Granule already in the DB, don't download
-                                    self.granuleStatus[g.egid] = 0
-                            else:
-                                self.granuleQueue.append((g.egid, granuleURL, granuleFilename))
+                            readyGranules.append((g.egid, granuleURL, granuleFilename))
                         else:
                             self.granuleStatus[g.egid] = -2  # granule directory make failed
+
+                    # If a granule has NOT already been inserted into the local
+                    # 'echo' database, add it to the download queue.  The DB is
+                    # checked for the whole collection at once (in chunks) rather
+                    # than with one query per granule.
+                    # v1.2.0 Only use check the DB if this is a useDB=True request
+                    inDB = set()
+                    if ero.getDBflag() == "True":
+                        inDB = self.dbHandle.findGranules([egid for egid, url, fn in readyGranules])
+
+                    for egid, granuleURL, granuleFilename in readyGranules:
+                        if egid in inDB:
+                            # Granule already in the DB, don't download
+                            self.granuleStatus[egid] = 0
+                        else:
+                            self.granuleQueue.append((egid, granuleURL, granuleFilename))
                 else:
                     # Failed to make the collection directory, so ALL
                     # granules in this collection will NOT be downloaded
                     for g in cc.granContainer:
-                        self.granuleStatus[g.egid] = -2  # collection directory make failed
+                        # collection directory make failed
+                        self.granuleStatus[g.egid] = -3 if g.egid in quarantined else -2
 
         # All granules, for all collections, that have not already been
         # downloaded before (already in the local 'echo' database), are
         # in the download 'granuleQueue'.  Run file downloader.
-        # You have two options here, you can call 'singledownload' or
+        # You have two options here (--download-engine), 'singledownload' or
         # 'multidownload'.  The 'multidownload' uses PyCurl's concurrent
-        # download feature and is currently hardcoded for 10 simultaneous
-        # downloads (determined after stress testing to be optimal for our
-        # network conditions).  'singledownload' is included for
+        # download feature, with the number of simultaneous downloads
+        # adapted to the measured throughput (started at 10, which was
+        # determined after stress testing to be optimal for our network
+        # conditions at the time).  'singledownload' is included for
         # benchmarking purposes, and really should never be used as it is
         # about 50% slower (stress testing with 30 granules (~1.5GB) to
-        # download).
+        # download).  'socketdownload' (socket) is an event driven version of
+        # 'multidownload'.  EDCbench.py measures the engines against a local server.
 
         EDClog.write("ECHOdownloader::downloadGranules\n")
         EDClog.write("\t{0:d} total granules will be downloaded\n".format(len(self.granuleQueue)))
+        self.orderGranuleQueue(ero.getDownloadOrder())
         if len(self.granuleQueue) > 0:
-            self.multidownload()
-        # self.singledownload()
-        EDClog.write("\tFinished multi-download process\n")
+            if self.engine == "single":
+                self.singledownload()
+            elif self.engine == "socket":
+                self.socketdownload()
+            else:
+                self.multidownload()
+            self.hostStats.save()
+        EDClog.write("\tFinished {}-download process\n".format(self.engine))
+        if self.report is not None:
+            self.report.close()
 
         # Update the 'downloadStatus' attribute of all granule objects using the
         # 'granuleStatus' dictionary {egid,0|1|-1|-2}
@@ -1461,29 +3726,589 @@ class ECHOdownloader(object):
         #  1: download was attempted and was successful
         # -1: download was attempted and failed
         # -2: failed to make either the collection or granule holding directory
+        # -3: No download attempted, granule is quarantined
         #
+        statusCounts = {0: 0, 1: 0, -1: 0, -2: 0, -3: 0}
         for cc in ero.collContainer:
             for g in cc.granContainer:
                 g.setDownloadStatus(self.granuleStatus[g.egid])
-                if g.getDownloadStatus() < 0:
+                g.setDigest(self.granuleDigest.get(g.egid))
+                statusCounts[g.getDownloadStatus()] += 1
+                if g.getDownloadStatus() in (-1, -2):
                     # see above status codes
                     cc.setFailedStatus(True)
 
-    def singledownload(self):
+        # Per-run values, so gauges: they start over every run
+        self.metrics.set("edclient_last_run_granules_downloaded", "gauge", "Granules downloaded in the last run",
+                         statusCounts[1])
+        self.metrics.set("edclient_last_run_granules_skipped", "gauge",
+                         "Granules skipped in the last run, already in the DB", statusCounts[0])
+        self.metrics.set("edclient_last_run_granules_failed", "gauge",
+                         "Granules that failed to download in the last run (download or directory failure)",
+                         statusCounts[-1] + statusCounts[-2])
+        self.metrics.set("edclient_last_run_granules_quarantined", "gauge",
+                         "Granules skipped in the last run, quarantined", statusCounts[-3])
+
+    def orderGranuleQueue(self, order):
+        """
+        Sort the download queue once, before downloading, using one of the
+        request file's 'downloadOrder' policies:
+
+          discovery : order the granules were returned by ECHO (no sorting)
+          largest   : largest granules first, to shorten the total run time
+          newest    : most recent granules (begin date/time) first
+          collection: one granule from each collection in turn
+
+        The download queue keeps this order within each host, so handing
+        out the next granule stays O(1) no matter how long the queue is.
+        """
+        EDClog.write("\tDownload order: {}\n".format(order))
+        if order == "largest":
+            self.granuleQueue.sort(key=lambda item: self.granules[item[0]].getGranuleSizeMB(), reverse=True)
+        elif order == "newest":
+            self.granuleQueue.sort(key=lambda item: self.granules[item[0]].begDateTime, reverse=True)
+        elif order == "collection":
+            collQueues = {}  # collection id: deque of (egid, url, filename) tuples
+            rotation = deque()  # collections with queued granules, in round-robin order
+            for item in self.granuleQueue:
+                cid = self.granuleColl[item[0]]
+                if cid not in collQueues:
+                    collQueues[cid] = deque()
+                    rotation.append(cid)
+                collQueues[cid].append(item)
+            self.granuleQueue = []
+            while rotation:
+                cid = rotation.popleft()
+                self.granuleQueue.append(collQueues[cid].popleft())
+                if collQueues[cid]:
+                    rotation.append(cid)
+
+    def setMetrics(self, numBytes, elapsed, numActive, numQueued):
+        """
+        Update the download metrics (progress so far, while downloading).  The
+        granule counts come from 'granuleStatus', so failed means the same
+        (-1 or -2) as in the end of run counts of 'downloadGranules'.
+        """
+        statuses = list(self.granuleStatus.values())
+        self.metrics.set("edclient_last_run_granules_downloaded", "gauge", "Granules downloaded in the last run",
+                         statuses.count(1))
+        self.metrics.set("edclient_last_run_granules_failed", "gauge",
+                         "Granules that failed to download in the last run (download or directory failure)",
+                         statuses.count(-1) + statuses.count(-2))
+        self.metrics.set("edclient_last_run_downloaded_bytes", "gauge", "Bytes downloaded in the last run",
+                         numBytes)
+        self.metrics.set("edclient_download_throughput_bytes_per_second", "gauge",
+                         "Average download throughput of the run", numBytes / max(elapsed, 1e-3))
+        self.metrics.set("edclient_download_active_transfers", "gauge", "Granule transfers in progress", numActive)
+        self.metrics.set("edclient_download_queued_granules", "gauge", "Granules waiting to be downloaded",
+                         numQueued)
+
+    def haveHTTP2(self):
+        """
+        :return: True if libcurl was built with HTTP/2 support (and pycurl
+                 knows how to ask for it)
+        """
+        feature = getattr(pycurl, 'VERSION_HTTP2', None)
+        if feature is None or not hasattr(pycurl, 'CURL_HTTP_VERSION_2TLS'):
+            return False
+        return bool(pycurl.version_info()[4] & feature)
+
+    def makeShare(self):
+        """
+        :return: A CurlShare letting all curl objects share the DNS cache, TLS
+                 sessions and (where libcurl supports it) the connection cache,
+                 None if sharing isn't available
+        """
+        try:
+            share = pycurl.CurlShare()
+            share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        except (AttributeError, pycurl.error) as error:
+            EDClog.write("ECHOdownloader::makeShare\n")
+            EDClog.write("\t***WARNING: Curl handles can't share DNS/TLS caches ({})\n".format(error))
+            return None
 
-        for egid, url, filename in self.granuleQueue:
-            c = pycurl.Curl()
-            c.setopt(c.URL, url)
-            c.fp = open(filename, "wb")
-            c.setopt(c.WRITEDATA, c.fp)
+        lockConnect = getattr(pycurl, 'LOCK_DATA_CONNECT', None)
+        if lockConnect is not None:
             try:
-                c.perform()
+                share.setopt(pycurl.SH_SHARE, lockConnect)
+            except pycurl.error:
+                pass
+        return share
+
+    def makeMulti(self):
+        """
+        :return: A new multi stack, multiplexing HTTP/2 transfers to the same
+                 host over one connection when HTTP/2 is in use
+        """
+        m = pycurl.CurlMulti()
+        multiplex = getattr(pycurl, 'PIPE_MULTIPLEX', None)
+        if self.http2 and multiplex is not None:
+            try:
+                m.setopt(pycurl.M_PIPELINING, multiplex)
             except pycurl.error:
-                EDClog.write("\tsingledownload failed: %s\n" % egid)
-                self.granuleStatus[egid] = 0
+                pass
+        return m
+
+    def makeCurl(self):
+        """
+        :return: A new curl object with the options shared by all transfers
+        """
+        c = pycurl.Curl()
+        c.transfer = None
+        c.rateLimit = 0  # bytes/s, see 'limitRate'
+        c.stallOnly = False  # see 'setTimeouts'
+        c.running = False  # transfer under way, see 'limitRate'
+        if self.share is not None:
+            c.setopt(pycurl.SHARE, self.share)
+        self.setHTTPVersion(c, self.http2)
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.MAXREDIRS, 5)
+        c.setopt(pycurl.CONNECTTIMEOUT, 30)
+        c.setopt(pycurl.TIMEOUT, self.transferTimeout)
+        c.setopt(pycurl.NOSIGNAL, 1)
+        # HTTP errors (404, 416 etc.) are transfer failures, not file content
+        c.setopt(pycurl.FAILONERROR, 1)
+        return c
+
+    def setHTTPVersion(self, c, multiplex):
+        """
+        With 'multiplex', HTTP/2 over TLS when the server offers it (ALPN),
+        HTTP/1.1 otherwise, waiting for a connection that can be multiplexed
+        rather than opening another one.  Without it, HTTP/1.1 on a
+        connection of its own: byte range segments are only faster if every
+        one of them gets its own TCP connection.
+        """
+        pipeWait = getattr(pycurl, 'PIPEWAIT', None)
+        if multiplex:
+            c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+        else:
+            c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_1_1)
+        if pipeWait is not None:
+            c.setopt(pipeWait, 1 if multiplex else 0)
+
+    def limitRate(self, handles):
+        """
+        Share the current rate limit (--day-rate/--night-rate) evenly between
+        the curl objects of the running transfers 'handles'.  Called whenever
+        transfers start or finish, and at least once a second, which picks up
+        the day/night switch.  libcurl paces each transfer to its share, so
+        nothing ever sleeps in a callback.
+        """
+        perTransfer = self.limiter.perTransfer(len(handles))
+        for c in handles:
+            if c.rateLimit != perTransfer:
+                c.rateLimit = perTransfer
+                c.setopt(pycurl.MAX_RECV_SPEED_LARGE, perTransfer)
+                self.setTimeouts(c)
+            # Called last before the transfers are performed
+            c.running = True
+
+    def setTimeouts(self, c):
+        """
+        A transfer at full speed gets the fixed 'transferTimeout'.  A rate
+        limited transfer, or a large granule downloaded in one piece
+        ('stallOnly'), may legitimately take much longer, so it is only
+        aborted when it stalls (below 'lowSpeedLimit' bytes/s, or half its
+        rate limit if that is lower, for 'lowSpeedTime' seconds).  So is a
+        transfer already under way when its limit is lifted: libcurl counts
+        the fixed timeout from the start of the transfer, which would abort
+        one that has been rate limited for longer straight away.
+        """
+        if c.rateLimit > 0 or c.stallOnly or c.running:
+            c.setopt(pycurl.TIMEOUT, 0)
+            speedLimit = self.lowSpeedLimit
+            if c.rateLimit > 0:
+                speedLimit = min(speedLimit, max(1, c.rateLimit // 2))
+            c.setopt(pycurl.LOW_SPEED_LIMIT, speedLimit)
+            c.setopt(pycurl.LOW_SPEED_TIME, self.lowSpeedTime)
+        else:
+            c.setopt(pycurl.TIMEOUT, self.transferTimeout)
+            c.setopt(pycurl.LOW_SPEED_TIME, 0)
+
+    def transferDone(self, c, errno=0, errmsg=""):
+        """
+        Record the outcome of the transfer on curl object 'c'.  A successful
+        transfer is moved into place, a failed one keeps its partial file so
+        the next attempt can resume it.
+        :return: The granule download status (1 or -1)
+        """
+        t = c.transfer
+        c.transfer = None
+        status = -1
+        if errno == 0:
+            if t.complete():
+                self.granuleDigest[t.egid] = t.digest
+                status = 1
+        else:
+            t.close()
+            if self.resumeRejected(c, errno):
+                # Resuming is pointless, start over from byte zero
+                t.discard()
+            EDClog.write("\t{} ({}: {})\n".format(t.egid, errno, errmsg))
+
+        if self.report is not None:
+            self.report.record(c, t, status, errno)
+        return status
+
+    def resumeRejected(self, c, errno):
+        """
+        :return: True if the transfer on 'c' failed because its resume range
+                 was rejected: the server ignored the Range request (libcurl
+                 won't append the whole file to the partial one), or can't
+                 satisfy it (416, most likely the partial file is already
+                 complete or not the same file)
+        """
+        if errno == pycurl.E_RANGE_ERROR:
+            return True
+        return errno == pycurl.E_HTTP_RETURNED_ERROR and c.getinfo(pycurl.RESPONSE_CODE) == 416
+
+    def isTransient(self, c, errno):
+        """
+        :return: True if the failed transfer on 'c' is worth retrying (timeouts,
+                 connection resets, HTTP 5xx etc.)
+        """
+        if errno in self.transientErrors:
+            return True
+        if errno == pycurl.E_HTTP_RETURNED_ERROR:
+            code = c.getinfo(pycurl.RESPONSE_CODE)
+            return code >= 500 or code in (408, 429)
+        return False
+
+    def retryGranule(self, c, egid, errno):
+        """
+        Decide whether a failed granule download is retried in this run
+        :return: Seconds to wait before the retry (exponential backoff with
+                 jitter), None if the granule is not retried
+        """
+        attempt = self.attempts.get(egid, 1)
+        if attempt >= self.maxAttempts or not self.isTransient(c, errno):
+            return None
+
+        self.attempts[egid] = attempt + 1
+        delay = min(self.retryDelay * math.pow(2, attempt - 1), self.maxRetryDelay)
+        delay *= random.uniform(0.5, 1.5)
+        EDClog.write("\tRetrying {} in {:.1f}s (attempt {} of {})\n".format(egid, delay, attempt + 1,
+                                                                          self.maxAttempts))
+        return delay
+
+    def nextMirror(self, egid):
+        """
+        :return: The best mirror of granule 'egid' not tried since the last
+                 retry wait, None if all of them have been tried
+        """
+        for url in self.hostStats.rank(self.mirrors[egid]):
+            if url not in self.tried[egid]:
+                self.tried[egid].add(url)
+                return url
+        return None
+
+    def raceMirror(self, egid, url, filename, queue):
+        """
+        :return: The mirror to race against 'url' for granule 'egid', None if
+                 the granule isn't raced (racing is off, the granule is too big
+                 or of unknown size, no other mirror host has room, or there is
+                 a partial file to resume, which the loser would throw away)
+        """
+        sizeMB = self.granules[egid].getGranuleSizeMB()
+        if not (0.0 < sizeMB <= self.raceMirrorsMB):
+            return None
+        if os.access(filename + '.part', os.F_OK):
+            return None
+        for mirror in self.hostStats.rank(self.mirrors[egid]):
+            if (mirror not in self.tried[egid] and queue.hostOf(mirror) != queue.hostOf(url) and
+                    queue.hasRoom(mirror)):
+                return mirror
+        return None
+
+    def makeTransfer(self, c, egid, url, filename, race=None, partname=None, segment=None):
+        """
+        :return: The transfer of 'url' on the (possibly reused) curl object
+                 'c', with the protocol and timeouts set up for its kind
+        """
+        c.running = False
+        if segment is not None:
+            self.setHTTPVersion(c, False)
+            c.stallOnly = False
+            self.setTimeouts(c)
+            return ECHOsegmentTransfer(c, self.segFiles[egid], segment, url)
+        g = self.granules[egid]
+        sizeMB = g.getGranuleSizeMB()
+        self.setHTTPVersion(c, self.http2)
+        c.stallOnly = not (0.0 < sizeMB <= self.stallOnlyMB)
+        self.setTimeouts(c)
+        return ECHOtransfer(c, egid, url, filename, sizeMB, g.getChecksum(), race, partname)
+
+    def probeSizes(self, urls):
+        """
+        Get the size of the files at 'urls' with HEAD requests, up to
+        'maxConns' at a time.  Each gets 'probeTimeout' seconds, a server
+        that is slow to answer just has its granule downloaded in one piece.
+        :return: Dictionary of url, exact size in bytes of the files whose
+                 server accepts byte ranges
+        """
+        sizes = {}
+        pending = deque(urls)
+        m = pycurl.CurlMulti()
+        active = []
+        while pending or active:
+            while pending and len(active) < self.maxConns:
+                c = self.makeCurl()
+                c.probeURL = pending.popleft()
+                c.headers = []
+                c.setopt(pycurl.URL, c.probeURL)
+                c.setopt(pycurl.NOBODY, 1)
+                c.setopt(pycurl.HEADERFUNCTION, c.headers.append)
+                c.setopt(pycurl.CONNECTTIMEOUT, self.probeTimeout)
+                c.setopt(pycurl.TIMEOUT, self.probeTimeout)
+                m.add_handle(c)
+                active.append(c)
+            while 1:
+                ret, num_handles = m.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while 1:
+                num_q, ok_list, err_list = m.info_read()
+                for c, errmsg in [(c, None) for c in ok_list] + [(c, errmsg) for c, errno, errmsg in err_list]:
+                    if errmsg is not None:
+                        EDClog.write("\tCouldn't get the size of {} ({})\n".format(c.probeURL, errmsg))
+                    elif self.acceptsRanges(c.headers):
+                        size = int(c.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD))
+                        if size > 0:
+                            sizes[c.probeURL] = size
+                    m.remove_handle(c)
+                    active.remove(c)
+                    c.close()
+                if num_q == 0:
+                    break
+            if active:
+                m.select(1.0)
+        m.close()
+        return sizes
+
+    def acceptsRanges(self, headers):
+        """
+        :return: True if the response 'headers' include 'Accept-Ranges: bytes'
+        """
+        for h in headers:
+            if isinstance(h, bytes):
+                h = h.decode('iso-8859-1')
+            name, sep, value = h.partition(':')
+            if name.strip().lower() == 'accept-ranges' and value.strip().lower() == 'bytes':
+                return True
+        return False
+
+    def makeQueue(self, hostCap):
+        """
+        :return: (ECHOdownloadQueue of the granule queue, number of granules
+                 in it).  Granules larger than the segmentation threshold are
+                 queued as byte range segments (if the server supports them).
+        """
+        queue = ECHOdownloadQueue([], hostCap)
+        numGranules = 0
+        sizes = {}
+        if self.segmentThresholdMB > 0.0:
+            sizes = self.probeSizes(url for egid, url, filename in self.granuleQueue
+                                    if self.segmentThresholdMB < self.granules[egid].getGranuleSizeMB() and
+                                    url.lower().startswith('http'))
+        for item in self.granuleQueue:
+            egid, url, filename = item
+            g = self.granules[egid]
+            size = sizes.get(url)
+            if size is None:
+                queue.put(item)
+                numGranules += 1
+                continue
+
+            try:
+                sf = ECHOsegmentedFile(egid, url, filename, size, self.segmentMB * 1048576, g.getGranuleSizeMB(),
+                                       g.getChecksum())
+            except (IOError, OSError) as error:
+                EDClog.write("\tCouldn't preallocate {} ({}), downloading it in one piece\n".format(
+                    filename, error))
+                queue.put(item)
+                numGranules += 1
+                continue
+
+            self.segFiles[egid] = sf
+            EDClog.write("\tDownloading {} ({} bytes) in {} segments\n".format(egid, size, len(sf.segments)))
+            if sf.pending:
+                self.queueSegments(sf, queue)
+                numGranules += 1
             else:
-                EDClog.write("\tsinglelownload success: %s\n" % egid)
-                self.granuleStatus[egid] = 1
+                # Every segment was downloaded by an earlier run
+                self.granuleStatus[egid] = 1 if sf.complete() else -1
+                self.granuleDigest[egid] = sf.digest
+        return queue, numGranules
+
+    def queueSegments(self, sf, queue):
+        """
+        Queue the next segments of segmented file 'sf', keeping at most
+        'segmentConns' of them queued or in flight.  New segments go to the
+        end of the host's queue, so one large granule can't hold up the
+        granules queued behind it.
+        """
+        while sf.outstanding < self.segmentConns and not sf.failed:
+            index = sf.nextSegment()
+            if index is None:
+                break
+            sf.outstanding += 1
+            queue.put((sf.egid, sf.url, sf.filename, index))
+
+    def finishSegment(self, c, t, status, errno, queue, engine):
+        """
+        Handle a finished segment of a segmented granule: queue the next
+        segments, retry a failed one, and finish the granule once all of its
+        segments are in.  The partial file of a failed granule is kept, the
+        next run only downloads the missing segments.
+        :return: 1 (granule downloaded), -1 (granule failed) or 0 (segments left)
+        """
+        sf = t.segFile
+        if status == 1:
+            sf.segmentDone(t.index)
+        else:
+            delay = self.retryGranule(c, "{} segment {}".format(t.egid, t.index), errno)
+            if delay is not None:
+                # Only the probed URL is known to have this size and accept ranges
+                queue.retry((t.egid, sf.url, t.filename, t.index), delay)
+                return 0
+            sf.failed = True
+        sf.outstanding -= 1
+
+        self.queueSegments(sf, queue)
+        if sf.outstanding > 0:
+            return 0
+        if not sf.failed and sf.complete():
+            EDClog.write("\t%s success: %s\n" % (engine, t.egid))
+            self.granuleDigest[t.egid] = sf.digest
+            self.granuleStatus[t.egid] = 1
+            return 1
+
+        EDClog.write("\t%s failed: %s\n" % (engine, t.egid))
+        self.granuleStatus[t.egid] = -1
+        return -1
+
+    def startTransfers(self, m, queue, freelist, active, target):
+        """
+        Start transfers on the free curl objects of multi stack 'm', within
+        the concurrency 'target' and the per-host limits of 'queue'.  Small
+        granules (--race-mirrors) are raced from two mirrors, the segments
+        of large granules are started like any other transfer.  The rate
+        limit is then shared out again between all running transfers.
+        """
+        while freelist and len(active) < target:
+            item = queue.get()
+            if item is None:
+                break
+            egid, url, filename = item[:3]
+            segment = item[3] if len(item) > 3 else None
+            racer = None
+            if segment is None and len(freelist) > 1 and len(active) + 1 < target:
+                racer = self.raceMirror(egid, url, filename, queue)
+            race = ECHOrace() if racer is not None else None
+            c = freelist.pop()  # from the bottom
+            c.transfer = self.makeTransfer(c, egid, url, filename, race, segment=segment)
+            m.add_handle(c)
+            active.append(c)
+            if racer is not None:
+                EDClog.write("\tRacing {} from {} and {}\n".format(egid, queue.hostOf(url), queue.hostOf(racer)))
+                queue.started(racer)
+                self.tried[egid].add(racer)
+                # The racer writes its own partial file, always from byte zero
+                partname = filename + '.race.part'
+                if os.access(partname, os.F_OK):
+                    os.remove(partname)
+                c = freelist.pop()
+                c.transfer = self.makeTransfer(c, egid, racer, filename, race, partname)
+                m.add_handle(c)
+                active.append(c)
+        self.limitRate(active)
+
+    def finishTransfer(self, c, errno, errmsg, queue, engine):
+        """
+        Handle a finished transfer: record the outcome, and either fail the
+        granule over to its next mirror, requeue it for a retry or set its
+        final status.  The loser of a mirror race is just discarded.  The
+        finished transfers (but not race losers) are counted in 'numAttempts'
+        and 'numAttemptsFailed'.
+        :return: The granule status, 1 (downloaded), -1 (failed) or 0 if the
+                 granule isn't finished yet (requeued, more segments to go or
+                 the other transfer of a mirror race is still running)
+        """
+        t = c.transfer
+        queue.done(t.url)
+        race = t.race
+        if race is not None:
+            race.running -= 1
+            if race.winner is None and errno == 0:
+                # An empty file, finished without any data to win with
+                race.winner = t
+            if race.lost(t):
+                c.transfer = None
+                t.discard()
+                return 0
+
+        status = self.transferDone(c, errno, errmsg)
+        self.hostStats.record(t.url, c.getinfo(pycurl.SIZE_DOWNLOAD), c.getinfo(pycurl.TOTAL_TIME), status == 1)
+        self.numAttempts += 1
+        if status != 1:
+            self.numAttemptsFailed += 1
+        if isinstance(t, ECHOsegmentTransfer):
+            return self.finishSegment(c, t, status, errno, queue, engine)
+        if status == 1:
+            EDClog.write("\t%s success: %s\n" % (engine, t.egid))
+            self.granuleStatus[t.egid] = 1
+            return 1
+
+        if race is not None:
+            # Racing transfers never leave a partial file behind
+            t.discard()
+            if race.winner is None and race.running > 0:
+                return 0
+        elif t.offset > 0 and self.resumeRejected(c, errno):
+            # The partial file is gone, download the whole file straight away
+            EDClog.write("\tRestarting {} from byte 0\n".format(t.egid))
+            queue.retry((t.egid, t.url, t.filename), 0.0)
+            return 0
+
+        url = self.nextMirror(t.egid)
+        if url is not None:
+            EDClog.write("\tFailing {} over to {}\n".format(t.egid, queue.hostOf(url)))
+            queue.retry((t.egid, url, t.filename), 0.0)
+            return 0
+
+        delay = self.retryGranule(c, t.egid, errno)
+        if delay is not None:
+            # Every mirror gets tried again, best first
+            url = self.hostStats.rank(self.mirrors[t.egid])[0]
+            self.tried[t.egid] = set([url])
+            queue.retry((t.egid, url, t.filename), delay)
+            return 0
+
+        EDClog.write("\t%s failed: %s\n" % (engine, t.egid))
+        self.granuleStatus[t.egid] = -1
+        return -1
+
+    def singledownload(self):
+
+        # One transfer at a time, failovers and retries go through the queue
+        queue = self.makeQueue(1)[0]
+        while len(queue) > 0:
+            item = queue.get()
+            if item is None:
+                # Only retries waiting for their backoff to expire
+                time.sleep(queue.waitTime() or 0.0)
+                continue
+            egid, url, filename = item[:3]
+            c = self.makeCurl()
+            c.transfer = self.makeTransfer(c, egid, url, filename, segment=item[3] if len(item) > 3 else None)
+            self.limitRate([c])
+            errno, errmsg = 0, ""
+            try:
+                c.perform()
+            except pycurl.error as error:
+                errno, errmsg = error.args
+            self.finishTransfer(c, errno, errmsg, queue, "singledownload")
             c.close()
 
     def multidownload(self):
@@ -1496,87 +4321,187 @@ class ECHOdownloader(object):
         This code is based on the Python program 'retriever-multi.py' that
         is provided with the PyCurl documentation.
         """
-        concurrent_conns = 10
-        queue = self.granuleQueue[:]
-        num_urls = len(queue)
+        queue, num_urls = self.makeQueue(self.hostConns)
+
+        # The number of concurrent transfers is tuned while downloading by the
+        # adaptive concurrency controller, between the min. and max. number
+        # of connections
+        controller = ECHOconcurrency(self.minConns, self.maxConns)
+        completedBytes = 0
+        startTime = time.time()
 
         # Pre-allocate a list of curl objects
-        m = pycurl.CurlMulti()
+        m = self.makeMulti()
         m.handles = []
-        for i in range(concurrent_conns):
-            c = pycurl.Curl()
-            c.fp = None
-            c.setopt(pycurl.FOLLOWLOCATION, 1)
-            c.setopt(pycurl.MAXREDIRS, 5)
-            c.setopt(pycurl.CONNECTTIMEOUT, 30)
-            c.setopt(pycurl.TIMEOUT, 300)
-            c.setopt(pycurl.NOSIGNAL, 1)
-            m.handles.append(c)
+        for i in range(self.maxConns):
+            m.handles.append(self.makeCurl())
 
         freelist = m.handles[:]
+        active = []
         num_processed = 0
         while num_processed < num_urls:
-            # If there is an url to process and a free curl object, add to multi stack
-            while queue and freelist:
-                egid, url, filename = queue.pop(0)
-                c = freelist.pop()  # from the bottom
-                c.fp = open(filename, "wb")
-                c.setopt(pycurl.URL, url)
-                c.setopt(pycurl.WRITEDATA, c.fp)
-                m.add_handle(c)
-                # store some info
-                c.filename = filename
-                c.url = url
-                c.egid = egid
+            # If there is an url to process and a free curl object, add to multi
+            # stack, as long as we stay within the controller's concurrency target
+            # and the per-host limits of the download queue
+            self.startTransfers(m, queue, freelist, active, controller.getTarget())
             # Run the internal curl state machine for the multi stack
             while 1:
                 ret, num_handles = m.perform()
                 if ret != pycurl.E_CALL_MULTI_PERFORM:
                     break
-            # Check for curl objects which have terminated, and add them to the freelist
+            # Check for curl objects which have terminated, and add them to the freelist.
+            # Granules that failed with a transient error are requeued for a retry.
             while 1:
                 num_q, ok_list, err_list = m.info_read()
-                for c in ok_list:
-                    c.fp.close()
-                    c.fp = None
+                for c, errno, errmsg in [(c, 0, "") for c in ok_list] + err_list:
+                    completedBytes += c.getinfo(pycurl.SIZE_DOWNLOAD)
                     m.remove_handle(c)
-                    self.granuleStatus[c.egid] = 1
-                    EDClog.write("\tmultidownload success: %s\n" % c.egid)
+                    active.remove(c)
+                    status = self.finishTransfer(c, errno, errmsg, queue, "multidownload")
                     freelist.append(c)
-                for c, errno, errmsg in err_list:
-                    c.fp.close()
-                    c.fp = None
+                    if status != 0:
+                        num_processed += 1
+                if num_q == 0:
+                    break
+            # Currently no more I/O is pending.  Let the concurrency controller
+            # look at the aggregate throughput and error rate (bytes of transfers
+            # still running are included), then call select() to sleep until
+            # some more data is available.
+            totalBytes = completedBytes + sum(c.getinfo(pycurl.SIZE_DOWNLOAD) for c in active)
+            controller.update(totalBytes, self.numAttempts, self.numAttemptsFailed, len(queue) > 0)
+            if self.metrics.due():
+                self.setMetrics(totalBytes, time.time() - startTime, len(active), len(queue))
+                self.metrics.write()
+            if active:
+                m.select(1.0)
+            elif num_processed < num_urls:
+                # Only retries waiting for their backoff to expire
+                time.sleep(min(1.0, queue.waitTime() or 0.0))
+
+        self.setMetrics(completedBytes, time.time() - startTime, 0, 0)
+
+        # Cleanup
+        for c in m.handles:
+            if c.transfer is not None:
+                c.transfer.close()
+                c.transfer = None
+            c.close()
+
+        m.close()
+
+    def socketdownload(self):
+        """
+        Event driven version of 'multidownload'.  Instead of polling the multi
+        stack once a second, libcurl tells us (M_SOCKETFUNCTION) which sockets
+        to watch and (M_TIMERFUNCTION) when it next needs to run, and an
+        ECHOeventLoop calls 'socket_action' as soon as a socket is ready.
+        Finished transfers are handled, and their curl objects refilled from
+        the queue, right after the event that finished them.
+        """
+        loop = ECHOeventLoop()
+        queue, num_urls = self.makeQueue(self.hostConns)
+        controller = ECHOconcurrency(self.minConns, self.maxConns)
+        m = self.makeMulti()
+        m.handles = [self.makeCurl() for i in range(self.maxConns)]
+        freelist = m.handles[:]
+        active = []
+        state = {'processed': 0, 'bytes': 0, 'timer': None}
+        startTime = time.time()
+
+        def fill():
+            # Start transfers while there are free curl objects, within the
+            # controller's concurrency target and the per-host limits
+            self.startTransfers(m, queue, freelist, active, controller.getTarget())
+
+        def finished():
+            while 1:
+                num_q, ok_list, err_list = m.info_read()
+                for c, errno, errmsg in [(c, 0, "") for c in ok_list] + err_list:
+                    state['bytes'] += c.getinfo(pycurl.SIZE_DOWNLOAD)
                     m.remove_handle(c)
-                    self.granuleStatus[c.egid] = -1
-                    #
-                    # Perhaps this is where we should remove the empty
-                    # local file?
-                    #
-                    EDClog.write("\tmultidownload failed: %s\n" % c.egid)
+                    active.remove(c)
+                    status = self.finishTransfer(c, errno, errmsg, queue, "socketdownload")
                     freelist.append(c)
-                num_processed = num_processed + len(ok_list) + len(err_list)
+                    if status == 0:
+                        # Start any retry as soon as its backoff expires
+                        wait = queue.waitTime()
+                        if wait is not None:
+                            loop.callLater(wait, fill)
+                    else:
+                        state['processed'] += 1
                 if num_q == 0:
                     break
-            # Currently no more I/O is pending, could do something in the meantime
-            # (display a progress bar, etc.).
-            # We just call select() to sleep until some more data is available.
-            m.select(1.0)
+            fill()
+
+        def socketAction(fd, events):
+            while 1:
+                ret, num_handles = m.socket_action(fd, events)
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            finished()
+
+        def onSocket(fd, readable, writable, error):
+            events = 0
+            if readable:
+                events |= pycurl.CSELECT_IN
+            if writable:
+                events |= pycurl.CSELECT_OUT
+            if error:
+                events |= pycurl.CSELECT_ERR
+            socketAction(fd, events)
+
+        def curlSocket(what, fd, multi, socketp):
+            if what == pycurl.POLL_REMOVE:
+                loop.unwatch(fd)
+            else:
+                loop.watch(fd, what in (pycurl.POLL_IN, pycurl.POLL_INOUT),
+                           what in (pycurl.POLL_OUT, pycurl.POLL_INOUT), onSocket)
+
+        def curlTimer(timeoutMs):
+            # Called by libcurl from inside add_handle/socket_action, so only
+            # schedule the timeout here, never run it
+            if state['timer'] is not None:
+                loop.cancel(state['timer'])
+                state['timer'] = None
+            if timeoutMs >= 0:
+                state['timer'] = loop.callLater(timeoutMs / 1000.0, socketAction, pycurl.SOCKET_TIMEOUT, 0)
+
+        def periodic():
+            totalBytes = state['bytes'] + sum(c.getinfo(pycurl.SIZE_DOWNLOAD) for c in active)
+            controller.update(totalBytes, self.numAttempts, self.numAttemptsFailed, len(queue) > 0)
+            if self.metrics.due():
+                self.setMetrics(totalBytes, time.time() - startTime, len(active), len(queue))
+                self.metrics.write()
+            fill()
+            loop.callLater(1.0, periodic)
+
+        m.setopt(pycurl.M_SOCKETFUNCTION, curlSocket)
+        m.setopt(pycurl.M_TIMERFUNCTION, curlTimer)
+        fill()
+        loop.callLater(1.0, periodic)
+        while state['processed'] < num_urls:
+            loop.runOnce(1.0)
+
+        self.setMetrics(state['bytes'], time.time() - startTime, 0, 0)
 
         # Cleanup
         for c in m.handles:
-            if c.fp is not None:
-                c.fp.close()
-                c.fp = None
+            if c.transfer is not None:
+                c.transfer.close()
+                c.transfer = None
             c.close()
 
         m.close()
+        loop.close()
 
     def cleanup(self, ero):
         """
         :param: 'ero' - ECHO Request Object containing collections and granules
         Wade through all of the granules, in all collections.  If a
         download attempt was made, but failed (granule 'downloadStatus'
-        set to -1), look for the local file and if it exists, delete it
+        set to -1), make sure no local file is left under the final name.
+        The partial '.part' file is kept, so that a later attempt (from the
+        pending download file) can resume the transfer.
         """
         EDClog.write("ECHOdownloader::cleanup\n")
         for c in ero.collContainer:
@@ -1590,16 +4515,40 @@ class ECHOdownloader(object):
                     else:
                         EDClog.write("\t***INFO: Download of granule {} failed\n".format(g.egid))
                         EDClog.write("\tRemoved local file {}\n".format(g.getLocalFileName()))
+                if g.getDownloadStatus() == -1 and os.access(g.getLocalFileName() + '.part', os.F_OK):
+                    EDClog.write("\t***INFO: Keeping partial file {}.part for resume\n".format(g.getLocalFileName()))
 
 
 class ECHOdbHandler(object):
+    # Max. number of values in a single 'in (...)' lookup query
+    dbChunkSize = 500
+
+    # Parameterized insert statements, used for both single row and bulk inserts
+    collInsertSQL = ("insert into collections (collID,shortName,archCenter,collDesc,begDateTime,endDateTime,doi)"
+                     " values (%s,%s,%s,%s,%s,%s,%s)")
+    granInsertSQL = ("insert into granules (granID,collID,granuleUR,begDateTime,endDateTime,"
+                     "hasPolyPoints,w_bound,s_bound,e_bound,n_bound,localFileName,checksum)"
+                     " values (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)")
+    # Without the 'checksum' column, on a DB that hasn't been migrated yet
+    granInsertNoChecksumSQL = ("insert into granules (granID,collID,granuleUR,begDateTime,endDateTime,"
+                               "hasPolyPoints,w_bound,s_bound,e_bound,n_bound,localFileName)"
+                               " values (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)")
+    checksumMigration = "alter table granules add column checksum varchar(160) null;"
+    polyInsertSQL = "insert into polypoints (granID,latitude,longitude) values (%s,%s,%s)"
+
     def __init__(self, user, dbname, host):
         self.username = user
         self.database = dbname
         self.dbhost = host
+        self.rowsInserted = 0  # rows committed during this run
+        self.hasChecksum = True  # granules table has the 'checksum' column
 
         if not self.makeDBconnect():
             raise SystemExit
+        self.checkChecksumColumn()
+
+    def getRowsInserted(self):
+        return self.rowsInserted
 
     def makeDBconnect(self):
         try:
@@ -1614,9 +4563,27 @@ class ECHOdbHandler(object):
             self.dbCursor = self.dbHook.cursor()
             return True
 
-    def makeDBquery(self, queryStr):
+    def checkChecksumColumn(self):
+        """
+        Granule digests are only inserted if the granules table has the
+        'checksum' column, older DBs get the granules without them
+        """
+        qResults = self.makeDBquery("show columns from granules like 'checksum'")
+        if qResults is None or len(qResults) > 0:
+            return
+        self.hasChecksum = False
+        self.granInsertSQL = self.granInsertNoChecksumSQL
+        EDClog.write("ECHOdbHandler::checkChecksumColumn\n")
+        EDClog.write("\t***WARNING: The granules table has no 'checksum' column, granule digests aren't stored.\n")
+        EDClog.write("\tAdd it with: {}\n".format(self.checksumMigration))
+
+    def makeDBquery(self, queryStr, params=None):
+        """
+        :param queryStr: The SQL query string, with '%s' placeholders if 'params' is given
+        :param params: Optional sequence of query parameters (escaped by MySQLdb)
+        """
         try:
-            self.dbCursor.execute(queryStr)
+            self.dbCursor.execute(queryStr, params)
         except MySQLdb.Error as error:
             EDClog.write("ECHOdbHandler::makeDBquery\n")
             EDClog.write("\t***ERROR: DB Query Error: {}\n".format(error))
@@ -1625,13 +4592,30 @@ class ECHOdbHandler(object):
             # Return all query results, None if empty set
             return self.dbCursor.fetchall()
 
-    def makeDBinsert(self, sqlStr):
+    def findGranules(self, granIDs):
+        """
+        :param granIDs: List of granule IDs
+        :return: Set of the granule IDs that are already in the granules table.
+                 The lookup is done 'dbChunkSize' IDs at a time, a failed chunk
+                 query counts its granules as not in the DB.
+        """
+        found = set()
+        for i in range(0, len(granIDs), self.dbChunkSize):
+            chunk = granIDs[i:i + self.dbChunkSize]
+            qStr = "select granID from granules where granID in ({})".format(','.join(['%s'] * len(chunk)))
+            qResults = self.makeDBquery(qStr, chunk)
+            if qResults:
+                found.update(row[0] for row in qResults)
+        return found
+
+    def makeDBinsert(self, sqlStr, params=None):
         """
-        :param sqlStr: The SQL insert string
+        :param sqlStr: The SQL insert string, with '%s' placeholders if 'params' is given
+        :param params: Optional sequence of insert parameters (escaped by MySQLdb)
         :return: True on success, False on failure
         """
         try:
-            self.dbCursor.execute(sqlStr)
+            self.dbCursor.execute(sqlStr, params)
         except MySQLdb.Error as error:
             EDClog.write("ECHOdbHandler::makdeDBinsert\n")
             EDClog.write("\t***ERROR: DB Insert Error: {}\n".format(error))
@@ -1639,36 +4623,45 @@ class ECHOdbHandler(object):
             return False
         else:
             self.dbHook.commit()
+            self.rowsInserted += 1
             return True
 
+    def dbDateTime(self, dtStr):
+        """
+        :param dtStr: ECHO datetime string, "null" if there was none
+        :return: DB insert parameter for the datetime (None is inserted as NULL)
+        """
+        if dtStr == "null":
+            return None
+        return dtStr
+
+    def collectionRow(self, c):
+        return (c.getid(), c.getshortname(), c.getarchcenter(), c.getdesc(),
+                self.dbDateTime(c.getbegdate()), self.dbDateTime(c.getenddate()), c.getdoi())
+
+    def granuleRow(self, g, cid):
+        if g.getPolyPointStatus():
+            ppf = 1
+        else:
+            ppf = 0
+
+        row = (g.getgranuleid(), cid, g.getgranuleur(),
+               self.dbDateTime(g.getgranulebd()), self.dbDateTime(g.getgranuleed()), ppf,
+               g.getgranulewb(), g.getgranulesb(), g.getgranuleeb(), g.getgranulenb(),
+               g.getLocalFileName())
+        if self.hasChecksum:
+            row += (g.getDigest(),)
+        return row
+
     def collectionInsert(self, c):
         """
         :param c: The collection object
         :return: True on success, False on failure
         """
         cid = c.getid()
-        csn = c.getshortname()
-        cac = c.getarchcenter()
-        cde = c.getdesc()
-        cbd = c.getbegdate()
-        ced = c.getenddate()
-        doi = c.getdoi()
 
         EDClog.write("ECHOdbHandler::collectionInsert\n")
-        qStr = "insert into collections (collID,shortName,archCenter,collDesc,begDateTime,endDateTime,doi)"
-        if cbd == "null":
-            cbdstr = "convert(null, datetime)"
-        else:
-            cbdstr = "convert('" + cbd + "',datetime)"
-        if ced == "null":
-            cedstr = "convert(null, datetime)"
-        else:
-            cedstr = "convert('" + ced + "',datetime)"
-
-        qStr += " values('" + cid + "','" + csn + "','" + cac + \
-                "','" + cde + "'," + cbdstr + ", " + cedstr + ", '" + doi + "');"
-
-        if not self.makeDBinsert(qStr):
+        if not self.makeDBinsert(self.collInsertSQL, self.collectionRow(c)):
             EDClog.write("\tDB Insertion failure for collection {}\n".format(cid))
             return False
 
@@ -1681,41 +4674,10 @@ class ECHOdbHandler(object):
         :param cid: The collection object id that owns the granule to insert
         :return: True on success, False on failure
         """
-        if g.getPolyPointStatus():
-            ppf = 1
-        else:
-            ppf = 0
-
         gid = g.getgranuleid()
-        gur = g.getgranuleur()
-        gbd = g.getgranulebd()
-        ged = g.getgranuleed()
-        gwb = g.getgranulewb()
-        gsb = g.getgranulesb()
-        geb = g.getgranuleeb()
-        gnb = g.getgranulenb()
-        glf = g.getLocalFileName()
 
         EDClog.write("ECHOdbHandler::granuleInsert\n")
-        qStr = "insert into granules (granID,collID,granuleUR,begDateTime,endDateTime,"
-        qStr += "hasPolyPoints,w_bound,s_bound,e_bound,n_bound,localFileName)"
-
-        if gbd == "null":
-            gbdstr = "convert(null, datetime)"
-        else:
-            gbdstr = "convert('" + gbd + "',datetime)"
-        if ged == "null":
-            gedstr = "convert(null, datetime)"
-        else:
-            gedstr = "convert('" + ged + "',datetime)"
-
-        qStr = qStr + " values('" + gid + "','" + cid + "','" + gur + \
-               "'," + gbdstr + ", " + gedstr + ", '" + \
-               str(ppf) + "'," + \
-               "'" + str(gwb) + \
-               "','" + str(gsb) + "','" + str(geb) + "','" + str(gnb) + \
-               "','" + glf + "');"
-        if not self.makeDBinsert(qStr):
+        if not self.makeDBinsert(self.granInsertSQL, self.granuleRow(g, cid)):
             EDClog.write("\tDB Insertion failure for granule {}\n".format(gid))
             return False
 
@@ -1730,9 +4692,7 @@ class ECHOdbHandler(object):
         :return: True on success, False on failure
         """
         EDClog.write("ECHOdbHandler::polypointInsert\n")
-        qStr = "insert into polypoints (granID,latitude,longitude)"
-        qStr += " values('" + gid + "','" + str(lat) + "','" + str(lon) + "');"
-        if not self.makeDBinsert(qStr):
+        if not self.makeDBinsert(self.polyInsertSQL, (gid, lat, lon)):
             EDClog.write("\tDB polyPoint insertion failure for granule {}\n".format(gid))
             return False
 
@@ -1742,52 +4702,117 @@ class ECHOdbHandler(object):
     def update(self, ero):
         """
         :param ero: The ECHO Request Object containing collections and granules
+
+        Each collection (and its downloaded granules and their polypoints) is
+        written in a single transaction using one 'executemany' batch per
+        table.  If the transaction fails it is rolled back and the collection
+        is written again one row at a time ('rowUpdate'), which finds the rows
+        that actually fail and flags them as pending DB transactions.
         """
         for c in ero.collContainer:
-            cid = c.getid()
-            processGranules = False
             if c.getNumGranules() > 0:
                 # If there is at least 1 granule for the collection we can do the
                 # DB check
-                processGranules = True
-                qStr = "select shortName from collections where collID = '{}'".format(cid)
-                qResults = self.makeDBquery(qStr)
-                if not qResults:
-                    # Collection not already in DB, try to add it
-                    if not self.collectionInsert(c):
-                        # Collection insert failed, thus all granules and
-                        # granule polypoints become pending DB transactions as well
-                        c.setInsertFailed(True)
-                        processGranules = False
-                        for g in c.granContainer:
-                            g.setInsertFailed(True)
-                            for pp in g.polyPoints:
-                                pp.setInsertFailed(True)
-
-            if processGranules:
-                for g in c.granContainer:
+                if not self.bulkUpdate(c):
+                    EDClog.write("ECHOdbHandler::update\n")
+                    EDClog.write("\tBulk insert failed for collection {}, inserting row by row\n".format(c.getid()))
+                    self.rowUpdate(c)
+
+    def bulkUpdate(self, c):
+        """
+        :param c: The collection object
+        :return: True if the whole collection was committed, False if the
+                 transaction failed and was rolled back
+        """
+        cid = c.getid()
+        qStr = "select shortName from collections where collID = %s"
+        qResults = self.makeDBquery(qStr, (cid,))
+
+        # successful downloads only, note that we don't have to check if the
+        # granule is already in the DB, because the ECHOdownloader did
+        # that check prior to adding the granule to the download queue.
+        granRows = []
+        polyRows = []
+        for g in c.granContainer:
+            if g.getDownloadStatus() == 1:
+                granRows.append(self.granuleRow(g, cid))
+                if g.getPolyPointStatus():
                     gid = g.getgranuleid()
-                    processPolyPoints = False
-                    if g.getDownloadStatus() == 1:
-                        # successful download, note that we don't have to check if the
-                        # granule is already in the DB, because the ECHOdownloader did
-                        # that check prior to adding the granule to the download queue.
-                        processPolyPoints = True
-                        if not self.granuleInsert(g, cid):
-                            # Granule insert failed, thus all polypoints become
-                            # pending DB transactions as well
-                            g.setInsertFailed(True)
-                            processPolyPoints = False
-                            for pp in g.polyPoints:
-                                pp.setInsertFailed(True)
-
-                    if processPolyPoints and g.getPolyPointStatus():
+                    for pp in g.polyPoints:
+                        polyRows.append((gid, pp.getLatitude(), pp.getLongitude()))
+
+        EDClog.write("ECHOdbHandler::bulkUpdate\n")
+        try:
+            if not qResults:
+                # Collection not already in DB, add it
+                self.dbCursor.execute(self.collInsertSQL, self.collectionRow(c))
+            if granRows:
+                self.dbCursor.executemany(self.granInsertSQL, granRows)
+            if polyRows:
+                self.dbCursor.executemany(self.polyInsertSQL, polyRows)
+        except MySQLdb.Error as error:
+            EDClog.write("\t***ERROR: DB Insert Error: {}\n".format(error))
+            self.dbHook.rollback()
+            return False
+
+        try:
+            self.dbHook.commit()
+        except MySQLdb.Error as error:
+            EDClog.write("\t***ERROR: DB Commit Error: {}\n".format(error))
+            self.dbHook.rollback()
+            return False
+
+        EDClog.write("\tDB Insertion success for collection {} ({} granules, {} polyPoints)\n".format(
+            cid, len(granRows), len(polyRows)))
+        self.rowsInserted += len(granRows) + len(polyRows) + (0 if qResults else 1)
+        return True
+
+    def rowUpdate(self, c):
+        """
+        :param c: The collection object
+        Insert the collection, its downloaded granules and their polypoints one
+        row (and one commit) at a time, flagging each failed row
+        """
+        cid = c.getid()
+        processGranules = True
+        qStr = "select shortName from collections where collID = %s"
+        qResults = self.makeDBquery(qStr, (cid,))
+        if not qResults:
+            # Collection not already in DB, try to add it
+            if not self.collectionInsert(c):
+                # Collection insert failed, thus all granules and
+                # granule polypoints become pending DB transactions as well
+                c.setInsertFailed(True)
+                processGranules = False
+                for g in c.granContainer:
+                    g.setInsertFailed(True)
+                    for pp in g.polyPoints:
+                        pp.setInsertFailed(True)
+
+        if processGranules:
+            for g in c.granContainer:
+                gid = g.getgranuleid()
+                processPolyPoints = False
+                if g.getDownloadStatus() == 1:
+                    # successful download, note that we don't have to check if the
+                    # granule is already in the DB, because the ECHOdownloader did
+                    # that check prior to adding the granule to the download queue.
+                    processPolyPoints = True
+                    if not self.granuleInsert(g, cid):
+                        # Granule insert failed, thus all polypoints become
+                        # pending DB transactions as well
+                        g.setInsertFailed(True)
+                        processPolyPoints = False
                         for pp in g.polyPoints:
-                            lat = pp.getLatitude()
-                            lon = pp.getLongitude()
-                            if not self.polypointInsert(gid, lat, lon):
-                                # Individual PolyPoint record insert failed
-                                pp.setInsertFailed(True)
+                            pp.setInsertFailed(True)
+
+                if processPolyPoints and g.getPolyPointStatus():
+                    for pp in g.polyPoints:
+                        lat = pp.getLatitude()
+                        lon = pp.getLongitude()
+                        if not self.polypointInsert(gid, lat, lon):
+                            # Individual PolyPoint record insert failed
+                            pp.setInsertFailed(True)
 
 
 class ECHOptxHandler(object):
@@ -1804,6 +4829,7 @@ class ECHOptxHandler(object):
         self.processC = False
         self.processG = False
         self.processP = False
+        self.numPendingTx = 0  # records saved as pending transactions by this run
 
     def havePending(self):
         # If any of the pending transaction files exist, we have pending
@@ -1896,7 +4922,9 @@ class ECHOptxHandler(object):
         elif ttype == 'G':
             xmltag = "granule"
             fields = ['granID', 'collID', 'granuleUR', 'sizeMB', 'begDateTime', 'endDateTime', 'hasPolyPoints',
-                      'w_bound', 's_bound', 'e_bound', 'n_bound', 'localFileName']
+                      'w_bound', 's_bound', 'e_bound', 'n_bound', 'localFileName', 'checksum']
+            if not self.dbHandle.hasChecksum:
+                fields.remove('checksum')
         elif ttype == 'P':
             xmltag = "polypoint"
             fields = ['granID', 'latitude', 'longitude']
@@ -1931,7 +4959,13 @@ class ECHOptxHandler(object):
             values = []
             n = 0
             for f in fields:
-                values.append(transaction.find(f).text)
+                # Fields missing from older pending files (or left empty) are
+                # inserted as NULL
+                fElem = transaction.find(f)
+                if fElem is None:
+                    values.append(None)
+                else:
+                    values.append(fElem.text)
                 fStr += f
                 if n < (len(fields) - 1):
                     fStr += ','
@@ -1943,7 +4977,9 @@ class ECHOptxHandler(object):
             n = 0
             vStr = " values("
             for v in values:
-                if fields[n] == "begDateTime" or fields[n] == "endDateTime":
+                if v is None:
+                    tStr = "null"
+                elif fields[n] == "begDateTime" or fields[n] == "endDateTime":
                     if v == 'null':
                         tStr = "convert(null,datetime)"
                     else:
@@ -1983,6 +5019,9 @@ class ECHOptxHandler(object):
                 # the transaction file in the event of a database insert error
                 pendRoot.remove(transaction)
 
+    def getNumPendingTx(self):
+        return self.numPendingTx
+
     def savePendTx(self, ero):
         """
         :param ero: ECHO Request Object containing all collections, granules
@@ -2005,6 +5044,8 @@ class ECHOptxHandler(object):
                     if p.getInsertFailed():
                         self.makePelement(p, gid, pxmlroot)
 
+        self.numPendingTx = len(cxmlroot) + len(gxmlroot) + len(pxmlroot)
+
         if len(cxmlroot) > 0:
             self.writePendingTx(self.cpf, cxmlroot)
 
@@ -2075,6 +5116,8 @@ class ECHOptxHandler(object):
         nbelement.text = str(gobj.getgranulenb())
         lfelement = ET.SubElement(ge, 'localFileName')
         lfelement.text = gobj.getLocalFileName()
+        ckelement = ET.SubElement(ge, 'checksum')
+        ckelement.text = gobj.getDigest()
 
     def makePelement(self, pobj, gid, proot):
         pe = ET.SubElement(proot, "polypoint")
@@ -2091,6 +5134,10 @@ if __name__ == '__main__':
     runMgr = runManager()
     EDClog = runMgr.getLogFH()
 
+    # Wall clock/CPU timers (and optional profiling) for each run phase
+    phaseTimer = runMgr.getPhaseTimer()
+    metrics = runMgr.getMetrics()
+
     # The request object is used to manage request information and
     # retrieved information.
     echoReqObj = ECHOrequest(runMgr)
@@ -2128,19 +5175,24 @@ if __name__ == '__main__':
             ptxObj.openPending()
             # If any db transaction problems occur in 'processPending' EDClient
             # will terminate itself
-            ptxObj.processPending()
+            phaseTimer.run("pendingTx", ptxObj.processPending)
 
     #############################################################################
 
     # Make ECHO client object to manage communication with web service
-    echoClient = ECHOclient(runMgr.getMaxFiles())
+    echoClient = phaseTimer.run("login", ECHOclient, runMgr.getMaxFiles(), runMgr.getPoolSize(),
+                                runMgr.getTimeouts(), runMgr.getNumRetries(),
+                                runMgr.getQueryWorkers(), runMgr.getResponseCache(),
+                                *runMgr.getTokenCache(), serviceurl=runMgr.getEchoURL())
 
     # Get collection and granule information from ECHO
-    echoReqObj.getReqData(echoClient)
+    phaseTimer.run("query", echoReqObj.getReqData, echoClient)
 
     # Collection and granule information for the user's request
     # has been stored, close the client connection to the web service
-    echoClient.logout()
+    phaseTimer.run("logout", echoClient.logout)
+    metrics.set("edclient_granules_queried", "gauge", "Granules returned by the ECHO queries",
+                sum(c.getNumGranules() for c in echoReqObj.collContainer))
 
     # Is download requested, or just information query?
     if runMgr.getopMode() == 'D':
@@ -2155,7 +5207,7 @@ if __name__ == '__main__':
         # pending file downloads
         if echoReqObj.getDBflag() == "True":
             if echoReqObj.getHavePendDwnld():
-                echoReqObj.loadPendDwnld()
+                phaseTimer.run("pendingDownloads", echoReqObj.loadPendDwnld)
                 echoReqObj.zapPending()
 
         # v1.2.0 Downloader ONLY needs the DB handle object for
@@ -2163,21 +5215,31 @@ if __name__ == '__main__':
         # granule has already been downloaded, IF AND ONLY IF this
         # is a useDB=True request.  The downloader will only use
         # the DB check if the request object DB flag is set true
-        edloader = ECHOdownloader(echoReqObj, edbhand)
-        edloader.downloadGranules(echoReqObj)
+        edloader = ECHOdownloader(echoReqObj, edbhand, runMgr)
+        phaseTimer.run("download", edloader.downloadGranules, echoReqObj)
         # Remove (cleanup) any partial file downloads
-        edloader.cleanup(echoReqObj)
+        phaseTimer.run("cleanup", edloader.cleanup, echoReqObj)
 
         # v1.2.0 Only save pending file downloads and update local
         # database with new collection and granule information, and
         # save any DB transaction failures IF AND ONLY IF this was
         # a useDB=True request
         if echoReqObj.getDBflag() == "True":
-            echoReqObj.savePending()  # file downloads
-            edbhand.update(echoReqObj)
-            ptxObj.savePendTx(echoReqObj)
+            phaseTimer.run("savePending", echoReqObj.savePending)  # file downloads
+            phaseTimer.run("dbUpdate", edbhand.update, echoReqObj)
+            phaseTimer.run("savePendTx", ptxObj.savePendTx, echoReqObj)
+            metrics.set("edclient_last_run_db_rows_inserted", "gauge",
+                        "Rows inserted into the 'echo' DB in the last run", edbhand.getRowsInserted())
+            metrics.set("edclient_pending_tx_backlog", "gauge", "Records saved as pending DB transactions",
+                        ptxObj.getNumPendingTx())
 
     else:  # Query ECHO only
         for i in range(echoReqObj.numCollections):
             echoReqObj.collContainer[i].showCollectionInfo()
             echoReqObj.collContainer[i].showGranuleInfo()
+
+    phaseTimer.close()
+    for phase, seconds in sorted(phaseTimer.getDurations().items()):
+        metrics.set("edclient_phase_duration_seconds", "gauge", "Wall clock duration of each run phase",
+                    seconds, [("phase", phase)])
+    metrics.write()
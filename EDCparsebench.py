@@ -0,0 +1,276 @@
+"""
+   Python Module: 'EDCparsebench' (ECHO Data Client parsing benchmarks)
+   Atmospheric Sciences Research Center
+   Python Env   : Anaconda Python (2.7.10)
+
+   Micro-benchmarks for the XML handling of EDClient.  Synthetic ECHO10
+   granule query responses (see EDCbench.makeGranuleXML) of a configurable
+   number of granules and GPolygon points per granule are run through:
+
+        getGranules   - lxml parse of the response plus ECHOcollection.getGranules
+        savePending   - ECHOrequest.savePending, with every granule pending
+        loadPendDwnld - ECHOrequest.loadPendDwnld of the file savePending wrote
+
+   For each case the best wall clock and CPU time of '--repeat' runs and the
+   objects (granules and polypoints) built per second are reported, and
+   saved as JSON for comparison.  Each method of each case (granule and
+   point count) runs in a forked child process of its own, which builds the
+   method's input first.  The growth of the child's peak resident set size
+   over the timed runs is reported as the peak memory of the method.
+   Unlike a Python heap tracer this includes the libxml2 memory of the
+   parsed trees.
+
+   Example:
+
+        python EDCparsebench.py --granules 1000,10000,100000 --points 0,32
+"""
+import os
+import sys
+import argparse
+import gc
+import json
+import math
+import platform
+import shutil
+import tempfile
+import time
+import datetime as dt
+
+import lxml.etree as ET
+import EDClient
+import EDCbench
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def cpuTime():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def peakRSSMB():
+    """
+    :return: Peak resident set size of the process in MegaBytes (since the
+             last 'resetPeakRSS' where that works), None if unknown
+    """
+    try:
+        with open('/proc/self/status', 'r') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, ValueError):
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def resetPeakRSS():
+    """
+    Reset the peak resident set size to the current one (Linux 4.0 and
+    later).  Elsewhere the peak of building the input stays, and memory
+    measured against it is a lower bound.
+    :return: The peak resident set size to measure from, None if unknown
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except IOError:
+        pass
+    return peakRSSMB()
+
+
+def measure(func, repeat):
+    """
+    Run 'func' 'repeat' times
+    :return: (best wall seconds, best CPU seconds, last result)
+    """
+    bestWall = bestCPU = None
+    result = None
+    for i in range(repeat):
+        # Don't keep the previous result alive during the next run
+        result = None
+        gc.collect()
+        wallStart = time.time()
+        cpuStart = cpuTime()
+        result = func()
+        wall = time.time() - wallStart
+        cpu = cpuTime() - cpuStart
+        bestWall = wall if bestWall is None else min(bestWall, wall)
+        bestCPU = cpu if bestCPU is None else min(bestCPU, cpu)
+    return bestWall, bestCPU, result
+
+
+def runForked(func, *args):
+    """
+    Run func(*args) in a forked child process, so its memory use is not
+    mixed up with that of other runs (in-process where there is no fork)
+    :return: func's result, which must be JSON serializable
+    """
+    if not hasattr(os, 'fork'):
+        return func(*args)
+
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        status = 0
+        try:
+            payload = {'result': func(*args)}
+        except BaseException as error:
+            payload = {'error': repr(error)}
+            status = 1
+        with os.fdopen(wfd, 'w') as fh:
+            json.dump(payload, fh)
+        os._exit(status)
+
+    os.close(wfd)
+    with os.fdopen(rfd, 'r') as fh:
+        data = fh.read()
+    os.waitpid(pid, 0)
+    payload = json.loads(data) if data else {'error': "child process died"}
+    if 'error' in payload:
+        raise RuntimeError("Benchmark case failed: " + payload['error'])
+    return payload['result']
+
+
+# In this order, loadPendDwnld reads the file savePending writes
+methods = ('getGranules', 'savePending', 'loadPendDwnld')
+
+
+def makeResponse(collID, numGranules, numPoints):
+    """
+    :return: A synthetic ECHO10 granule query response (bytes)
+    """
+    fileSize = 1048576
+    digest = EDCbench.fileDigest(fileSize)
+    results = []
+    for index in range(numGranules):
+        fileURL = "http://127.0.0.1/files/{}/{}_{:06d}.hdf".format(fileSize, collID, index)
+        results.append(EDCbench.makeGranuleXML(collID, index, fileURL, fileSize, digest, numPoints))
+    return ("<results>" + "".join(results) + "</results>").encode('utf-8')
+
+
+def makeCollection(collID):
+    return EDClient.ECHOcollection(collID, "BENCH0", "EDCBENCH", "EDCbench synthetic collection",
+                                   "2007-01-01T00:00:00", "2007-12-31T23:59:59", "NoDOIauth/NoDOI")
+
+
+def runMethod(method, reqFile, numGranules, numPoints, repeat):
+    """
+    Benchmark one method: build its input, then time 'repeat' runs of it.
+    loadPendDwnld reads the pending download file left by savePending.
+    :return: Result dictionary
+    """
+    collID = "C-BENCH0"
+    response = makeResponse(collID, numGranules, numPoints)
+    responseMB = len(response) / math.pow(1024, 2)
+    numObjects = numGranules * (1 + numPoints)
+    runMgr = EDClient.runManager([reqFile])
+    EDClient.EDClog = runMgr.getLogFH()
+
+    if method == 'getGranules':
+        def func():
+            collection = makeCollection(collID)
+            collection.getGranules(ET.fromstring(response))
+            return collection
+    elif method == 'savePending':
+        # Every granule failed to download, so every granule is saved as pending
+        collection = makeCollection(collID)
+        collection.getGranules(ET.fromstring(response))
+        for g in collection.granContainer:
+            g.setDownloadStatus(-1)
+            g.setLocalFileName("/tmp/EDCbench/" + os.path.basename(g.accessURLs[0][0]))
+        collection.setFailedStatus(True)
+        ero = EDClient.ECHOrequest(runMgr)
+        ero.collContainer = [collection]
+        ero.numCollections = 1
+
+        def func():
+            ero.savePending()
+            ero.pdlFH.close()
+    else:
+        ero = EDClient.ECHOrequest(runMgr)
+
+        def func():
+            ero.pdlFH = open(ero.pdlfile, 'r')
+            ero.collContainer = []
+            ero.numCollections = 0
+            ero.loadPendDwnld()
+    response = None
+
+    gc.collect()
+    baseline = resetPeakRSS()
+    wall, cpu = measure(func, repeat)[:2]
+    peak = peakRSSMB()
+    runMgr.getLogFH().close()
+    return {'method': method,
+            'granules': numGranules,
+            'points': numPoints,
+            'response_MB': responseMB,
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'objects_per_second': numObjects / max(wall, 1e-9),
+            'max_rss_MB': None if baseline is None else peak - baseline}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EDClient XML parsing micro-benchmarks")
+    parser.add_argument("--granules", help="Comma separated granule counts (Default=1000,10000)", type=str,
+                        default="1000,10000")
+    parser.add_argument("--points", help="Comma separated GPolygon points per granule, 0 for bounding "
+                        "rectangles (Default=0,16)", type=str, default="0,16")
+    parser.add_argument("--repeat", help="Timed runs per case, the best is reported (Default=3)", type=int,
+                        default=3)
+    parser.add_argument("--output", help="JSON results file (Default=EDCparsebench_<timestamp>.json)",
+                        type=str, default=None)
+    args = parser.parse_args()
+
+    try:
+        granuleCounts = [int(n) for n in args.granules.split(',') if n]
+        pointCounts = [int(n) for n in args.points.split(',') if n]
+    except ValueError:
+        parser.error("--granules and --points must be comma separated integers")
+
+    stamp = dt.datetime.now().replace(microsecond=0).isoformat('T').replace('-', '_').replace(':', '_')
+    output = os.path.abspath(args.output or "EDCparsebench_" + stamp + ".json")
+
+    workDir = tempfile.mkdtemp(prefix="edcparsebench")
+    startDir = os.getcwd()
+    results = []
+    try:
+        os.chdir(workDir)
+        reqFile = EDCbench.writeRequestFile(workDir, 1)
+        print("{:>14s} {:>8s} {:>6s} {:>10s} {:>10s} {:>12s} {:>10s}".format(
+            "method", "granules", "points", "wall (s)", "CPU (s)", "objects/s", "peak MB"))
+        for numGranules in granuleCounts:
+            for numPoints in pointCounts:
+                for method in methods:
+                    result = runForked(runMethod, method, reqFile, numGranules, numPoints, args.repeat)
+                    results.append(result)
+                    peak = result['max_rss_MB']
+                    print("{:>14s} {:>8d} {:>6d} {:>10.3f} {:>10.3f} {:>12.0f} {:>10s}".format(
+                        method, numGranules, numPoints, result['wall_seconds'], result['cpu_seconds'],
+                        result['objects_per_second'], "n/a" if peak is None else "{:.1f}".format(peak)))
+                os.remove("pendingDwnld.xml")
+    finally:
+        os.chdir(startDir)
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    summary = {'timestamp': stamp,
+               'edclient_version': EDClient.__version__,
+               'python': platform.python_version(),
+               'lxml': ET.__version__,
+               'config': vars(args),
+               'results': results}
+    with open(output, 'w') as fh:
+        json.dump(summary, fh, indent=2, sort_keys=True)
+    print("Results written to {}".format(output))
+
+
+if __name__ == '__main__':
+    main()